@@ -0,0 +1,296 @@
+# Offline benchmarks for the search path, fuzzy matching and the data layer.
+#
+#   python benchmark.py                                   # in-memory stand-in, 10k/100k/1M titles
+#   python benchmark.py --sizes 10000 --out base.json     # save results
+#   python benchmark.py --sizes 10000 --compare base.json # diff against a previous run
+#   python benchmark.py --mongo mongodb://localhost:27017 # real Mongo (uses a movie_bot_bench database)
+
+import argparse
+import asyncio
+import json
+import platform
+import random
+import string
+import subprocess
+import time
+from datetime import datetime, UTC
+
+from catalog import TitleIndex, analyze, clean_text
+from popular import PopularBoard
+
+WORDS_PER_TITLE = (1, 4)
+LANGUAGES = ["Bengali", "Hindi", "English", "Dual Audio [Hindi-English]", ""]
+QUALITIES = ["480p", "720p", "1080p", "2160p 4K", "WEB-DL", "HDRip", "BluRay", "HDCAM", "x264", "HEVC"]
+EXTRA_LINES = ["", "\nDownload now", "\n🎬 Full movie | Join @CTGMovieOfficial", "\nSize: 1.2GB\nSubtitles: English"]
+SCENARIOS = ["direct", "fuzzy", "lang", "popular", "rating"]
+
+
+def make_vocabulary(rng, size=30000):
+    vowels = "aeiou"
+    words = set()
+    while len(words) < size:
+        length = rng.randint(3, 9)
+        words.add("".join(rng.choice(string.ascii_lowercase if i % 2 == 0 else vowels) for i in range(length)))
+    return sorted(words)
+
+
+def make_catalog(size, rng):
+    vocabulary = make_vocabulary(rng)
+    movies = []
+    for message_id in range(1, size + 1):
+        name = " ".join(rng.choice(vocabulary).capitalize() for _ in range(rng.randint(*WORDS_PER_TITLE)))
+        caption = (
+            f"{name} ({rng.randint(1960, 2025)}) {rng.choice(LANGUAGES)} "
+            f"{' '.join(rng.sample(QUALITIES, rng.randint(1, 3)))}{rng.choice(EXTRA_LINES)}"
+        )
+        movies.append({
+            "message_id": message_id,
+            "title": caption,
+            "name": name,
+            **analyze(caption),
+            "views_count": int(rng.paretovariate(1.2)) - 1
+        })
+    return movies
+
+
+def typo(text, rng):
+    if len(text) < 4:
+        return text
+    i = rng.randrange(1, len(text) - 1)
+    edit = rng.choice(("swap", "drop", "replace", "insert"))
+    if edit == "swap":
+        return text[:i] + text[i + 1] + text[i] + text[i + 2:]
+    if edit == "drop":
+        return text[:i] + text[i + 1:]
+    if edit == "replace":
+        return text[:i] + rng.choice(string.ascii_lowercase) + text[i + 1:]
+    return text[:i] + rng.choice(string.ascii_lowercase) + text[i:]
+
+
+def make_queries(movies, count, rng):
+    picks = [rng.choice(movies) for _ in range(count)]
+    return {
+        # What people type when the title exists: the name, sometimes only its first words
+        "direct": [" ".join(movie["name"].split()[:rng.randint(1, 3)]) for movie in picks],
+        "fuzzy": [clean_text(typo(movie["name"].lower(), rng)) for movie in picks],
+        "lang": [(clean_text(typo(movie["name"].lower(), rng)), rng.choice(["Bengali", "Hindi", "English"])) for movie in picks]
+    }
+
+
+class MemoryStore:
+    # Stand-in for the Mongo repositories: dict lookups and a set for the unique rating index
+    def __init__(self, movies):
+        self.movies = {movie["message_id"]: movie for movie in movies}
+        self.ratings = set()
+        self.favorites = {}
+
+    async def get_many(self, message_ids, projection=None):
+        return [self.movies[message_id] for message_id in message_ids if message_id in self.movies]
+
+    async def favorite_ids(self, user_id):
+        return self.favorites.get(user_id, [])
+
+    async def vote(self, message_id, user_id, action):
+        if (message_id, user_id) in self.ratings:
+            return None
+        self.ratings.add((message_id, user_id))
+        movie = self.movies[message_id]
+        field = "likes" if action == "like" else "dislikes"
+        movie[field] = movie.get(field, 0) + 1
+        return movie.get("likes", 0), movie.get("dislikes", 0)
+
+    async def close(self):
+        pass
+
+
+class MongoStore:
+    def __init__(self, url, movies):
+        from database import Database
+        from schema import SchemaManager
+        self.db = Database(url, name="movie_bot_bench")
+        self.movies = movies
+        self.schema = SchemaManager(self.db)
+
+    async def setup(self):
+        from pymongo import InsertOne
+        await self.db.client.drop_database("movie_bot_bench")
+        await self.schema.sync_indexes(wait=True)
+        for i in range(0, len(self.movies), 10000):
+            ops = [InsertOne({key: value for key, value in movie.items() if key != "name"}) for movie in self.movies[i:i + 10000]]
+            await self.db.movies_col.bulk_write(ops, ordered=False)
+
+    async def get_many(self, message_ids, projection=None):
+        return await self.db.movies.get_many(message_ids, projection)
+
+    async def favorite_ids(self, user_id):
+        return await self.db.users.favorites(user_id)
+
+    async def vote(self, message_id, user_id, action):
+        return await self.db.ratings.vote(message_id, user_id, action)
+
+    async def close(self):
+        await self.db.client.drop_database("movie_bot_bench")
+        await self.db.close()
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, wall):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 4),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 4),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 4),
+        "mean_ms": round(sum(latencies) / len(latencies) * 1000, 4) if latencies else 0.0,
+        "ops_per_sec": round(len(latencies) / wall, 1) if wall else 0.0
+    }
+
+
+async def run_scenario(operation, inputs, concurrency):
+    latencies = []
+    queue = list(inputs)
+
+    async def worker():
+        while queue:
+            item = queue.pop()
+            start = time.perf_counter()
+            await operation(item)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+async def bench_size(size, args):
+    rng = random.Random(args.seed)
+    print(f"\n== {size} titles ==")
+    movies = make_catalog(size, rng)
+    queries = make_queries(movies, args.queries, rng)
+
+    store = MongoStore(args.mongo, movies) if args.mongo else MemoryStore(movies)
+    if args.mongo:
+        start = time.perf_counter()
+        await store.setup()
+        print(f"mongo load: {time.perf_counter() - start:.1f}s")
+
+    results = {}
+    catalog = TitleIndex()
+    start = time.perf_counter()
+    catalog.load(movies)
+    results["index_build_seconds"] = round(time.perf_counter() - start, 3)
+
+    board = PopularBoard()
+    start = time.perf_counter()
+    board.load({movie["message_id"]: movie["views_count"] for movie in movies}, [])
+    results["popular_build_seconds"] = round(time.perf_counter() - start, 3)
+
+    projection = {"title": 1, "message_id": 1, "views_count": 1}
+
+    async def direct(query):
+        await store.get_many(catalog.search(query, clean_text(query), limit=args.results), projection)
+
+    async def fuzzy(query_clean):
+        matches = catalog.fuzzy(query_clean, limit=args.results)
+        await store.get_many([message_id for message_id, _ in matches], projection)
+
+    async def lang(item):
+        query_clean, language = item
+        matches = catalog.fuzzy(query_clean, limit=args.results, language=language)
+        await store.get_many([message_id for message_id, _ in matches], projection)
+
+    async def popular(user_id):
+        favorite_ids = set(await store.favorite_ids(user_id))
+        buttons = []
+        for message_id, views_count in board.top("all", args.results):
+            movie = catalog.get(message_id)
+            mark = "❤️ " if message_id in favorite_ids else ""
+            buttons.append(f"{mark}{movie['title'][:40]} ({views_count} views)")
+        return buttons
+
+    async def rating(item):
+        message_id, user_id = item
+        await store.vote(message_id, user_id, "like")
+
+    inputs = {
+        "direct": queries["direct"],
+        "fuzzy": queries["fuzzy"],
+        "lang": queries["lang"],
+        "popular": [rng.randrange(1, 10 ** 9) for _ in range(args.queries)],
+        "rating": [(rng.randint(1, size), rng.randrange(1, 10 ** 9)) for _ in range(args.queries)]
+    }
+    operations = {"direct": direct, "fuzzy": fuzzy, "lang": lang, "popular": popular, "rating": rating}
+
+    for scenario in args.scenarios:
+        results[scenario] = await run_scenario(operations[scenario], inputs[scenario], args.concurrency)
+        stats = results[scenario]
+        print(f"{scenario:>8}: p50 {stats['p50_ms']:8.3f} ms  p95 {stats['p95_ms']:8.3f} ms  "
+              f"p99 {stats['p99_ms']:8.3f} ms  {stats['ops_per_sec']:10.1f} ops/s")
+
+    await store.close()
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def compare(report, baseline_path):
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    print(f"\n== p95 vs {baseline_path} ({baseline.get('commit')}) ==")
+    for size, results in report["results"].items():
+        for scenario in SCENARIOS:
+            old = baseline["results"].get(size, {}).get(scenario)
+            new = results.get(scenario)
+            if not old or not new or not old["p95_ms"]:
+                continue
+            change = (new["p95_ms"] - old["p95_ms"]) / old["p95_ms"] * 100
+            print(f"{size:>8} {scenario:>8}: {old['p95_ms']:8.3f} -> {new['p95_ms']:8.3f} ms ({change:+.1f}%)")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark search, fuzzy matching and the data layer on synthetic catalogs.")
+    parser.add_argument("--sizes", default="10000,100000,1000000", help="comma separated catalog sizes")
+    parser.add_argument("--queries", type=int, default=2000, help="operations per scenario")
+    parser.add_argument("--results", type=int, default=10, help="results per query (RESULTS_COUNT)")
+    parser.add_argument("--concurrency", type=int, default=1, help="concurrent callers per scenario")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--mongo", help="MongoDB URL; default is the in-memory stand-in")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="write results as JSON to this file")
+    parser.add_argument("--compare", help="previous JSON results to compare p95 against")
+    args = parser.parse_args()
+    args.scenarios = [scenario for scenario in args.scenarios.split(",") if scenario in SCENARIOS]
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": datetime.now(UTC).isoformat(),
+        "backend": "mongo" if args.mongo else "memory",
+        "python": platform.python_version(),
+        "queries": args.queries,
+        "concurrency": args.concurrency,
+        "results": {}
+    }
+    for size in (int(size) for size in args.sizes.split(",")):
+        report["results"][str(size)] = await bench_size(size, args)
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"\nResults written to {args.out}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
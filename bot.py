@@ -1,170 +1,414 @@
-from pyrogram import Client, filters
-from pyrogram.types import Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from pymongo import MongoClient, ASCENDING
-from pymongo.errors import OperationFailure, CollectionInvalid, DuplicateKeyError
-from flask import Flask
+from pyrogram import Client, filters, idle
+from pyrogram.enums import ChatType
+from pyrogram.types import (
+    Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
+    InlineQuery, InlineQueryResultArticle, InputTextMessageContent
+)
+from flask import Flask, Response
 from threading import Thread
 import os
-import re
 from datetime import datetime, UTC, timedelta
 import asyncio
+import time
 import urllib.parse
-from fuzzywuzzy import process
 from concurrent.futures import ThreadPoolExecutor
+from catalog import TitleIndex, clean_text, normalize, normalize_query, movie_from_post, request_key, tokenize
+from database import Database, WriteBuffer
+from broadcast import BroadcastEngine
+from scheduler import DeleteScheduler
+from reindex import Reindexer
+from digest import NoResultDigest
+from rollups import StatsRollups
+from schema import SchemaManager
+from popular import PopularBoard, WEEK_DAYS, utc_day
+from cache import LRUCache
+from entities import EntityCache
+from callbacks import CallbackRegistry
+from paging import keyset_page, fits
+from fuzzypool import FuzzyPool
+from ratelimit import TokenBuckets, UpdateLimiter
+from metrics import Registry, MongoCommandMetrics, instrument
 
 # Configs - নিশ্চিত করুন এই ভেরিয়েবলগুলো আপনার এনভায়রনমেন্টে সেট করা আছে।
 API_ID = int(os.getenv("API_ID"))
 API_HASH = os.getenv("API_HASH")
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 CHANNEL_ID = int(os.getenv("CHANNEL_ID"))
-RESULTS_COUNT = int(os.getenv("RESULTS_COUNT", 10))
+RESULTS_COUNT = int(os.getenv("RESULTS_COUNT", 10))  # buttons per page
+SEARCH_DEPTH = int(os.getenv("SEARCH_DEPTH", 50))  # results kept per query for paging
+INLINE_RESULTS = int(os.getenv("INLINE_RESULTS", 20))  # per inline answer, Telegram allows up to 50
+INLINE_CACHE_TIME = int(os.getenv("INLINE_CACHE_TIME", 300))  # seconds Telegram may reuse an answer
+CALLBACK_TOKEN_TTL = int(os.getenv("CALLBACK_TOKEN_TTL", 3600))  # seconds a result button keeps working
+CALLBACK_ADMIN_TOKEN_TTL = int(os.getenv("CALLBACK_ADMIN_TOKEN_TTL", 7 * 24 * 3600))  # admin no-result buttons
+NO_RESULT_DIGEST_INTERVAL = int(os.getenv("NO_RESULT_DIGEST_INTERVAL", 3600))  # seconds between admin digests
+NO_RESULT_DIGEST_SIZE = int(os.getenv("NO_RESULT_DIGEST_SIZE", 10))  # top missed queries per digest
+CALLBACK_STORE = os.getenv("CALLBACK_STORE", "memory")  # "mongo" keeps buttons working across restarts
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", 5000))
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", 120))
+ENTITY_CACHE_MOVIES = int(os.getenv("ENTITY_CACHE_MOVIES", 20000))  # rating counts kept for watch_ links
+ENTITY_CACHE_USERS = int(os.getenv("ENTITY_CACHE_USERS", 50000))  # favorite sets kept
+ENTITY_CACHE_TTL = int(os.getenv("ENTITY_CACHE_TTL", 600))
+AUTO_DELETE_DELAY = int(os.getenv("AUTO_DELETE_DELAY", 300))
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))  # messages per second, across all jobs
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", 10))
+BROADCAST_BATCH_SIZE = int(os.getenv("BROADCAST_BATCH_SIZE", 500))
+REINDEX_BATCH_SIZE = int(os.getenv("REINDEX_BATCH_SIZE", 1000))  # movies per bulk upsert
+RATE_LIMIT_USER_RATE = float(os.getenv("RATE_LIMIT_USER_RATE", 1))  # updates per second per user
+RATE_LIMIT_USER_BURST = int(os.getenv("RATE_LIMIT_USER_BURST", 5))
+RATE_LIMIT_CHAT_RATE = float(os.getenv("RATE_LIMIT_CHAT_RATE", 3))  # updates per second per group
+RATE_LIMIT_CHAT_BURST = int(os.getenv("RATE_LIMIT_CHAT_BURST", 20))
+RATE_LIMIT_TRACKED = int(os.getenv("RATE_LIMIT_TRACKED", 50000))  # buckets kept per table
 ADMIN_IDS = list(map(int, os.getenv("ADMIN_IDS", "").split(",")))
 DATABASE_URL = os.getenv("DATABASE_URL")
+DATABASE_NAME = os.getenv("DATABASE_NAME", "movie_bot")
 UPDATE_CHANNEL = os.getenv("UPDATE_CHANNEL", "https://t.me/CTGMovieOfficial")
 START_PIC = os.getenv("START_PIC", "https://i.ibb.co/prnGXMr3/photo-2025-05-16-05-15-45-7504908428624527364.jpg")
 
 app = Client("movie_bot", api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
+# Metrics, served in Prometheus text format on the health server's /metrics
+metrics = Registry()
+HANDLER_REQUESTS = metrics.counter("moviebot_handler_requests_total", "Updates handled, per handler", ["handler"])
+HANDLER_ERRORS = metrics.counter("moviebot_handler_errors_total", "Handler calls that raised, per handler", ["handler"])
+HANDLER_LATENCY = metrics.histogram("moviebot_handler_seconds", "Handler latency", ["handler"])
+SEARCH_STAGE_LATENCY = metrics.histogram("moviebot_search_stage_seconds", "search() latency per stage (index, fuzzy, reply)", ["stage"])
+GROUP_MESSAGES_SKIPPED = metrics.counter("moviebot_group_messages_skipped_total", "Group messages dropped before any DB or Telegram work", ["reason"])
+MONGO_LATENCY = metrics.histogram("moviebot_mongo_command_seconds", "Mongo command latency per collection", ["collection", "command"])
+
+def instrumented(name):
+    return instrument(HANDLER_REQUESTS, HANDLER_ERRORS, HANDLER_LATENCY, name)
+
 # MongoDB setup
-mongo = MongoClient(DATABASE_URL)
-db = mongo["movie_bot"]
-movies_col = db["movies"]
-feedback_col = db["feedback"]
-stats_col = db["stats"]
-users_col = db["users"]
-settings_col = db["settings"]
-requests_col = db["requests"]
-
-# Indexing - Optimized for faster search
-try:
-    movies_col.drop_index("message_id_1")
-    print("Existing 'message_id_1' index dropped successfully (if it existed).")
-except Exception as e:
-    if "index not found" not in str(e):
-        print(f"Error dropping existing index 'message_id_1': {e}")
-    else:
-        print("'message_id_1' index not found, proceeding with creation.")
-
-try:
-    movies_col.create_index("message_id", unique=True, background=True)
-    print("Index 'message_id' (unique) ensured successfully.")
-except DuplicateKeyError as e:
-    print(f"Error: Cannot create unique index on 'message_id' due to duplicate entries. "
-          f"Please clean your database manually if this persists. Error: {e}")
-except OperationFailure as e:
-    print(f"Error creating index 'message_id': {e}")
-
-movies_col.create_index("language", background=True)
-movies_col.create_index([("title_clean", ASCENDING)], background=True)
-movies_col.create_index([("language", ASCENDING), ("title_clean", ASCENDING)], background=True)
-movies_col.create_index([("views_count", ASCENDING)], background=True)
-print("All other necessary indexes ensured successfully.")
+MONGO_POOL_SIZE = int(os.getenv("MONGO_POOL_SIZE", 50))
+MONGO_TIMEOUT_MS = int(os.getenv("MONGO_TIMEOUT_MS", 5000))
+MONGO_RETRIES = int(os.getenv("MONGO_RETRIES", 3))
+
+db = Database(
+    DATABASE_URL,
+    name=DATABASE_NAME,
+    pool_size=MONGO_POOL_SIZE,
+    timeout_ms=MONGO_TIMEOUT_MS,
+    retries=MONGO_RETRIES,
+    event_listeners=[MongoCommandMetrics(MONGO_LATENCY)]
+)
+
+# Declared indexes and data migrations, checked against Mongo on startup
+schema = SchemaManager(db)
+
+# views_count increments, per-user last_query and failed searches are buffered and written in bulk
+WRITE_FLUSH_INTERVAL = float(os.getenv("WRITE_FLUSH_INTERVAL", 5))
+WRITE_FLUSH_SIZE = int(os.getenv("WRITE_FLUSH_SIZE", 1000))
+write_buffer = WriteBuffer(db, interval=WRITE_FLUSH_INTERVAL, max_pending=WRITE_FLUSH_SIZE)
+
+# Per-minute traffic counters from write_buffer.count, rolled up into hours and days for /stats
+STATS_ROLLUP_INTERVAL = int(os.getenv("STATS_ROLLUP_INTERVAL", 300))
+stats_rollups = StatsRollups(db, interval=STATS_ROLLUP_INTERVAL)
+
+# Movie rating counts and per-user favorites for the watch_ path, kept current by the handlers
+entities = EntityCache(db, movie_size=ENTITY_CACHE_MOVIES, user_size=ENTITY_CACHE_USERS, ttl=ENTITY_CACHE_TTL)
+
+# FUZZY_WORKERS > 0 moves fuzzy scoring to that many processes (one per spare core)
+FUZZY_WORKERS = int(os.getenv("FUZZY_WORKERS", 0))
+FUZZY_REFRESH_DELAY = float(os.getenv("FUZZY_REFRESH_DELAY", 30))  # seconds between snapshot checks
+
+# In-memory title index, built at startup and kept current by save_post and the delete commands
+catalog = TitleIndex()
+
+fuzzy_pool = FuzzyPool(catalog, FUZZY_WORKERS, refresh_delay=FUZZY_REFRESH_DELAY) if FUZZY_WORKERS > 0 else None
+if fuzzy_pool:
+    # Forked here, before the health server and the thread pools start any thread
+    fuzzy_pool.spawn()
 
 # Flask App for health check
 flask_app = Flask(__name__)
 @flask_app.route("/")
 def home():
     return "Bot is running!"
+
+@flask_app.route("/metrics")
+def metrics_endpoint():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 Thread(target=lambda: flask_app.run(host="0.0.0.0", port=8080)).start()
 
-# Initialize a global ThreadPoolExecutor for running blocking functions (like fuzzywuzzy)
+# Initialize a global ThreadPoolExecutor for running blocking functions (like fuzzy scoring)
 thread_pool_executor = ThreadPoolExecutor(max_workers=5)
 
+# Materialized /popular lists, kept in memory and bumped on every watch
+popular_board = PopularBoard()
+POPULAR_WINDOWS = {"today": "আজকের", "week": "এই সপ্তাহের", "all": "বর্তমানে"}
+
+metrics.gauge("moviebot_executor_queue_depth", "Jobs waiting for a fuzzy scoring thread", lambda: thread_pool_executor._work_queue.qsize())
+if fuzzy_pool:
+    metrics.gauge("moviebot_fuzzy_pool_pending", "Fuzzy jobs submitted to the process pool and not finished", fuzzy_pool.queue_depth)
+    metrics.gauge("moviebot_fuzzy_snapshot_refreshes_total", "Catalog snapshots published to the fuzzy workers", lambda: fuzzy_pool.refreshes, kind="counter")
+    metrics.gauge("moviebot_fuzzy_pool_restarts_total", "Fuzzy worker pools replaced after breaking", lambda: fuzzy_pool.restarts, kind="counter")
+metrics.gauge("moviebot_catalog_movies", "Movies in the in-memory title index", lambda: len(catalog))
+metrics.gauge("moviebot_auto_delete_pending", "Messages waiting to be auto-deleted", lambda: len(delete_scheduler))
+metrics.gauge("moviebot_broadcast_messages_total", "Messages sent by broadcast jobs", lambda: broadcaster.sent_total, kind="counter")
+metrics.gauge("moviebot_write_buffer_pending", "Buffered view/user updates not yet flushed", lambda: len(write_buffer))
+metrics.gauge("moviebot_write_buffer_flush_lag_seconds", "Age of the oldest update at the last flush", lambda: write_buffer.last_flush_lag)
+metrics.gauge("moviebot_write_buffer_dropped_total", "Buffered $inc updates dropped after a flush that may have been applied", lambda: write_buffer.dropped, kind="counter")
+metrics.gauge("moviebot_result_cache_hits_total", "Result cache hits", lambda: result_cache.hits, kind="counter")
+metrics.gauge("moviebot_result_cache_misses_total", "Result cache misses", lambda: result_cache.misses, kind="counter")
+metrics.gauge("moviebot_result_cache_evictions_total", "Result cache entries evicted to stay within RESULT_CACHE_SIZE", lambda: result_cache.evictions, kind="counter")
+metrics.gauge("moviebot_result_cache_expirations_total", "Result cache entries dropped after RESULT_CACHE_TTL", lambda: result_cache.expirations, kind="counter")
+metrics.gauge("moviebot_result_cache_invalidations_total", "Result cache entries invalidated by catalog changes", lambda: result_cache.invalidations, kind="counter")
+metrics.gauge("moviebot_rate_limited_total", "Updates dropped by the rate limiter", lambda: sum(update_limiter.dropped.values()), kind="counter")
+metrics.gauge("moviebot_entity_cache_hits_total", "Movie and favorites lookups served from the entity cache", lambda: sum(cache["hits"] for cache in entities.stats().values()), kind="counter")
+metrics.gauge("moviebot_entity_cache_misses_total", "Movie and favorites lookups that went to Mongo", lambda: sum(cache["misses"] for cache in entities.stats().values()), kind="counter")
+metrics.gauge("moviebot_entity_cache_evictions_total", "Movies and favorites evicted from the entity cache", lambda: sum(cache["evictions"] for cache in entities.stats().values()), kind="counter")
+metrics.gauge("moviebot_callback_tokens", "Callback tokens held in memory", lambda: callback_tokens.stats()["size"])
+metrics.gauge("moviebot_callback_tokens_expired_total", "Button presses whose callback token had expired", lambda: callback_tokens.stats()["expired"], kind="counter")
+metrics.gauge("moviebot_rate_limit_buckets", "Token buckets currently tracked", lambda: len(update_limiter))
+
+async def load_catalog():
+    movies = await db.movies.index_fields()
+    catalog.load(movies)
+    since = utc_day(datetime.now(UTC) - timedelta(days=WEEK_DAYS - 1))
+    popular_board.load(
+        {movie["message_id"]: movie.get("views_count", 0) for movie in movies},
+        await db.daily_views.since(since)
+    )
+    print(f"Catalog index loaded with {len(catalog)} movies.")
+
 # Helpers
-def clean_text(text):
-    return re.sub(r'[^a-zA-Z0-9]', '', text.lower())
+def delete_message_later(chat_id, message_id, delay=None): # ডিফল্ট ডিলে AUTO_DELETE_DELAY (300 সেকেন্ড)
+    delete_scheduler.schedule(chat_id, message_id, delay)
+
+def find_corrected_matches(query_clean, score_cutoff=70, limit=5, language=None):
+    # Scores the query against the whole catalog, returns [(message_id, score), ...]
+    return catalog.fuzzy(query_clean, limit=limit, score_cutoff=score_cutoff, language=language)
+
+async def score_fuzzy(query_clean, score_cutoff=70, limit=5, language=None):
+    # On the worker processes when enabled, otherwise in the thread pool
+    if fuzzy_pool:
+        return await fuzzy_pool.search(query_clean, limit=limit, score_cutoff=score_cutoff, language=language)
+    return await asyncio.get_running_loop().run_in_executor(
+        thread_pool_executor, find_corrected_matches, query_clean, score_cutoff, limit, language
+    )
 
-def extract_language(text):
-    langs = ["Bengali", "Hindi", "English"]
-    return next((lang for lang in langs if lang.lower() in text.lower()), None)
+# Auto-deletes: one timer heap for every pending message, persisted in Mongo
+delete_scheduler = DeleteScheduler(app, db, delay=AUTO_DELETE_DELAY)
+
+# Search results keyed by (normalized query, language, SEARCH_DEPTH) -> (kind, [(message_id, score), ...])
+result_cache = LRUCache(maxsize=RESULT_CACHE_SIZE, ttl=RESULT_CACHE_TTL)
+
+def invalidate_results(message_id, title=None, title_clean=None):
+    # Drops every cached result that lists this movie. For a new or edited title also
+    # drops fuzzy/no-result entries and direct results the title would now match.
+    def affected(key, value):
+        kind, ranked = value
+        if any(mid == message_id for mid, _ in ranked):
+            return True
+        if title is None:
+            return False
+        query, language, _ = key
+        return kind != "direct" or language is not None or title_clean.startswith(clean_text(query)) or query in normalize(title)
+    return result_cache.invalidate(affected)
+
+async def lookup_movies(query, query_clean, language=None):
+    # Direct index hits first, whole-catalog fuzzy suggestions otherwise. Both come
+    # back as (message_id, score) sorted by (-score, message_id), the paging key.
+    with SEARCH_STAGE_LATENCY.time(stage="index"):
+        ranked = catalog.ranked(query, query_clean, language, limit=SEARCH_DEPTH)
+    if ranked:
+        return "direct", ranked
+
+    with SEARCH_STAGE_LATENCY.time(stage="fuzzy"):
+        ranked = await score_fuzzy(query_clean, 70, SEARCH_DEPTH, language)
+    return ("fuzzy" if ranked else "none"), ranked
+
+# callback_data carries a short token; the query and candidates stay server-side
+callback_tokens = CallbackRegistry(ttl=CALLBACK_TOKEN_TTL, db=db if CALLBACK_STORE == "mongo" else None)
+
+async def results_token(query, kind, ranked, language=None):
+    return await callback_tokens.put(
+        {"query": query, "kind": kind, "ranked": ranked, "language": language},
+        key=("search", query, language)
+    )
 
-def extract_year(text):
-    match = re.search(r'\b(19|20)\d{2}\b', text)
-    return int(match.group(0)) if match else None
+async def cached_results(query, language=None):
+    # query is the normalized query text (query_clean for the lang_ buttons)
+    cache_key = (query, language, SEARCH_DEPTH)
+    result = result_cache.get(cache_key)
+    if result is None:
+        result = await lookup_movies(query, clean_text(query), language)
+        result_cache.set(cache_key, result)
+    return result
+
+# Result pages: titles come from the catalog and views from the popular board, so
+# a page costs no Mongo reads. Pages are cut with keyset cursors, not offsets.
+def watch_button(message_id):
+    movie = catalog.get(message_id)
+    return InlineKeyboardButton(
+        text=f"{movie['title'][:40]} ({popular_board.views(message_id)} ভিউ)",
+        url=f"https://t.me/{app.me.username}?start=watch_{message_id}"
+    )
 
-async def delete_message_later(chat_id, message_id, delay=300): # ডিলে 300 সেকেন্ড (5 মিনিট) সেট করা হয়েছে
-    await asyncio.sleep(delay)
-    try:
-        await app.delete_messages(chat_id, message_id)
-    except Exception as e:
-        if "MESSAGE_ID_INVALID" not in str(e) and "MESSAGE_DELETE_FORBIDDEN" not in str(e):
-            print(f"Error deleting message {message_id} in chat {chat_id}: {e}")
-
-def find_corrected_matches(query_clean, all_movie_titles_data, score_cutoff=70, limit=5):
-    if not all_movie_titles_data:
-        return []
-
-    choices = [item["title_clean"] for item in all_movie_titles_data]
-
-    matches_raw = process.extract(query_clean, choices, limit=limit)
-
-    corrected_suggestions = []
-    for matched_clean_title, score in matches_raw:
-        if score >= score_cutoff:
-            for movie_data in all_movie_titles_data:
-                if movie_data["title_clean"] == matched_clean_title:
-                    corrected_suggestions.append({
-                        "title": movie_data["original_title"],
-                        "message_id": movie_data["message_id"],
-                        "language": movie_data["language"],
-                        "views_count": movie_data.get("views_count", 0) # Add views_count here
-                    })
-                    break
-    return corrected_suggestions
-
-# Global dictionary to keep track of last start command time per user
-user_last_start_time = {}
+def nav_row(prev_data, next_data):
+    # Buttons whose cursor doesn't fit in callback_data are left out
+    row = []
+    if prev_data and fits(prev_data):
+        row.append(InlineKeyboardButton("⬅️ আগের", callback_data=prev_data))
+    if next_data and fits(next_data):
+        row.append(InlineKeyboardButton("পরের ➡️", callback_data=next_data))
+    return [row] if row else []
+
+def score_key(pair):
+    message_id, score = pair
+    return (-score, message_id)
+
+def search_keyboard(kind, ranked, token, language=None, after=None, before=None):
+    ranked = [tuple(pair) for pair in ranked if pair[0] in catalog]
+    page, has_prev, has_next = keyset_page(ranked, score_key, RESULTS_COUNT, after, before)
+    buttons = [[watch_button(message_id)] for message_id, _ in page]
+    buttons += nav_row(
+        f"sp_p_{page[0][1]}_{page[0][0]}_{token}" if page and has_prev else None,
+        f"sp_n_{page[-1][1]}_{page[-1][0]}_{token}" if page and has_next else None
+    )
+    if kind == "fuzzy" and language is None:
+        buttons.append([
+            InlineKeyboardButton("বেঙ্গলি", callback_data=f"lang_Bengali_{token}"),
+            InlineKeyboardButton("হিন্দি", callback_data=f"lang_Hindi_{token}"),
+            InlineKeyboardButton("ইংলিশ", callback_data=f"lang_English_{token}")
+        ])
+    return InlineKeyboardMarkup(buttons)
+
+def popular_keyboard(window, favorite_ids, after=None, before=None):
+    top = [pair for pair in popular_board.top(window, popular_board.capacity) if pair[0] in catalog]
+    page, has_prev, has_next = keyset_page(top, score_key, RESULTS_COUNT, after, before)
+    buttons = []
+    for message_id, _ in page:
+        is_favorited = message_id in favorite_ids
+        favorite_button_text = "❌ ফেভারিট থেকে সরান" if is_favorited else "⭐ ফেভারিটে যোগ করুন"
+        buttons.append([watch_button(message_id)])
+        buttons.append([InlineKeyboardButton(favorite_button_text, callback_data=f"toggle_favorite_{message_id}")])
+    buttons += nav_row(
+        f"pp_p_{window}_{page[0][1]}_{page[0][0]}" if page and has_prev else None,
+        f"pp_n_{window}_{page[-1][1]}_{page[-1][0]}" if page and has_next else None
+    )
+    return InlineKeyboardMarkup(buttons) if page else None
+
+def favorites_keyboard(favorite_ids, after=None, before=None):
+    # Newest uploads first; the cursor is the message_id itself
+    ids = sorted((message_id for message_id in set(favorite_ids) if message_id in catalog), reverse=True)
+    page, has_prev, has_next = keyset_page(ids, lambda message_id: -message_id, RESULTS_COUNT, after, before)
+    buttons = []
+    for message_id in page:
+        buttons.append([watch_button(message_id)])
+        buttons.append([
+            InlineKeyboardButton(f"❌ '{catalog.get(message_id)['title'][:20]}...' ফেভারিট থেকে সরান", callback_data=f"toggle_favorite_{message_id}")
+        ])
+    buttons += nav_row(
+        f"fp_p_{page[0]}" if page and has_prev else None,
+        f"fp_n_{page[-1]}" if page and has_next else None
+    )
+    return InlineKeyboardMarkup(buttons) if page else None
+
+# Broadcasts and new-upload notifications, persisted in Mongo and resumed on restart
+broadcaster = BroadcastEngine(
+    app, db,
+    rate=BROADCAST_RATE,
+    concurrency=BROADCAST_CONCURRENCY,
+    batch_size=BROADCAST_BATCH_SIZE,
+    on_sent=lambda m: delete_message_later(m.chat.id, m.id),
+    on_batch=lambda sent: write_buffer.count("broadcasts", sent)
+)
+
+async def refresh_catalog():
+    await load_catalog()
+    result_cache.clear()
+    entities.clear_movies()
+
+# /reindex: rebuilds the movies collection from the channel, resumable across restarts
+reindexer = Reindexer(app, db, CHANNEL_ID, batch_size=REINDEX_BATCH_SIZE, on_done=refresh_catalog)
+
+# Failed searches go to the admins as one periodic digest, grouped by normalized query
+no_result_digest = NoResultDigest(
+    app, db, callback_tokens, ADMIN_IDS,
+    interval=NO_RESULT_DIGEST_INTERVAL,
+    limit=NO_RESULT_DIGEST_SIZE,
+    token_ttl=CALLBACK_ADMIN_TOKEN_TTL
+)
+
+# Token buckets in front of every handler; admins and channel posts are never throttled
+update_limiter = UpdateLimiter(
+    user_rate=RATE_LIMIT_USER_RATE,
+    user_burst=RATE_LIMIT_USER_BURST,
+    chat_rate=RATE_LIMIT_CHAT_RATE,
+    chat_burst=RATE_LIMIT_CHAT_BURST,
+    maxsize=RATE_LIMIT_TRACKED
+)
+# /start is also debounced to one every 5 seconds per user
+start_buckets = TokenBuckets(rate=1 / 5, burst=1, maxsize=RATE_LIMIT_TRACKED)
+
+# group=-1 runs before every other handler; stop_propagation drops the update
+@app.on_message(~filters.chat(CHANNEL_ID) & ~filters.user(ADMIN_IDS), group=-1)
+async def throttle_messages(_, msg: Message):
+    # Group chatter is charged in search(), once it is known to cost a lookup
+    if msg.chat and msg.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP) and not (msg.text or "").startswith("/"):
+        return
+    sender = msg.from_user or msg.sender_chat
+    if update_limiter.check("message", sender.id if sender else None, msg.chat.id if msg.chat else None):
+        msg.stop_propagation()
+
+@app.on_callback_query(~filters.user(ADMIN_IDS), group=-1)
+async def throttle_callbacks(_, cq: CallbackQuery):
+    chat_id = cq.message.chat.id if cq.message else None
+    if update_limiter.check("callback", cq.from_user.id, chat_id):
+        try:
+            await cq.answer("অনেক দ্রুত চাপ দিচ্ছেন, একটু অপেক্ষা করুন।")
+        except Exception:
+            pass
+        cq.stop_propagation()
+
+async def fulfil_requests(message_id, text):
+    # Pending requests whose words all appear in the new post are closed, and everyone
+    # who asked for them gets one message through the broadcast engine
+    fulfilled = await db.requests.fulfil(sorted(set(tokenize(text))), message_id)
+    users = sorted({user_id for request in fulfilled for user_id in request.get("requesters", [])})
+    if not users:
+        return
+    print(f"Post {message_id} fulfils {len(fulfilled)} request(s) from {len(users)} user(s)")
+    await broadcaster.start(
+        f"✅ আপনার অনুরোধ করা মুভি আপলোড হয়েছে:\n**{text.splitlines()[0][:100]}**\nএখনই সার্চ করে দেখুন!",
+        audience={"user_ids": users},
+        auto_delete=True
+    )
 
 @app.on_message(filters.chat(CHANNEL_ID))
+@instrumented("save_post")
 async def save_post(_, msg: Message):
     text = msg.text or msg.caption
     if not text:
         return
 
-    movie_to_save = {
-        "message_id": msg.id,
-        "title": text,
-        "date": msg.date,
-        "year": extract_year(text),
-        "language": extract_language(text),
-        "title_clean": clean_text(text),
-        "views_count": 0,
-        "likes": 0,
-        "dislikes": 0,
-        "rated_by": []
-    }
-
-    result = movies_col.update_one({"message_id": msg.id}, {"$set": movie_to_save}, upsert=True)
-
-    if result.upserted_id is not None:
-        setting = settings_col.find_one({"key": "global_notify"})
-        if setting and setting.get("value"):
-            for user in users_col.find({"notify": {"$ne": False}}):
-                try:
-                    m = await app.send_message(
-                        user["_id"],
-                        f"নতুন মুভি আপলোড হয়েছে:\n**{text.splitlines()[0][:100]}**\nএখনই সার্চ করে দেখুন!"
-                    )
-                    asyncio.create_task(delete_message_later(m.chat.id, m.id))
-                    await asyncio.sleep(0.05)
-                except Exception as e:
-                    if "PEER_ID_INVALID" in str(e) or "USER_IS_BOT" in str(e) or "USER_DEACTIVATED_REQUIRED" in str(e):
-                        print(f"Skipping notification to invalid/blocked user {user['_id']}: {e}")
-                    else:
-                        print(f"Failed to send notification to user {user['_id']}: {e}")
+    movie_to_save = movie_from_post(msg.id, text, msg.date)
+
+    is_new = await db.movies.upsert(movie_to_save)
+    catalog.add(movie_to_save)
+    entities.forget_movie(msg.id)
+    invalidate_results(msg.id, text, movie_to_save["title_clean"])
+
+    if is_new:
+        await fulfil_requests(msg.id, text)
+
+    if is_new and await db.settings.get("global_notify"):
+        # Runs as a background job so the next channel post isn't held up
+        await broadcaster.start(
+            f"নতুন মুভি আপলোড হয়েছে:\n**{text.splitlines()[0][:100]}**\nএখনই সার্চ করে দেখুন!",
+            audience="notify",
+            auto_delete=True
+        )
 
 @app.on_message(filters.command("start"))
+@instrumented("start")
 async def start(_, msg: Message):
     user_id = msg.from_user.id
-    current_time = datetime.now(UTC)
 
-    if user_id in user_last_start_time:
-        time_since_last_start = current_time - user_last_start_time[user_id]
-        if time_since_last_start < timedelta(seconds=5):
-            print(f"User {user_id} sent /start too quickly. Ignoring.")
-            return
-
-    user_last_start_time[user_id] = current_time
+    if not start_buckets.allow(user_id):
+        print(f"User {user_id} sent /start too quickly. Ignoring.")
+        return
 
     if len(msg.command) > 1 and msg.command[1].startswith("watch_"):
         message_id = int(msg.command[1].replace("watch_", ""))
@@ -176,22 +420,22 @@ async def start(_, msg: Message):
                 protect_content=True
             )
 
-            movie_data = movies_col.find_one({"message_id": message_id})
+            # Both reads come from the entity cache in steady state
+            movie_data = await entities.movie(message_id)
             if movie_data:
                 likes_count = movie_data.get('likes', 0)
                 dislikes_count = movie_data.get('dislikes', 0)
 
                 # Fetch user's favorite movies to check if this movie is already favorited
-                user_data = users_col.find_one({"_id": user_id})
-                is_favorited = message_id in user_data.get("favorite_movies", []) if user_data else False
+                is_favorited = message_id in await entities.favorites(user_id)
 
                 favorite_button_text = "❌ ফেভারিট থেকে সরান" if is_favorited else "⭐ ফেভারিটে যোগ করুন"
                 favorite_callback_data = f"toggle_favorite_{message_id}"
 
                 rating_buttons = InlineKeyboardMarkup([
                     [
-                        InlineKeyboardButton(f"👍 লাইক ({likes_count})", callback_data=f"like_{message_id}_{user_id}"),
-                        InlineKeyboardButton(f"👎 ডিসলাইক ({dislikes_count})", callback_data=f"dislike_{message_id}_{user_id}")
+                        InlineKeyboardButton(f"👍 লাইক ({likes_count})", callback_data=f"like_{message_id}"),
+                        InlineKeyboardButton(f"👎 ডিসলাইক ({dislikes_count})", callback_data=f"dislike_{message_id}")
                     ],
                     [ # ফেভারিট বাটন এখানে যোগ করা হয়েছে
                         InlineKeyboardButton(favorite_button_text, callback_data=favorite_callback_data)
@@ -203,370 +447,451 @@ async def start(_, msg: Message):
                     reply_markup=rating_buttons,
                     reply_to_message_id=copied_message.id
                 )
-                asyncio.create_task(delete_message_later(rating_message.chat.id, rating_message.id))
-                asyncio.create_task(delete_message_later(copied_message.chat.id, copied_message.id))
+                delete_message_later(rating_message.chat.id, rating_message.id)
+                delete_message_later(copied_message.chat.id, copied_message.id)
 
-            movies_col.update_one(
-                {"message_id": message_id},
-                {"$inc": {"views_count": 1}}
-            )
+            write_buffer.incr_views(message_id)
+            write_buffer.count("watches")
+            popular_board.record_view(message_id)
 
         except Exception as e:
             error_msg = await msg.reply_text("মুভিটি খুঁজে পাওয়া যায়নি বা লোড করা যায়নি।")
-            asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+            delete_message_later(error_msg.chat.id, error_msg.id)
             print(f"Error copying message from start payload: {e}")
         return
 
-    users_col.update_one(
-        {"_id": msg.from_user.id},
-        {"$set": {"joined": datetime.now(UTC), "notify": True}, "$setOnInsert": {"favorite_movies": []}}, # favorite_movies যোগ করা হয়েছে
-        upsert=True
-    )
+    if await db.users.register(msg.from_user.id):
+        write_buffer.count("new_users")
     btns = InlineKeyboardMarkup([
         [InlineKeyboardButton("আপডেট চ্যানেল", url=UPDATE_CHANNEL)],
         [InlineKeyboardButton("অ্যাডমিনের সাথে যোগাযোগ", url="https://t.me/ctgmovies23")]
     ])
     start_message = await msg.reply_photo(photo=START_PIC, caption="আমাকে মুভির নাম লিখে পাঠান, আমি খুঁজে দেবো।", reply_markup=btns)
-    asyncio.create_task(delete_message_later(start_message.chat.id, start_message.id))
+    delete_message_later(start_message.chat.id, start_message.id)
 
 @app.on_message(filters.command("feedback") & filters.private)
+@instrumented("feedback")
 async def feedback(_, msg: Message):
     if len(msg.command) < 2:
         error_msg = await msg.reply("অনুগ্রহ করে /feedback এর পর আপনার মতামত লিখুন।")
-        asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+        delete_message_later(error_msg.chat.id, error_msg.id)
         return
-    feedback_col.insert_one({
-        "user": msg.from_user.id,
-        "text": msg.text.split(None, 1)[1],
-        "time": datetime.now(UTC)
-    })
+    await db.feedback.add(msg.from_user.id, msg.text.split(None, 1)[1])
     m = await msg.reply("আপনার মতামতের জন্য ধন্যবাদ!")
-    asyncio.create_task(delete_message_later(m.chat.id, m.id))
+    delete_message_later(m.chat.id, m.id)
 
 @app.on_message(filters.command("broadcast") & filters.user(ADMIN_IDS))
+@instrumented("broadcast")
 async def broadcast(_, msg: Message):
     if len(msg.command) < 2:
-        error_msg = await msg.reply("ব্যবহার: /broadcast আপনার মেসেজ এখানে")
-        asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+        error_msg = await msg.reply("ব্যবহার: /broadcast আপনার মেসেজ এখানে অথবা /broadcast resume")
+        delete_message_later(error_msg.chat.id, error_msg.id)
+        return
+    if msg.command[1:] == ["resume"]:
+        # Jobs that stopped on an error continue after their last checkpoint
+        resumed = await broadcaster.resume(failed=True)
+        reply_msg = await msg.reply(f"🔄 {resumed} টি ব্রডকাস্ট আবার চালু করা হয়েছে।" if resumed else "চালু করার মতো কোনো থেমে যাওয়া ব্রডকাস্ট নেই।")
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
         return
-    count = 0
     message_to_send = msg.text.split(None, 1)[1]
-    for user in users_col.find():
-        try:
-            await app.send_message(user["_id"], message_to_send)
-            count += 1
-            await asyncio.sleep(0.05)
-        except Exception as e:
-            if "PEER_ID_INVALID" in str(e) or "USER_IS_BLOCKED" in str(e) or "USER_BOT" in str(e) or "USER_DEACTIVATED_REQUIRED" in str(e):
-                print(f"Skipping broadcast to invalid/blocked user {user['_id']}: {e}")
-            else:
-                print(f"Failed to broadcast to user {user['_id']}: {e}")
-    reply_msg = await msg.reply(f"{count} জন ব্যবহারকারীর কাছে ব্রডকাস্ট পাঠানো হয়েছে।")
-    asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
+    # Progress is reported by editing a message in the admin's chat
+    await broadcaster.start(message_to_send, audience="all", admin_chat_id=msg.chat.id)
+
+def trend(current, previous):
+    if not previous:
+        return ""
+    change = (current - previous) / previous * 100
+    return f" ({'↑' if change >= 0 else '↓'}{abs(change):.0f}%)"
+
+def share(counts, event):
+    return f"{counts[event] / counts['searches'] * 100:.0f}%" if counts["searches"] else "-"
+
+def traffic_line(label, current, previous):
+    return (
+        f"{label}: সার্চ {current['searches']}{trend(current['searches'], previous['searches'])}, "
+        f"সরাসরি {share(current, 'direct')}, কাছাকাছি {share(current, 'fuzzy')}, পাওয়া যায়নি {share(current, 'no_result')}\n"
+        f"  দেখা {current['watches']}{trend(current['watches'], previous['watches'])}, "
+        f"নতুন ইউজার {current['new_users']}{trend(current['new_users'], previous['new_users'])}, "
+        f"ব্রডকাস্ট {current['broadcasts']}"
+    )
 
 @app.on_message(filters.command("stats") & filters.user(ADMIN_IDS))
+@instrumented("stats")
 async def stats(_, msg: Message):
+    # Estimated collection counts and the stats rollups; nothing here scans a collection
+    buffer_stats = write_buffer.stats()
+    cache_stats = result_cache.stats()
+    entity_stats = entities.stats()
+    token_stats = callback_tokens.stats()
+    users_count, feedback_count, pending_requests, open_misses, traffic = await asyncio.gather(
+        db.users.count(),
+        db.feedback.count(),
+        db.requests.count("pending"),
+        db.missed_queries.count_open(),
+        stats_rollups.summary()
+    )
+    totals = traffic["totals"]
     stats_msg = await msg.reply(
-        f"মোট ব্যবহারকারী: {users_col.count_documents({})}\n"
-        f"মোট মুভি: {movies_col.count_documents({})}\n"
-        f"মোট ফিডব্যাক: {feedback_col.count_documents({})}\n"
-        f"মোট অনুরোধ: {requests_col.count_documents({})}"
+        f"মোট ব্যবহারকারী: {users_count}\n"
+        f"মোট মুভি: {len(catalog)}\n"
+        f"মোট ফিডব্যাক: {feedback_count}\n"
+        f"অপেক্ষমাণ অনুরোধ: {pending_requests} টি মুভি\n"
+        f"উত্তরহীন অনুসন্ধান: {open_misses}\n\n"
+        f"📈 ট্রাফিক (আগের সময়ের তুলনায়)\n"
+        f"{traffic_line('শেষ ১ ঘণ্টা', *traffic['hour'])}\n"
+        f"{traffic_line('শেষ ২৪ ঘণ্টা', *traffic['day'])}\n"
+        f"{traffic_line('শেষ ৭ দিন', *traffic['week'])}\n"
+        f"সর্বমোট: সার্চ {totals['searches']}, দেখা {totals['watches']}, ব্রডকাস্ট {totals['broadcasts']}\n\n"
+        f"রাইট বাফার: {buffer_stats['pending']} অপেক্ষমাণ, শেষ ব্যাচ {buffer_stats['last_batch_size']} "
+        f"(সর্বোচ্চ {buffer_stats['max_batch_size']}), ফ্লাশ ল্যাগ {buffer_stats['last_flush_lag']:.1f}s, বাদ {buffer_stats['dropped']}\n"
+        f"রেজাল্ট ক্যাশ: {cache_stats['size']} এন্ট্রি, হিট {cache_stats['hits']}, মিস {cache_stats['misses']}, "
+        f"এভিকশন {cache_stats['evictions']}, ইনভ্যালিডেশন {cache_stats['invalidations']}\n"
+        f"এনটিটি ক্যাশ: মুভি {entity_stats['movies']['size']} (হিট {entity_stats['movies']['hits']}, মিস {entity_stats['movies']['misses']}), "
+        f"ইউজার {entity_stats['users']['size']} (হিট {entity_stats['users']['hits']}, মিস {entity_stats['users']['misses']})\n"
+        f"কলব্যাক টোকেন: {token_stats['size']} টি, মেয়াদোত্তীর্ণ {token_stats['expired']}\n"
+        f"রেট লিমিট: {sum(update_limiter.dropped.values())} আপডেট বাদ দেওয়া হয়েছে"
     )
-    asyncio.create_task(delete_message_later(stats_msg.chat.id, stats_msg.id))
+    delete_message_later(stats_msg.chat.id, stats_msg.id)
 
 @app.on_message(filters.command("notify") & filters.user(ADMIN_IDS))
+@instrumented("notify_command")
 async def notify_command(_, msg: Message):
     if len(msg.command) != 2 or msg.command[1] not in ["on", "off"]:
         error_msg = await msg.reply("ব্যবহার: /notify on অথবা /notify off")
-        asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+        delete_message_later(error_msg.chat.id, error_msg.id)
         return
     new_value = True if msg.command[1] == "on" else False
-    settings_col.update_one(
-        {"key": "global_notify"},
-        {"$set": {"value": new_value}},
-        upsert=True
-    )
+    await db.settings.set("global_notify", new_value)
     status = "চালু" if new_value else "বন্ধ"
     reply_msg = await msg.reply(f"✅ গ্লোবাল নোটিফিকেশন {status} করা হয়েছে!")
-    asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
+    delete_message_later(reply_msg.chat.id, reply_msg.id)
 
 @app.on_message(filters.command("delete_movie") & filters.user(ADMIN_IDS))
+@instrumented("delete_specific_movie")
 async def delete_specific_movie(_, msg: Message):
     if len(msg.command) < 2:
         error_msg = await msg.reply("অনুগ্রহ করে মুভির টাইটেল দিন। ব্যবহার: `/delete_movie <মুভির টাইটেল>`")
-        asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+        delete_message_later(error_msg.chat.id, error_msg.id)
         return
 
     movie_title_to_delete = msg.text.split(None, 1)[1].strip()
 
-    movie_to_delete = movies_col.find_one({"title": {"$regex": re.escape(movie_title_to_delete), "$options": "i"}})
-
-    if not movie_to_delete:
-        cleaned_title_to_delete = clean_text(movie_title_to_delete)
-        movie_to_delete = movies_col.find_one({"title_clean": {"$regex": f"^{re.escape(cleaned_title_to_delete)}$", "$options": "i"}})
+    matches = catalog.search(movie_title_to_delete, "", limit=1)
+    message_id_to_delete = matches[0] if matches else catalog.find_exact(clean_text(movie_title_to_delete))
+    movie_to_delete = catalog.get(message_id_to_delete) if message_id_to_delete is not None else None
+    if movie_to_delete is None and tokenize(movie_title_to_delete):
+        # Not in this process's catalog (e.g. written by a reindex still running): ask Mongo
+        found = await db.movies.find_by_tokens(tokenize(movie_title_to_delete), limit=1, projection={"message_id": 1, "title": 1})
+        movie_to_delete = found[0] if found else None
 
     if movie_to_delete:
-        movies_col.delete_one({"_id": movie_to_delete["_id"]})
+        await db.movies.delete(movie_to_delete["message_id"])
+        entities.forget_movie(movie_to_delete["message_id"])
+        catalog.remove(movie_to_delete["message_id"])
+        popular_board.remove(movie_to_delete["message_id"])
+        invalidate_results(movie_to_delete["message_id"])
         reply_msg = await msg.reply(f"মুভি **{movie_to_delete['title']}** সফলভাবে ডিলিট করা হয়েছে।")
-        asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
     else:
         error_msg = await msg.reply(f"**{movie_title_to_delete}** নামের কোনো মুভি খুঁজে পাওয়া যায়নি।")
-        asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+        delete_message_later(error_msg.chat.id, error_msg.id)
+
+@app.on_message(filters.command("reindex") & filters.user(ADMIN_IDS))
+@instrumented("reindex_command")
+async def reindex_command(_, msg: Message):
+    args = msg.command[1:]
+    if args == ["stop"]:
+        await reindexer.cancel()
+        reply_msg = await msg.reply("⏹ রিইনডেক্স বন্ধ করা হয়েছে।")
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
+        return
+    if reindexer.running:
+        reply_msg = await msg.reply("একটি রিইনডেক্স ইতিমধ্যে চলছে। বন্ধ করতে /reindex stop দিন।")
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
+        return
+    if args == ["resume"]:
+        await reindexer.resume()
+        reply_msg = await msg.reply("🔄 রিইনডেক্স আবার চালু করা হয়েছে।" if reindexer.running else "চালু করার মতো কোনো রিইনডেক্স নেই।")
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
+        return
+    if not all(arg.isdigit() for arg in args) or len(args) > 2:
+        error_msg = await msg.reply("ব্যবহার: /reindex [শুরুর আইডি] [শেষ আইডি] অথবা /reindex resume | stop")
+        delete_message_later(error_msg.chat.id, error_msg.id)
+        return
+    from_id = int(args[0]) if args else 1
+    to_id = int(args[1]) if len(args) > 1 else None
+    # Progress is reported by editing a message in the admin's chat
+    await reindexer.start(admin_chat_id=msg.chat.id, from_id=from_id, to_id=to_id)
 
 @app.on_message(filters.command("delete_all_movies") & filters.user(ADMIN_IDS))
+@instrumented("delete_all_movies_command")
 async def delete_all_movies_command(_, msg: Message):
     confirmation_button = InlineKeyboardMarkup([
         [InlineKeyboardButton("হ্যাঁ, সব ডিলিট করুন", callback_data="confirm_delete_all_movies")],
         [InlineKeyboardButton("না, বাতিল করুন", callback_data="cancel_delete_all_movies")]
     ])
     reply_msg = await msg.reply("আপনি কি নিশ্চিত যে আপনি ডাটাবেস থেকে **সব মুভি** ডিলিট করতে চান? এই প্রক্রিয়াটি অপরিবর্তনীয়!", reply_markup=confirmation_button)
-    asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
-
-@app.on_callback_query(filters.regex(r"^noresult_(wrong|notyet|uploaded|coming)_(\d+)_([^ ]+)$") & filters.user(ADMIN_IDS))
+    delete_message_later(reply_msg.chat.id, reply_msg.id)
+
+# What a user is told when an admin answers their failed search
+NO_RESULT_REPLIES = {
+    "wrong": "❌ আপনি **'{query}'** নামে ভুল সার্চ করেছেন। অনুগ্রহ করে সঠিক নাম লিখে আবার চেষ্টা করুন।",
+    "notyet": "⏳ **'{query}'** মুভিটি এখনো আমাদের কাছে আসেনি। অনুগ্রহ করে কিছু সময় পর আবার চেষ্টা করুন।",
+    "uploaded": "📤 **'{query}'** মুভিটি ইতিমধ্যে আপলোড করা হয়েছে। সঠিক নামে আবার সার্চ করুন।",
+    "coming": "🚀 **'{query}'** মুভিটি খুব শিগগিরই আমাদের চ্যানেলে আসবে। অনুগ্রহ করে অপেক্ষা করুন."
+}
+
+@app.on_callback_query(filters.regex(r"^noresult_(wrong|notyet|uploaded|coming)_(\S+)$") & filters.user(ADMIN_IDS))
+@instrumented("handle_admin_reply")
 async def handle_admin_reply(_, cq: CallbackQuery):
+    # Per-search buttons from before the no-result digest, still in admin chats:
+    # noresult_{reason}_{user_id}_{quoted query}
     parts = cq.data.split("_", 3)
+    if len(parts) != 4 or not parts[2].isdigit():
+        await cq.answer("এই বাটনের মেয়াদ শেষ হয়ে গেছে।", show_alert=True)
+        return
     reason = parts[1]
     user_id = int(parts[2])
-    encoded_query = parts[3]
-    original_query = urllib.parse.unquote_plus(encoded_query)
+    original_query = urllib.parse.unquote_plus(parts[3])
 
-    messages = {
-        "wrong": f"❌ আপনি **'{original_query}'** নামে ভুল সার্চ করেছেন। অনুগ্রহ করে সঠিক নাম লিখে আবার চেষ্টা করুন।",
-        "notyet": f"⏳ **'{original_query}'** মুভিটি এখনো আমাদের কাছে আসেনি। অনুগ্রহ করে কিছু সময় পর আবার চেষ্টা করুন।",
-        "uploaded": f"📤 **'{original_query}'** মুভিটি ইতিমধ্যে আপলোড করা হয়েছে। সঠিক নামে আবার সার্চ করুন।",
-        "coming": f"🚀 **'{original_query}'** মুভিটি খুব শিগগিরই আমাদের চ্যানেলে আসবে। অনুগ্রহ করে অপেক্ষা করুন."
-    }
+    reply = NO_RESULT_REPLIES[reason].format(query=original_query)
 
     try:
-        m_sent = await app.send_message(user_id, messages[reason])
-        asyncio.create_task(delete_message_later(m_sent.chat.id, m_sent.id))
+        m_sent = await app.send_message(user_id, reply)
+        delete_message_later(m_sent.chat.id, m_sent.id)
         await cq.answer("ব্যবহারকারীকে জানানো হয়েছে ✅", show_alert=True)
         await cq.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup([[
-            InlineKeyboardButton(f"✅ উত্তর দেওয়া হয়েছে: {messages[reason].split(' ')[0]}", callback_data="noop")
+            InlineKeyboardButton(f"✅ উত্তর দেওয়া হয়েছে: {reply.split(' ')[0]}", callback_data="noop")
         ]]))
     except Exception as e:
         await cq.answer("ব্যবহারকারীকে মেসেজ পাঠানো যায়নি ❌", show_alert=True)
         print(f"Error sending admin reply to user {user_id}: {e}")
 
+@app.on_callback_query(filters.regex(r"^digest_(wrong|notyet|uploaded|coming)_(\S+)$") & filters.user(ADMIN_IDS))
+@instrumented("handle_digest_reply")
+async def handle_digest_reply(_, cq: CallbackQuery):
+    _, reason, token = cq.data.split("_", 2)
+    payload = await callback_tokens.get(token)
+    if payload is None:
+        await cq.answer("এই বাটনের মেয়াদ শেষ হয়ে গেছে।", show_alert=True)
+        return
+    doc = await db.missed_queries.resolve(payload["key"], reason)
+    if doc is None:
+        await cq.answer("এই অনুসন্ধানের উত্তর আগেই দেওয়া হয়েছে।", show_alert=True)
+        return
+
+    users = doc.get("users", [])
+    if users:
+        # Every user who hit this query gets the reply, paced by the broadcast engine
+        await broadcaster.start(
+            NO_RESULT_REPLIES[reason].format(query=doc["query"]),
+            audience={"user_ids": users},
+            auto_delete=True
+        )
+    await cq.answer(f"{len(users)} জন ব্যবহারকারীকে জানানো হচ্ছে ✅", show_alert=True)
+
+    # Only this query's row changes; the rest of the digest stays answerable
+    rows = [
+        [InlineKeyboardButton(f"✅ {NO_RESULT_REPLIES[reason].split(' ')[0]} {len(users)} জন", callback_data="noop")]
+        if any(button.callback_data and button.callback_data.endswith(f"_{token}") for button in row) else row
+        for row in cq.message.reply_markup.inline_keyboard
+    ]
+    await cq.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(rows))
+
 @app.on_message(filters.command("popular") & (filters.private | filters.group))
+@instrumented("popular_movies")
 async def popular_movies(_, msg: Message):
-    popular_movies_list = list(movies_col.find(
-        {"views_count": {"$exists": True}}
-    ).sort("views_count", -1).limit(RESULTS_COUNT))
-
-    if popular_movies_list:
-        buttons = []
-        for movie in popular_movies_list:
-            if "title" in movie and "message_id" in movie:
-                # Check if movie is favorited for the popular list
-                user_id = msg.from_user.id
-                user_data = users_col.find_one({"_id": user_id})
-                is_favorited = movie["message_id"] in user_data.get("favorite_movies", []) if user_data else False
-                favorite_button_text = "❌ ফেভারিট থেকে সরান" if is_favorited else "⭐ ফেভারিটে যোগ করুন"
-                favorite_callback_data = f"toggle_favorite_{movie['message_id']}"
+    window = msg.command[1].lower() if len(msg.command) > 1 and msg.command[1].lower() in POPULAR_WINDOWS else "all"
 
-                buttons.append([
-                    InlineKeyboardButton(
-                        text=f"{movie['title'][:40]} ({movie.get('views_count', 0)} ভিউ)",
-                        url=f"https://t.me/{app.me.username}?start=watch_{movie['message_id']}"
-                    )
-                ])
-                buttons.append([
-                    InlineKeyboardButton(favorite_button_text, callback_data=favorite_callback_data)
-                ])
+    # Read the user's favorites once for the whole page
+    reply_markup = None
+    if popular_board.top(window, 1):
+        reply_markup = popular_keyboard(window, set(await entities.favorites(msg.from_user.id)))
 
-
-        reply_markup = InlineKeyboardMarkup(buttons)
+    if reply_markup:
         m = await msg.reply_text(
-            "🔥 বর্তমানে সবচেয়ে জনপ্রিয় মুভিগুলো:\n\n",
+            f"🔥 {POPULAR_WINDOWS[window]} সবচেয়ে জনপ্রিয় মুভিগুলো:\n\n",
             reply_markup=reply_markup,
             quote=True
         )
-        asyncio.create_task(delete_message_later(m.chat.id, m.id))
+        delete_message_later(m.chat.id, m.id)
     else:
         m = await msg.reply_text("দুঃখিত, বর্তমানে কোনো জনপ্রিয় মুভি পাওয়া যায়নি।", quote=True)
-        asyncio.create_task(delete_message_later(m.chat.id, m.id))
+        delete_message_later(m.chat.id, m.id)
+
+# Answer to the requester, per RequestsRepo.add status
+REQUEST_REPLIES = {
+    "new": "আপনার অনুরোধ **'{name}'** সফলভাবে জমা দেওয়া হয়েছে। এডমিনরা এটি পর্যালোচনা করবেন।",
+    "joined": "**'{name}'** মুভিটির জন্য আরও অনুরোধ আছে ({waiting} জন)। আপলোড হলেই আপনাকে জানানো হবে।",
+    "duplicate": "আপনি আগেই **'{name}'** অনুরোধ করেছেন। আপলোড হলেই আপনাকে জানানো হবে।"
+}
+
+# What requesters are told when an admin closes their request
+REQUEST_CLOSED_REPLIES = {
+    "fulfilled": "✅ আপনার অনুরোধ করা মুভি **'{name}'** আপলোড করা হয়েছে। এখনই সার্চ করে দেখুন!",
+    "rejected": "❌ দুঃখিত, আপনার অনুরোধ করা মুভি **'{name}'** এই মুহূর্তে যোগ করা সম্ভব নয়।"
+}
+
+async def submit_request(user_id, username, movie_name):
+    # Admins hear about a title once, from its first requester; later requesters only join it
+    key, tokens = request_key(movie_name)
+    status, waiting = await db.requests.add(key, tokens, user_id, username, movie_name)
+    if status != "new":
+        return status, waiting
+
+    token = await callback_tokens.put({"key": key}, key=("request", key), ttl=CALLBACK_ADMIN_TOKEN_TTL)
+    admin_request_btns = InlineKeyboardMarkup([[
+        InlineKeyboardButton("✅ সম্পন্ন হয়েছে", callback_data=f"req_fulfilled_{token}"),
+        InlineKeyboardButton("❌ বাতিল করা হয়েছে", callback_data=f"req_rejected_{token}")
+    ]])
+    for admin_id in ADMIN_IDS:
+        try:
+            await app.send_message(
+                admin_id,
+                f"❗ *নতুন মুভির অনুরোধ!*\n\n"
+                f"🎬 মুভির নাম: `{movie_name}`\n"
+                f"👤 ইউজার: [{username}](tg://user?id={user_id}) (`{user_id}`)\n"
+                f"পরের অনুরোধগুলো এর সাথে যোগ হবে; আপলোড হলে সবাইকে জানানো হবে।",
+                reply_markup=admin_request_btns,
+                disable_web_page_preview=True
+            )
+        except Exception as e:
+            print(f"Could not notify admin {admin_id} about request: {e}")
+    return status, waiting
+
+@app.on_callback_query(filters.regex(r"^req_(fulfilled|rejected)_(\S+)$") & filters.user(ADMIN_IDS))
+@instrumented("handle_request_reply")
+async def handle_request_reply(_, cq: CallbackQuery):
+    _, status, rest = cq.data.split("_", 2)
+    user_id, _, name = rest.partition("_")
+    if name and user_id.isdigit():
+        # Buttons sent before callback tokens: req_{status}_{user_id}_{quoted name}
+        key, _ = request_key(urllib.parse.unquote_plus(name))
+    else:
+        payload = await callback_tokens.get(rest)
+        if payload is None:
+            await cq.answer("এই বাটনের মেয়াদ শেষ হয়ে গেছে।", show_alert=True)
+            return
+        key = payload["key"]
+
+    request = await db.requests.close({"key": key}, status, closed_by=cq.from_user.id)
+    if request is None:
+        await cq.answer("এই অনুরোধটি আগেই বন্ধ করা হয়েছে।", show_alert=True)
+        return
+    users = request.get("requesters", [])
+    if users:
+        await broadcaster.start(
+            REQUEST_CLOSED_REPLIES[status].format(name=request["movie_name"]),
+            audience={"user_ids": users},
+            auto_delete=True
+        )
+    await cq.answer(f"{len(users)} জন ব্যবহারকারীকে জানানো হচ্ছে ✅", show_alert=True)
+    await cq.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup([[
+        InlineKeyboardButton(f"{REQUEST_CLOSED_REPLIES[status].split(' ')[0]} {len(users)} জন", callback_data="noop")
+    ]]))
 
 @app.on_message(filters.command("request") & filters.private)
+@instrumented("request_movie")
 async def request_movie(_, msg: Message):
     if len(msg.command) < 2:
         error_msg = await msg.reply("অনুগ্রহ করে /request এর পর মুভির নাম লিখুন। উদাহরণ: `/request The Creator`", quote=True)
-        asyncio.create_task(delete_message_later(error_msg.chat.id, error_msg.id))
+        delete_message_later(error_msg.chat.id, error_msg.id)
         return
 
     movie_name = msg.text.split(None, 1)[1].strip()
     user_id = msg.from_user.id
     username = msg.from_user.username or msg.from_user.first_name
 
-    requests_col.insert_one({
-        "user_id": user_id,
-        "username": username,
-        "movie_name": movie_name,
-        "request_time": datetime.now(UTC),
-        "status": "pending"
-    })
-
-    m = await msg.reply(f"আপনার অনুরোধ **'{movie_name}'** সফলভাবে জমা দেওয়া হয়েছে। এডমিনরা এটি পর্যালোচনা করবেন।", quote=True)
-    asyncio.create_task(delete_message_later(m.chat.id, m.id))
-
-    encoded_movie_name = urllib.parse.quote_plus(movie_name)
-    admin_request_btns = InlineKeyboardMarkup([[
-        InlineKeyboardButton("✅ সম্পন্ন হয়েছে", callback_data=f"req_fulfilled_{user_id}_{encoded_movie_name}"),
-        InlineKeyboardButton("❌ বাতিল করা হয়েছে", callback_data=f"req_rejected_{user_id}_{encoded_movie_name}")
-    ]])
+    status, waiting = await submit_request(user_id, username, movie_name)
 
-    for admin_id in ADMIN_IDS:
-        try:
-            await app.send_message(
-                admin_id,
-                f"❗ *নতুন মুভির অনুরোধ (ইনলাইন বাটন থেকে)!*\n\n"
-                f"🎬 মুভির নাম: `{movie_name}`\n"
-                f"👤 ইউজার: [{username}](tg://user?id={user_id}) (`{user_id}`)",
-                reply_markup=admin_request_btns,
-                disable_web_page_preview=True
-            )
-        except Exception as e:
-            print(f"Could not notify admin {admin_id} about request from callback: {e}")
+    m = await msg.reply(REQUEST_REPLIES[status].format(name=movie_name, waiting=waiting), quote=True)
+    delete_message_later(m.chat.id, m.id)
 
 @app.on_message(filters.command("favorites") & filters.private)
+@instrumented("view_favorites")
 async def view_favorites(_, msg: Message):
     user_id = msg.from_user.id
-    user_data = users_col.find_one({"_id": user_id})
+    favorite_movie_ids = await entities.favorites(user_id)
 
-    if not user_data or not user_data.get("favorite_movies"):
+    if not favorite_movie_ids:
         m = await msg.reply_text("আপনার ফেভারিট তালিকায় কোনো মুভি নেই।", quote=True)
-        asyncio.create_task(delete_message_later(m.chat.id, m.id))
+        delete_message_later(m.chat.id, m.id)
         return
 
-    favorite_movie_ids = user_data["favorite_movies"]
-
-    # Fetch movie details from movies_col for the favorited IDs
-    favorited_movies_data = list(movies_col.find(
-        {"message_id": {"$in": favorite_movie_ids}}
-    ))
+    # Only the page being shown is rendered, from the in-memory catalog
+    reply_markup = favorites_keyboard(favorite_movie_ids)
 
-    if not favorited_movies_data:
+    if not reply_markup:
         m = await msg.reply_text("আপনার ফেভারিট তালিকায় থাকা কোনো মুভি খুঁজে পাওয়া যায়নি।", quote=True)
-        asyncio.create_task(delete_message_later(m.chat.id, m.id))
+        delete_message_later(m.chat.id, m.id)
         return
 
-    buttons = []
-    for movie in favorited_movies_data:
-        buttons.append([
-            InlineKeyboardButton(
-                text=f"{movie['title'][:40]} ({movie.get('views_count', 0)} ভিউ)",
-                url=f"https://t.me/{app.me.username}?start=watch_{movie['message_id']}"
-            )
-        ])
-        buttons.append([
-            InlineKeyboardButton(f"❌ '{movie['title'][:20]}...' ফেভারিট থেকে সরান", callback_data=f"toggle_favorite_{movie['message_id']}")
-        ])
-
     m = await msg.reply_text(
         "❤️ আপনার ফেভারিট মুভিগুলো:",
-        reply_markup=InlineKeyboardMarkup(buttons),
+        reply_markup=reply_markup,
         quote=True
     )
-    asyncio.create_task(delete_message_later(m.chat.id, m.id))
+    delete_message_later(m.chat.id, m.id)
 
 
 @app.on_message(filters.text & (filters.group | filters.private))
+@instrumented("search")
 async def search(_, msg: Message):
     query = msg.text.strip()
     if not query:
         return
 
-    if msg.chat.type == "group":
+    query_clean = clean_text(query)
+
+    if msg.chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
         if len(query) < 3:
             return
-        if msg.reply_to_message or msg.from_user.is_bot:
+        if msg.reply_to_message or not msg.from_user or msg.from_user.is_bot:
+            return
+        # Nothing in a searchable script (Latin, Bengali, Devanagari)
+        if not query_clean:
+            return
+        # Chatter that can't match any title costs no Mongo or Telegram calls
+        if not catalog.plausible(query, query_clean):
+            GROUP_MESSAGES_SKIPPED.inc(reason="no_match")
             return
-        if not re.search(r'[a-zA-Z0-9]', query):
+        if msg.from_user.id not in ADMIN_IDS and update_limiter.check("message", msg.from_user.id, msg.chat.id):
             return
 
     user_id = msg.from_user.id
-    users_col.update_one(
-        {"_id": user_id},
-        {"$set": {"last_query": query}, "$setOnInsert": {"joined": datetime.now(UTC), "favorite_movies": []}}, # favorite_movies যোগ করা হয়েছে
-        upsert=True
-    )
-
-    loading_message = await msg.reply("🔎 লোড হচ্ছে, অনুগ্রহ করে অপেক্ষা করুন...", quote=True)
-    asyncio.create_task(delete_message_later(loading_message.chat.id, loading_message.id))
-
-    query_clean = clean_text(query)
-
-    matched_movies_direct = list(movies_col.find(
-        {"$or": [
-            {"title_clean": {"$regex": f"^{re.escape(query_clean)}", "$options": "i"}},
-            {"title": {"$regex": re.escape(query), "$options": "i"}}
-        ]}
-    ).limit(RESULTS_COUNT))
-
-    if matched_movies_direct:
+    write_buffer.touch_user(user_id, query)
+
+    query_key = normalize_query(query)
+    cache_key = (query_key, None, SEARCH_DEPTH)
+    result = result_cache.get(cache_key)
+    if result is None:
+        loading_message = await msg.reply("🔎 লোড হচ্ছে, অনুগ্রহ করে অপেক্ষা করুন...", quote=True)
+        delete_message_later(loading_message.chat.id, loading_message.id)
+        result = await lookup_movies(query_key, query_clean)
+        result_cache.set(cache_key, result)
         await loading_message.delete()
-        buttons = []
-        for movie in matched_movies_direct:
-            buttons.append([
-                InlineKeyboardButton(
-                    text=f"{movie['title'][:40]} ({movie.get('views_count', 0)} ভিউ)",
-                    url=f"https://t.me/{app.me.username}?start=watch_{movie['message_id']}"
-                )
-            ])
-            # সার্চ রেজাল্ট থেকে ফেভারিট বাটন সরানো হয়েছে
-            # buttons.append([
-            #     InlineKeyboardButton(favorite_button_text, callback_data=favorite_callback_data)
-            # ])
-
-        m = await msg.reply("🎬 নিচের রেজাল্টগুলো পাওয়া গেছে:", reply_markup=InlineKeyboardMarkup(buttons), quote=True)
-        asyncio.create_task(delete_message_later(m.chat.id, m.id))
-        return
-
-    all_movie_data_cursor = movies_col.find(
-        {"title_clean": {"$regex": query_clean, "$options": "i"}},
-        {"title_clean": 1, "original_title": "$title", "message_id": 1, "language": 1, "views_count": 1}
-    ).limit(100)
-
-    all_movie_data = list(all_movie_data_cursor)
-
-    corrected_suggestions = await asyncio.get_event_loop().run_in_executor(
-        thread_pool_executor,
-        find_corrected_matches,
-        query_clean,
-        all_movie_data,
-        70,
-        RESULTS_COUNT
-    )
 
-    await loading_message.delete()
+    kind, ranked = result
+    write_buffer.count("searches")
+    write_buffer.count("no_result" if kind == "none" else kind)
 
-    if corrected_suggestions:
-        buttons = []
-        for movie in corrected_suggestions:
-            buttons.append([
-                InlineKeyboardButton(
-                    text=f"{movie['title'][:40]} ({movie.get('views_count', 0)} ভিউ)",
-                    url=f"https://t.me/{app.me.username}?start=watch_{movie['message_id']}"
-                )
-            ])
-            # ফাজি সার্চ রেজাল্ট থেকেও ফেভারিট বাটন সরানো হয়েছে
-            # buttons.append([
-            #     InlineKeyboardButton(favorite_button_text, callback_data=favorite_callback_data)
-            # ])
-
-        lang_buttons = [
-            InlineKeyboardButton("বেঙ্গলি", callback_data=f"lang_Bengali_{query_clean}"),
-            InlineKeyboardButton("হিন্দি", callback_data=f"lang_Hindi_{query_clean}"),
-            InlineKeyboardButton("ইংলিশ", callback_data=f"lang_English_{query_clean}")
-        ]
-        buttons.append(lang_buttons)
+    if kind == "direct":
+        token = await results_token(query_key, kind, ranked)
+        with SEARCH_STAGE_LATENCY.time(stage="reply"):
+            m = await msg.reply("🎬 নিচের রেজাল্টগুলো পাওয়া গেছে:", reply_markup=search_keyboard(kind, ranked, token), quote=True)
+        delete_message_later(m.chat.id, m.id)
+        return
 
-        m = await msg.reply("🔍 সরাসরি মিলে যায়নি, তবে কাছাকাছি কিছু পাওয়া গেছে:", reply_markup=InlineKeyboardMarkup(buttons), quote=True)
-        asyncio.create_task(delete_message_later(m.chat.id, m.id))
+    if kind == "fuzzy":
+        token = await results_token(query_key, kind, ranked)
+        with SEARCH_STAGE_LATENCY.time(stage="reply"):
+            m = await msg.reply("🔍 সরাসরি মিলে যায়নি, তবে কাছাকাছি কিছু পাওয়া গেছে:", reply_markup=search_keyboard(kind, ranked, token), quote=True)
+        delete_message_later(m.chat.id, m.id)
     else:
         Google_Search_url = "https://www.google.com/search?q=" + urllib.parse.quote(query)
 
-        request_button = InlineKeyboardButton("এই মুভির জন্য অনুরোধ করুন", callback_data=f"request_movie_{user_id}_{urllib.parse.quote_plus(query)}")
+        token = await callback_tokens.put({"user_id": user_id, "query": query}, key=("noresult", user_id, query_key))
+        request_button = InlineKeyboardButton("এই মুভির জন্য অনুরোধ করুন", callback_data=f"request_movie_{token}")
         google_button_row = [InlineKeyboardButton("গুগলে সার্চ করুন", url=Google_Search_url)]
 
         reply_markup_for_no_result = InlineKeyboardMarkup([
@@ -585,166 +910,183 @@ async def search(_, msg: Message):
             reply_markup=reply_markup_for_no_result,
             quote=True
         )
-        asyncio.create_task(delete_message_later(alert.chat.id, alert.id))
-
-        encoded_query = urllib.parse.quote_plus(query)
-        admin_btns = InlineKeyboardMarkup([[
-            InlineKeyboardButton("❌ ভুল নাম", callback_data=f"noresult_wrong_{user_id}_{encoded_query}"),
-            InlineKeyboardButton("⏳ এখনো আসেনি", callback_data=f"noresult_notyet_{user_id}_{encoded_query}")
-        ], [
-            InlineKeyboardButton("📤 আপলোড আছে", callback_data=f"noresult_uploaded_{user_id}_{encoded_query}"),
-            InlineKeyboardButton("🚀 শিগগির আসবে", callback_data=f"noresult_coming_{user_id}_{encoded_query}")
-        ]])
-
-        for admin_id in ADMIN_IDS:
-            try:
-                await app.send_message(
-                    admin_id,
-                    f"❗ *নতুন মুভি খোঁজা হয়েছে কিন্তু পাওয়া যায়নি!*\n\n"
-                    f"🔍 অনুসন্ধান: `{query}`\n"
-                    f"👤 ইউজার: [{msg.from_user.first_name}](tg://user?id={user_id}) (`{user_id}`)",
-                    reply_markup=admin_btns,
-                    disable_web_page_preview=True
-                )
-            except Exception as e:
-                print(f"Could not notify admin {admin_id}: {e}")
+        delete_message_later(alert.chat.id, alert.id)
+
+        # Admins see it in the next no-result digest, merged with everyone else who searched it
+        write_buffer.record_miss(query_key, query, user_id)
+
+def inline_article(message_id):
+    movie = catalog.get(message_id)
+    title = movie["title"].strip().split("\n", 1)[0]
+    watch_url = f"https://t.me/{app.me.username}?start=watch_{message_id}"
+    return InlineQueryResultArticle(
+        title=title[:64],
+        description=f"{popular_board.views(message_id)} ভিউ",
+        input_message_content=InputTextMessageContent(f"🎬 **{title[:100]}**"),
+        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("▶️ মুভিটি দেখুন", url=watch_url)]]),
+        id=str(message_id)
+    )
+
+# @bot <title> from any chat. Answered from the catalog and result cache only; the
+# chosen result links to the watch_ flow in /start. next_offset carries the keyset
+# cursor "score:message_id" of the last result.
+@app.on_inline_query()
+@instrumented("inline_search")
+async def inline_search(_, iq: InlineQuery):
+    # Each keystroke is an inline query; charge it before any search work
+    if iq.from_user.id not in ADMIN_IDS and update_limiter.check("inline", iq.from_user.id):
+        return
+    query_key = normalize_query(iq.query)
+    if query_key:
+        _, ranked = await cached_results(query_key)
+    else:
+        # Empty query: what's popular this week
+        ranked = popular_board.top("week", popular_board.capacity)
+    ranked = [pair for pair in ranked if pair[0] in catalog]
+
+    # A malformed offset (it comes from the client) starts from the first page
+    after = None
+    if iq.offset:
+        try:
+            score, message_id = iq.offset.split(":")
+            after = (-int(score), int(message_id))
+        except ValueError:
+            after = None
+    page, _, has_next = keyset_page(ranked, score_key, INLINE_RESULTS, after)
+
+    await iq.answer(
+        [inline_article(message_id) for message_id, _ in page],
+        cache_time=INLINE_CACHE_TIME,
+        next_offset=f"{page[-1][1]}:{page[-1][0]}" if page and has_next else ""
+    )
 
 @app.on_callback_query()
+@instrumented("callback_handler")
 async def callback_handler(_, cq: CallbackQuery):
     data = cq.data
 
     if data == "confirm_delete_all_movies":
-        movies_col.delete_many({})
+        await db.movies.delete_all()
+        entities.clear_movies()
+        catalog.clear()
+        popular_board.clear()
+        result_cache.clear()
         reply_msg = await cq.message.edit_text("✅ ডাটাবেস থেকে সব মুভি সফলভাবে ডিলিট করা হয়েছে।")
-        asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
         await cq.answer("সব মুভি ডিলিট করা হয়েছে।")
     elif data == "cancel_delete_all_movies":
         reply_msg = await cq.message.edit_text("❌ সব মুভি ডিলিট করার প্রক্রিয়া বাতিল করা হয়েছে।")
-        asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
+        delete_message_later(reply_msg.chat.id, reply_msg.id)
         await cq.answer("বাতিল করা হয়েছে।")
 
     elif data.startswith("movie_"):
         await cq.answer("মুভিটি ফরওয়ার্ড করার জন্য আমাকে ব্যক্তিগতভাবে মেসেজ করুন।", show_alert=True)
 
     elif data.startswith("lang_"):
-        _, lang, query_clean = data.split("_", 2)
-
-        potential_lang_matches_cursor = movies_col.find(
-            {"language": lang, "title_clean": {"$regex": query_clean, "$options": "i"}},
-            {"title": 1, "message_id": 1, "title_clean": 1, "views_count": 1}
-        ).limit(50)
-
-        potential_lang_matches = list(potential_lang_matches_cursor)
-
-        fuzzy_data_for_matching_lang = [
-            {"title_clean": m["title_clean"], "original_title": m["title"], "message_id": m["message_id"],
-             "language": lang, "views_count": m.get("views_count", 0)}
-            for m in potential_lang_matches
-        ]
-
-        loop = asyncio.get_running_loop()
-        matches_filtered_by_lang = await loop.run_in_executor(
-            thread_pool_executor,
-            find_corrected_matches,
-            query_clean,
-            fuzzy_data_for_matching_lang,
-            70,
-            RESULTS_COUNT
-        )
-
-        if matches_filtered_by_lang:
-            buttons = []
-            # ভাষাভিত্তিক সার্চ রেজাল্ট থেকেও ফেভারিট বাটন সরানো হয়েছে
-            # user_id = cq.from_user.id
-            # user_data = users_col.find_one({"_id": user_id})
-            # user_favorite_movies = user_data.get("favorite_movies", []) if user_data else []
-
-            for m in matches_filtered_by_lang[:RESULTS_COUNT]:
-                # is_favorited = m["message_id"] in user_favorite_movies
-                # favorite_button_text = "❌ ফেভারিট থেকে সরান" if is_favorited else "⭐ ফেভারিটে যোগ করুন"
-                # favorite_callback_data = f"toggle_favorite_{m['message_id']}"
+        _, lang, token = data.split("_", 2)
+        payload = await callback_tokens.get(token)
+        if payload is None:
+            await cq.answer("এই বাটনের মেয়াদ শেষ হয়ে গেছে, আবার সার্চ করুন।", show_alert=True)
+            return
 
-                buttons.append([InlineKeyboardButton(f"{m['title'][:40]} ({m.get('views_count',0)} ভিউ)", url=f"https://t.me/{app.me.username}?start=watch_{m['message_id']}")])
-                # buttons.append([InlineKeyboardButton(favorite_button_text, callback_data=favorite_callback_data)])
+        # Re-rank the candidates search() already found; only if none of them is
+        # in this language does the fuzzy index get asked again (in memory)
+        ranked = [pair for pair in payload["ranked"] if (catalog.get(pair[0]) or {}).get("language") == lang]
+        if not ranked:
+            ranked = await score_fuzzy(clean_text(payload["query"]), 70, SEARCH_DEPTH, lang)
+        if ranked:
+            lang_token = await results_token(payload["query"], "fuzzy", ranked, lang)
             reply_msg = await cq.message.edit_text(
                 f"ফলাফল ({lang}) - নিচের থেকে সিলেক্ট করুন:",
-                reply_markup=InlineKeyboardMarkup(buttons)
+                reply_markup=search_keyboard("fuzzy", ranked, lang_token, lang)
             )
-            asyncio.create_task(delete_message_later(reply_msg.chat.id, reply_msg.id))
+            delete_message_later(reply_msg.chat.id, reply_msg.id)
         else:
             await cq.answer("এই ভাষায় কিছু পাওয়া যায়নি।", show_alert=True)
         await cq.answer()
 
+    elif data.startswith("sp_"):
+        # Search result pages: sp_{n|p}_{score}_{message_id}_{token}
+        _, direction, score, message_id, token = data.split("_", 4)
+        payload = await callback_tokens.get(token)
+        if payload is None:
+            await cq.answer("এই বাটনের মেয়াদ শেষ হয়ে গেছে, আবার সার্চ করুন।", show_alert=True)
+            return
+        cursor = (-int(score), int(message_id))
+        await cq.message.edit_reply_markup(search_keyboard(
+            payload["kind"], payload["ranked"], token, payload["language"],
+            after=cursor if direction == "n" else None,
+            before=cursor if direction == "p" else None
+        ))
+        await cq.answer()
+
+    elif data.startswith("pp_"):
+        # /popular pages: pp_{n|p}_{window}_{views}_{message_id}
+        _, direction, window, views, message_id = data.split("_")
+        cursor = (-int(views), int(message_id))
+        reply_markup = popular_keyboard(
+            window, set(await entities.favorites(cq.from_user.id)),
+            after=cursor if direction == "n" else None,
+            before=cursor if direction == "p" else None
+        )
+        if reply_markup:
+            await cq.message.edit_reply_markup(reply_markup)
+        await cq.answer()
+
+    elif data.startswith("fp_"):
+        # /favorites pages: fp_{n|p}_{message_id}
+        _, direction, message_id = data.split("_")
+        cursor = -int(message_id)
+        reply_markup = favorites_keyboard(
+            await entities.favorites(cq.from_user.id),
+            after=cursor if direction == "n" else None,
+            before=cursor if direction == "p" else None
+        )
+        if reply_markup:
+            await cq.message.edit_reply_markup(reply_markup)
+        await cq.answer()
+
     elif data.startswith("request_movie_"):
-        _, user_id_str, encoded_movie_name = data.split("_", 2)
-        user_id = int(user_id_str)
-        movie_name = urllib.parse.unquote_plus(encoded_movie_name)
+        payload = await callback_tokens.get(data[len("request_movie_"):])
+        if payload is None:
+            await cq.answer("এই বাটনের মেয়াদ শেষ হয়ে গেছে, আবার সার্চ করুন।", show_alert=True)
+            return
+        user_id = payload["user_id"]
+        movie_name = payload["query"]
         username = cq.from_user.username or cq.from_user.first_name
 
-        requests_col.insert_one({
-            "user_id": user_id,
-            "username": username,
-            "movie_name": movie_name,
-            "request_time": datetime.now(UTC),
-            "status": "pending"
-        })
-
-        await cq.answer(f"আপনার অনুরোধ '{movie_name}' সফলভাবে জমা দেওয়া হয়েছে।", show_alert=True)
-
-        admin_request_btns = InlineKeyboardMarkup([[
-            InlineKeyboardButton("✅ সম্পন্ন হয়েছে", callback_data=f"req_fulfilled_{user_id}_{encoded_movie_name}"),
-            InlineKeyboardButton("❌ বাতিল করা হয়েছে", callback_data=f"req_rejected_{user_id}_{encoded_movie_name}")
-        ]])
-
-        for admin_id in ADMIN_IDS:
-            try:
-                await app.send_message(
-                    admin_id,
-                    f"❗ *নতুন মুভির অনুরোধ (ইনলাইন বাটন থেকে)!*\n\n"
-                    f"🎬 মুভির নাম: `{movie_name}`\n"
-                    f"👤 ইউজার: [{username}](tg://user?id={user_id}) (`{user_id}`)",
-                    reply_markup=admin_request_btns,
-                    disable_web_page_preview=True
-                )
-            except Exception as e:
-                print(f"Could not notify admin {admin_id} about request from callback: {e}")
+        status, waiting = await submit_request(user_id, username, movie_name)
+        await cq.answer(REQUEST_REPLIES[status].format(name=movie_name, waiting=waiting).replace("**", ""), show_alert=True)
 
         try:
             edited_msg = await cq.message.edit_text(
-                f"❌ দুঃখিত! আপনার খোঁজা মুভিটি খুঁজে পাওয়া যায়নি।\n\n"
-                f"আপনার অনুরোধ **'{movie_name}'** জমা দেওয়া হয়েছে। এডমিনরা এটি পর্যালোচনা করবেন।",
+                "❌ দুঃখিত! আপনার খোঁজা মুভিটি খুঁজে পাওয়া যায়নি।\n\n"
+                + REQUEST_REPLIES[status].format(name=movie_name, waiting=waiting),
                 reply_markup=None
             )
-            asyncio.create_task(delete_message_later(edited_msg.chat.id, edited_msg.id))
+            delete_message_later(edited_msg.chat.id, edited_msg.id)
         except Exception as e:
             print(f"Error editing user message after request: {e}")
 
     elif data.startswith("like_") or data.startswith("dislike_"):
-        action, message_id_str, user_id_str = data.split("_", 2)
+        # The voter is whoever pressed the button; older buttons also carried a user id,
+        # which is ignored
+        action, message_id_str = data.split("_")[:2]
         movie_message_id = int(message_id_str)
-        user_id = int(user_id_str)
-
-        movie = movies_col.find_one({"message_id": movie_message_id})
+        user_id = cq.from_user.id
 
-        if not movie:
+        try:
+            counts = await db.ratings.vote(movie_message_id, user_id, action)
+        except LookupError:
             await cq.answer("দুঃখিত, এই মুভিটি খুঁজে পাওয়া যায়নি।", show_alert=True)
             return
 
-        if user_id in movie.get("rated_by", []):
+        if counts is None:
             await cq.answer("আপনি ইতিমধ্যেই এই মুভিতে রেটিং দিয়েছেন!", show_alert=True)
             return
 
-        update_query = {"$inc": {}, "$push": {"rated_by": user_id}}
-        if action == "like":
-            update_query["$inc"]["likes"] = 1
-        elif action == "dislike":
-            update_query["$inc"]["dislikes"] = 1
-
-        movies_col.update_one({"message_id": movie_message_id}, update_query)
-
-        updated_movie = movies_col.find_one({"message_id": movie_message_id})
-        updated_likes = updated_movie.get('likes', 0)
-        updated_dislikes = updated_movie.get('dislikes', 0)
+        updated_likes, updated_dislikes = counts
+        entities.set_counts(movie_message_id, updated_likes, updated_dislikes)
 
         # Get current keyboard to preserve other buttons (like favorite button)
         current_keyboard = cq.message.reply_markup.inline_keyboard
@@ -768,35 +1110,18 @@ async def callback_handler(_, cq: CallbackQuery):
         movie_message_id = int(data.split("_")[2])
         user_id = cq.from_user.id
 
-        user_data = users_col.find_one({"_id": user_id})
-
-        if not user_data:
-            # User not found in db, maybe first time using bot via callback
-            users_col.update_one(
-                {"_id": user_id},
-                {"$set": {"joined": datetime.now(UTC), "notify": True}, "$setOnInsert": {"favorite_movies": []}},
-                upsert=True
-            )
-            user_data = users_col.find_one({"_id": user_id}) # refetch after upsert
-
-        favorite_movies = user_data.get("favorite_movies", [])
+        favorite_movies = await entities.favorites(user_id)
 
         message_already_favorited = movie_message_id in favorite_movies
 
         if message_already_favorited:
             # Remove from favorites
-            users_col.update_one(
-                {"_id": user_id},
-                {"$pull": {"favorite_movies": movie_message_id}}
-            )
+            await entities.remove_favorite(user_id, movie_message_id)
             action_message = "❌ ফেভারিট থেকে সরানো হয়েছে।"
             new_button_text = "⭐ ফেভারিটে যোগ করুন"
         else:
-            # Add to favorites
-            users_col.update_one(
-                {"_id": user_id},
-                {"$addToSet": {"favorite_movies": movie_message_id}} # $addToSet ensures unique values
-            )
+            # Add to favorites, creating the user if they first arrive via a callback
+            await entities.add_favorite(user_id, movie_message_id)
             action_message = "⭐ ফেভারিটে যোগ করা হয়েছে।"
             new_button_text = "❌ ফেভারিট থেকে সরান"
 
@@ -835,7 +1160,7 @@ async def callback_handler(_, cq: CallbackQuery):
             if action in responses:
                 try:
                     m = await app.send_message(uid, responses[action])
-                    asyncio.create_task(delete_message_later(m.chat.id, m.id))
+                    delete_message_later(m.chat.id, m.id)
                     await cq.answer("অ্যাডমিনের পক্ষ থেকে উত্তর পাঠানো হয়েছে।")
                 except Exception as e:
                     await cq.answer("ইউজারকে বার্তা পাঠাতে সমস্যা হয়েছে।", show_alert=True)
@@ -845,6 +1170,47 @@ async def callback_handler(_, cq: CallbackQuery):
         else:
             await cq.answer("অকার্যকর কলব্যাক ডেটা।", show_alert=True)
 
-if __name__ == "__main__":
+async def timed(phases, name, awaitable):
+    start = time.perf_counter()
+    result = await awaitable
+    phases[name] = time.perf_counter() - start
+    return result
+
+async def main():
+    # Index builds run in the background; only schema checks and the
+    # in-memory loads are awaited before polling starts
+    phases = {}
+    startup = time.perf_counter()
+    await timed(phases, "indexes", schema.sync_indexes())
+    await timed(phases, "migrations", schema.migrate())
+    await timed(phases, "catalog", asyncio.gather(load_catalog(), delete_scheduler.recover()))
+    if fuzzy_pool:
+        await timed(phases, "fuzzy_workers", fuzzy_pool.start())
+    await timed(phases, "telegram", app.start())
+    delete_scheduler.start()
+    write_buffer.start()
+    no_result_digest.start()
+    stats_rollups.start()
+    await broadcaster.resume()
+    await reindexer.resume()
+    print("Startup: " + ", ".join(f"{name} {seconds:.2f}s" for name, seconds in phases.items())
+          + f", total {time.perf_counter() - startup:.2f}s")
     print("বট শুরু হচ্ছে...")
-    app.run()
+    await idle()
+    # Jobs that send through the client go first. The client stops before the buffers,
+    # so the updates still being handled can schedule deletes and buffer writes that
+    # the last flushes below pick up.
+    await no_result_digest.stop()
+    await stats_rollups.stop()
+    await broadcaster.stop()
+    await reindexer.stop()
+    await app.stop()
+    await delete_scheduler.stop()
+    await write_buffer.stop()
+    await schema.stop()
+    if fuzzy_pool:
+        await fuzzy_pool.stop()
+    await db.close()
+
+if __name__ == "__main__":
+    app.run(main())
@@ -0,0 +1,169 @@
+import asyncio
+import time
+
+from pyrogram.errors import (
+    FloodWait, UserIsBlocked, InputUserDeactivated, PeerIdInvalid,
+    UserDeactivated, UserDeactivatedBan, UserIsBot
+)
+
+# Users that will never receive anything again; they are pruned in bulk.
+# PeerIdInvalid is not one of them: it also means the session's peer cache is
+# empty (e.g. after a redeploy with a fresh session file), so it only counts as failed.
+DEAD_USER_ERRORS = (UserIsBlocked, InputUserDeactivated, UserDeactivated, UserDeactivatedBan, UserIsBot)
+
+
+class RateLimiter:
+    # Spaces sends evenly at `rate` per second across every running job
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = self._next
+            self._next = now + self.interval
+
+    def pause(self, seconds):
+        self._next = max(self._next, time.monotonic() + seconds)
+
+
+class BroadcastEngine:
+    def __init__(self, client, db, rate=25, concurrency=10, batch_size=500, progress_interval=15, on_sent=None, on_batch=None):
+        self.client = client
+        self.db = db
+        self.limiter = RateLimiter(rate)
+        self.semaphore = asyncio.Semaphore(concurrency)
+        self.batch_size = batch_size
+        self.progress_interval = progress_interval
+        # Called with every message sent by a job that has auto_delete set
+        self.on_sent = on_sent
+        # Called with the number of messages delivered after every batch
+        self.on_batch = on_batch
+        self.sent_total = 0
+        self._tasks = {}
+
+    async def start(self, text, audience="all", admin_chat_id=None, auto_delete=False):
+        progress_message_id = None
+        if admin_chat_id is not None:
+            m = await self.client.send_message(admin_chat_id, "📣 ব্রডকাস্ট শুরু হচ্ছে...")
+            progress_message_id = m.id
+        job = await self.db.broadcasts.create(text, audience, admin_chat_id, progress_message_id, auto_delete)
+        self._spawn(job)
+        return job["_id"]
+
+    async def resume(self, failed=False):
+        # On startup, jobs left running; with failed=True (/broadcast resume), the jobs
+        # that stopped on an error. Returns how many were started.
+        jobs = await (self.db.broadcasts.reopen_failed() if failed else self.db.broadcasts.running())
+        resumed = 0
+        for job in jobs:
+            if job["_id"] not in self._tasks:
+                print(f"Resuming broadcast {job['_id']} after user {job.get('last_user_id')}")
+                self._spawn(job)
+                resumed += 1
+        return resumed
+
+    def _spawn(self, job):
+        task = asyncio.create_task(self._run(job))
+        self._tasks[job["_id"]] = task
+        task.add_done_callback(lambda _: self._tasks.pop(job["_id"], None))
+
+    async def _send(self, user_id, text, auto_delete):
+        async with self.semaphore:
+            while True:
+                await self.limiter.acquire()
+                try:
+                    m = await self.client.send_message(user_id, text)
+                except FloodWait as e:
+                    print(f"FloodWait during broadcast, pausing for {e.value}s")
+                    self.limiter.pause(e.value)
+                    continue
+                except DEAD_USER_ERRORS:
+                    return "pruned"
+                except PeerIdInvalid:
+                    return "failed"
+                except Exception as e:
+                    print(f"Failed to broadcast to user {user_id}: {e}")
+                    return "failed"
+                self.sent_total += 1
+                if auto_delete and self.on_sent:
+                    self.on_sent(m)
+                return "sent"
+
+    async def _run(self, job):
+        job_id = job["_id"]
+        last_user_id = job.get("last_user_id")
+        totals = {"sent": job.get("sent", 0), "failed": job.get("failed", 0), "pruned": job.get("pruned", 0)}
+        last_report = time.monotonic()
+        try:
+            while True:
+                user_ids = await self.db.users.audience_batch(job["audience"], last_user_id, self.batch_size)
+                if not user_ids:
+                    break
+                results = await asyncio.gather(*(self._send(user_id, job["text"], job.get("auto_delete")) for user_id in user_ids))
+
+                batch = {"sent": 0, "failed": 0, "pruned": 0}
+                dead = []
+                for user_id, result in zip(user_ids, results):
+                    batch[result] += 1
+                    if result == "pruned":
+                        dead.append(user_id)
+                if dead:
+                    await self.db.users.mark_blocked(dead)
+
+                last_user_id = user_ids[-1]
+                await self.db.broadcasts.checkpoint(job_id, last_user_id, batch)
+                for key, value in batch.items():
+                    totals[key] += value
+                if self.on_batch:
+                    self.on_batch(batch["sent"])
+
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(job, totals, done=False)
+
+            await self.db.broadcasts.finish(job_id)
+            await self._report(job, totals, done=True)
+        except asyncio.CancelledError:
+            # Left as "running" so it resumes from the last checkpoint on the next start
+            raise
+        except Exception as e:
+            print(f"Broadcast {job_id} stopped after user {last_user_id}: {e}")
+            try:
+                await self.db.broadcasts.fail(job_id, str(e))
+            except Exception as e2:
+                # Still "running", so it resumes on the next start
+                print(f"Could not mark broadcast {job_id} failed: {e2}")
+            await self._report(job, totals, done=False, error=e)
+
+    async def _report(self, job, totals, done, error=None):
+        if job.get("admin_chat_id") is None:
+            return
+        if error is not None:
+            header = f"⚠️ ব্রডকাস্ট থেমে গেছে: {error}\nআবার চালু করতে /broadcast resume দিন।"
+        elif done:
+            header = "✅ ব্রডকাস্ট সম্পন্ন হয়েছে।"
+        else:
+            header = "📣 ব্রডকাস্ট চলছে..."
+        text = (
+            f"{header}\n\n"
+            f"পাঠানো হয়েছে: {totals['sent']}\n"
+            f"ব্যর্থ: {totals['failed']}\n"
+            f"বাদ দেওয়া (ব্লক/ডিঅ্যাক্টিভেটেড): {totals['pruned']}"
+        )
+        try:
+            if job.get("progress_message_id"):
+                await self.client.edit_message_text(job["admin_chat_id"], job["progress_message_id"], text)
+            else:
+                await self.client.send_message(job["admin_chat_id"], text)
+        except Exception as e:
+            print(f"Could not report broadcast progress: {e}")
+
+    async def stop(self):
+        for task in list(self._tasks.values()):
+            task.cancel()
+        await asyncio.gather(*self._tasks.values(), return_exceptions=True)
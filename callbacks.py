@@ -0,0 +1,59 @@
+import base64
+import hashlib
+import os
+from datetime import datetime, UTC, timedelta
+
+from cache import LRUCache
+
+
+# Keys the token hash, so a token can't be computed from its context (query, user id)
+SECRET = os.urandom(16)
+
+
+def _token(key=None):
+    # 8 url-safe characters; derived from `key` so the same context reuses its token
+    raw = hashlib.blake2b(repr(key).encode(), digest_size=6, key=SECRET).digest() if key is not None else os.urandom(6)
+    return base64.urlsafe_b64encode(raw).decode().replace("_", "-")
+
+
+class CallbackRegistry:
+    # Short tokens for callback_data, which Telegram caps at 64 bytes. The payload
+    # (query, candidate ids, user, ...) stays server-side in an LRU with a TTL, and
+    # optionally in Mongo so buttons keep working across restarts.
+    # Tokens never contain "_", so they can sit anywhere in a "_"-separated payload.
+
+    def __init__(self, maxsize=100000, ttl=3600, db=None):
+        self.ttl = ttl
+        self.db = db
+        self.expired = 0
+        self._cache = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    def __len__(self):
+        return len(self._cache)
+
+    async def put(self, payload, key=None, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        # The same context (e.g. a repeated search) gets the same token, and its TTL
+        # restarts so the newest buttons last as long as fresh ones
+        token = _token(key)
+        self._cache.set(token, payload, ttl)
+        if self.db is not None:
+            await self.db.callback_tokens.save(token, payload, datetime.now(UTC) + timedelta(seconds=ttl))
+        return token
+
+    async def get(self, token):
+        payload = self._cache.get(token)
+        if payload is None and self.db is not None:
+            doc = await self.db.callback_tokens.get(token)
+            if doc is not None:
+                payload = doc["payload"]
+                remaining = (doc["expires"].replace(tzinfo=UTC) - datetime.now(UTC)).total_seconds()
+                self._cache.set(token, payload, max(1, remaining))
+        if payload is None:
+            self.expired += 1
+        return payload
+
+    def stats(self):
+        stats = self._cache.stats()
+        stats["expired"] = self.expired
+        return stats
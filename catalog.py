@@ -0,0 +1,487 @@
+import heapq
+import re
+import threading
+import unicodedata
+from bisect import bisect_left, insort
+from collections import Counter
+
+try:
+    from Levenshtein import ratio
+except ImportError:
+    from difflib import SequenceMatcher
+
+    def ratio(a, b):
+        return SequenceMatcher(None, a, b).ratio()
+
+# Latin letters and digits, or runs of Bengali / Devanagari script (danda excluded).
+# Applied to normalize()d text only.
+TOKEN_RE = re.compile(r'[a-z0-9]+|[\u0980-\u09ff]+|[\u0900-\u0963\u0966-\u097f]+')
+YEAR_RE = re.compile(r'\b(?:19|20)\d{2}\b')
+QUALITY_RE = re.compile(r'\b(480p|720p|1080p|2160p|4k|web-?dl|web-?rip|hdrip|blu-?ray|brrip|dvdrip|hdcam|camrip|hdtc|x264|x265|hevc|10bit)\b')
+# Bengali and Devanagari digits, so "২০২৩" is a year too
+DIGITS = str.maketrans("০১২৩৪৫৬৭৮৯०१२३४५६७८९", "0123456789" * 2)
+# Checked in order, so "Dual Audio [Hindi-English]" is Hindi
+LANGUAGES = (
+    ("Bengali", frozenset({"bengali", "bangla", "বাংলা"})),
+    ("Hindi", frozenset({"hindi", "হিন্দি", "हिंदी", "हिन्दी"})),
+    ("English", frozenset({"english", "ইংরেজি", "इंग्लिश"})),
+)
+EMPTY = frozenset()
+# TitleIndex.plausible() scores as many fuzzy candidates as search() does, and counts
+# at most this many trigram postings to find them before it stops ruling queries out
+PLAUSIBLE_CANDIDATES = 500
+PLAUSIBLE_MAX_SCAN = 10000
+# "Title contains query" checks per lookup before giving up. Only reached when every
+# query word is in thousands of titles (language/quality tags) and few have them all.
+MAX_CONTAINS_SCAN = 1000
+
+# Group chatter that never names a movie on its own (English and romanized Bengali/Hindi)
+STOPWORDS = frozenset("""
+a an and are bro bhai vai vi bhaiya bhaia da dada apu sis guys hi hii hello hlw helo hey ok okay oky thanks thank
+thx tnx ty pls plz please welcome good morning night gn gm yes yeah yep no nope nah na hmm hm lol haha hahaha
+what why how who when where which is am was the to of in on for with from at by this that you your u ur i me my
+we our they them he she his him koi kothay kemon acho achen ache ki keno kivabe ar r o ami tumi apni amra tomar
+apnar amar den dao diben dila dilen link movie movies film full hd download send admin group plzz kya hai
+""".split())
+
+
+def normalize(text):
+    # NFKC + casefold, native digits to ASCII, and accents dropped from Latin letters
+    # so "Amélie" matches "amelie". Marks on Bengali/Devanagari letters are kept.
+    if text.isascii():
+        return text.lower()
+    chars = []
+    for ch in unicodedata.normalize("NFKD", text):
+        if unicodedata.combining(ch) and chars and chars[-1].isascii():
+            continue
+        chars.append(ch)
+    return unicodedata.normalize("NFKC", "".join(chars)).casefold().translate(DIGITS)
+
+
+def tokenize(text):
+    return TOKEN_RE.findall(normalize(text))
+
+
+def clean_text(text):
+    return "".join(tokenize(text))
+
+
+def normalize_query(text):
+    return " ".join(normalize(text).split())
+
+
+def _language(tokens):
+    return next((language for language, names in LANGUAGES if not names.isdisjoint(tokens)), None)
+
+
+def _year(normalized):
+    match = YEAR_RE.search(normalized)
+    return int(match.group(0)) if match else None
+
+
+def extract_language(text):
+    return _language(tokenize(text))
+
+
+def extract_year(text):
+    return _year(normalize(text))
+
+
+def analyze(text):
+    # Everything search needs from a caption, from a single normalize() pass
+    normalized = normalize(text)
+    tokens = TOKEN_RE.findall(normalized)
+    return {
+        "title_clean": "".join(tokens),
+        "tokens": list(dict.fromkeys(tokens)),
+        "year": _year(normalized),
+        "language": _language(tokens),
+        "quality": sorted({tag.replace("-", "") for tag in QUALITY_RE.findall(normalized)})
+    }
+
+
+def movie_from_post(message_id, text, date=None):
+    # The fields stored for a channel post; shared by save_post and /reindex
+    return {"message_id": message_id, "title": text, "date": date, **analyze(text)}
+
+
+def request_key(text):
+    # Requests for the same title share one document: the sorted non-stopword
+    # tokens, so "Avatar 2009 movie" and "avatar (2009)" are the same request.
+    # A new post fulfils a request when it contains all of its tokens.
+    tokens = sorted({token for token in tokenize(text) if token not in STOPWORDS})
+    return (" ".join(tokens) or normalize_query(text)), tokens
+
+
+def fuzzy_key(title):
+    # The part of a caption people actually type: first line, up to the year
+    line = title.strip().split("\n", 1)[0]
+    tokens = tokenize(YEAR_RE.split(line, 1)[0]) or tokenize(line)
+    return tuple(tokens[:8])
+
+
+def _grams(text):
+    if len(text) < 3:
+        return {text} if text else set()
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _needed(query, gram_count):
+    # Each edit destroys at most three trigrams; fuzzy scoring allows ~25% edits
+    edits = max(1, len(query) // 4)
+    return max(1, gram_count - 3 * edits)
+
+
+class FuzzyIndex:
+    # Trigram candidate filter over the fuzzy keys of the whole catalog, followed by
+    # a Levenshtein ratio on the surviving candidates only.
+
+    def __init__(self, entries=()):
+        self._keys = {}
+        self._langs = {}
+        self._grams = {}
+        for message_id, key, language in entries:
+            self.add(message_id, key, language)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def add(self, message_id, key, language=None):
+        if message_id in self._keys:
+            self.remove(message_id)
+        self._keys[message_id] = key
+        self._langs[message_id] = language
+        for gram in _grams("".join(key)):
+            ids = self._grams.get(gram)
+            if ids is None:
+                ids = self._grams[gram] = set()
+            ids.add(message_id)
+
+    def remove(self, message_id):
+        key = self._keys.pop(message_id, None)
+        self._langs.pop(message_id, None)
+        if key is None:
+            return
+        for gram in _grams("".join(key)):
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(message_id)
+                if not ids:
+                    del self._grams[gram]
+
+    def clear(self):
+        self._keys = {}
+        self._langs = {}
+        self._grams = {}
+
+    def entries(self):
+        return [(message_id, key, self._langs[message_id]) for message_id, key in self._keys.items()]
+
+    def plausible(self, query, score_cutoff=70, max_candidates=PLAUSIBLE_CANDIDATES, max_scan=PLAUSIBLE_MAX_SCAN):
+        # search() without a language, stopping at the first candidate that scores.
+        # When finding the candidates would mean counting more than `max_scan`
+        # postings it answers True rather than spend the time.
+        candidates = self._candidates(query, max_candidates, max_scan)
+        if candidates is None:
+            return True
+        return any(self._score(query, self._keys[message_id]) >= score_cutoff for message_id in candidates)
+
+    def _candidates(self, query, max_candidates, max_scan=None):
+        postings = sorted((self._grams.get(gram, EMPTY) for gram in _grams(query)), key=len)
+        if not postings:
+            return []
+        # A title within ~25% edits must still share `needed` trigrams with the query,
+        # so it has to appear in at least one of the rarest len - needed + 1 lists.
+        needed = _needed(query, len(postings))
+        split = len(postings) - needed + 1
+        if max_scan is not None and sum(map(len, postings[:split])) > max_scan:
+            return None
+        counts = Counter()
+        for ids in postings[:split]:
+            counts.update(ids)
+        # Titles that can no longer reach `needed` with the lists left are dropped
+        rest = postings[split:]
+        for i, ids in enumerate(rest):
+            left = len(rest) - i - 1
+            alive = Counter()
+            for message_id, hits in counts.items():
+                if message_id in ids:
+                    hits += 1
+                if hits + left >= needed:
+                    alive[message_id] = hits
+            counts = alive
+        return [message_id for message_id, hits in counts.most_common(max_candidates) if hits >= needed]
+
+    def _score(self, query, key):
+        joined = "".join(key)
+        best = ratio(query, joined)
+        size = len(query)
+        offset = 0
+        # Partial matches aligned on word starts, slightly discounted
+        for token in key:
+            if len(joined) - offset > size:
+                best = max(best, 0.9 * ratio(query, joined[offset:offset + size]))
+            offset += len(token)
+        return int(round(best * 100))
+
+    def candidates(self, query, language=None, max_candidates=500):
+        # (message_id, key) pairs to score; the only part of search() that reads the
+        # index, so a caller can hold its lock for this and score without it
+        if not query:
+            return []
+        return [
+            (message_id, self._keys[message_id])
+            for message_id in self._candidates(query, max_candidates)
+            if not language or self._langs[message_id] == language
+        ]
+
+    def rank(self, query, candidates, limit=5, score_cutoff=70):
+        scored = []
+        for message_id, key in candidates:
+            score = self._score(query, key)
+            if score >= score_cutoff:
+                scored.append((message_id, score))
+        scored.sort(key=lambda pair: (-pair[1], pair[0]))
+        return scored[:limit]
+
+    def search(self, query, limit=5, score_cutoff=70, language=None, max_candidates=500):
+        return self.rank(query, self.candidates(query, language, max_candidates), limit, score_cutoff)
+
+
+def _has(ids, message_id):
+    i = bisect_left(ids, message_id)
+    return i < len(ids) and ids[i] == message_id
+
+
+class TitleIndex:
+    # In-memory copy of the catalog: message_id -> (title, title_clean, language,
+    # normalized title),
+    # a sorted list of (title_clean, message_id) for prefix lookups and a token
+    # inverted index (token -> sorted message_ids) for "title contains query" lookups.
+
+    def __init__(self):
+        self._docs = {}
+        self._by_clean = []
+        self._postings = {}
+        self._vocab = []
+        self._fuzzy = FuzzyIndex()
+        # Bumped on every change, so snapshots of the index can tell they're stale
+        self.version = 0
+        # search() runs on the event loop while fuzzy() runs in the thread pool
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._docs)
+
+    def __contains__(self, message_id):
+        return message_id in self._docs
+
+    def get(self, message_id):
+        entry = self._docs.get(message_id)
+        if entry is None:
+            return None
+        title, title_clean, language, _ = entry
+        return {"message_id": message_id, "title": title, "title_clean": title_clean, "language": language}
+
+    def load(self, docs):
+        with self._lock:
+            self.clear()
+            for doc in docs:
+                self._add(doc, keep_sorted=False)
+            self._by_clean.sort()
+            for ids in self._postings.values():
+                ids.sort()
+            self._vocab = sorted(self._postings)
+            self.version += 1
+
+    def clear(self):
+        with self._lock:
+            self._docs = {}
+            self._by_clean = []
+            self._postings = {}
+            self._vocab = []
+            self._fuzzy.clear()
+            self.version += 1
+
+    def add(self, doc):
+        with self._lock:
+            if doc["message_id"] in self._docs:
+                self._remove(doc["message_id"])
+            self._add(doc, keep_sorted=True)
+            self.version += 1
+
+    def _add(self, doc, keep_sorted):
+        message_id = doc["message_id"]
+        title = doc.get("title") or ""
+        title_clean = doc.get("title_clean") or ""
+        # Normalized once here; contains lookups compare against it for every candidate
+        normalized = normalize(title)
+        self._docs[message_id] = (title, title_clean, doc.get("language"), normalized)
+
+        if keep_sorted:
+            insort(self._by_clean, (title_clean, message_id))
+        else:
+            self._by_clean.append((title_clean, message_id))
+
+        for token in set(TOKEN_RE.findall(normalized)):
+            ids = self._postings.get(token)
+            if ids is None:
+                ids = self._postings[token] = []
+                if keep_sorted:
+                    insort(self._vocab, token)
+            if keep_sorted:
+                insort(ids, message_id)
+            else:
+                ids.append(message_id)
+
+        self._fuzzy.add(message_id, fuzzy_key(title), doc.get("language"))
+
+    def remove(self, message_id):
+        with self._lock:
+            self.version += 1
+            return self._remove(message_id)
+
+    def _remove(self, message_id):
+        entry = self._docs.pop(message_id, None)
+        if entry is None:
+            return None
+        _, title_clean, _, normalized = entry
+        self._fuzzy.remove(message_id)
+
+        i = bisect_left(self._by_clean, (title_clean, message_id))
+        if i < len(self._by_clean) and self._by_clean[i] == (title_clean, message_id):
+            del self._by_clean[i]
+
+        for token in set(TOKEN_RE.findall(normalized)):
+            ids = self._postings.get(token)
+            if ids is None:
+                continue
+            i = bisect_left(ids, message_id)
+            if i < len(ids) and ids[i] == message_id:
+                del ids[i]
+            if not ids:
+                del self._postings[token]
+                j = bisect_left(self._vocab, token)
+                if j < len(self._vocab) and self._vocab[j] == token:
+                    del self._vocab[j]
+        return message_id
+
+    def find_exact(self, title_clean):
+        with self._lock:
+            i = bisect_left(self._by_clean, (title_clean,))
+            if i < len(self._by_clean) and self._by_clean[i][0] == title_clean:
+                return self._by_clean[i][1]
+            return None
+
+    def _prefix_ids(self, prefix):
+        i = bisect_left(self._by_clean, (prefix,))
+        while i < len(self._by_clean) and self._by_clean[i][0].startswith(prefix):
+            yield self._by_clean[i][1]
+            i += 1
+
+    def _token_prefix_postings(self, prefix):
+        postings = []
+        i = bisect_left(self._vocab, prefix)
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            postings.append(self._postings[self._vocab[i]])
+            i += 1
+        return postings
+
+    def _contains_ids(self, query):
+        # Every query word but the last must be a whole title word, the last one
+        # may be a prefix. Yields matches in message_id order, walking the smallest
+        # posting list and checking the others, so callers can stop at their limit.
+        tokens = tokenize(query)
+        if not tokens:
+            return
+        exact = []
+        for token in tokens[:-1]:
+            ids = self._postings.get(token)
+            if not ids:
+                return
+            exact.append(ids)
+        exact.sort(key=len)
+        last = tokens[-1]
+        prefix = None
+        if not exact or len(last) >= 3:
+            prefix = self._token_prefix_postings(last)
+            if not prefix:
+                return
+        if prefix is not None and (not exact or sum(map(len, prefix)) < len(exact[0])):
+            candidates = prefix[0] if len(prefix) == 1 else heapq.merge(*prefix)
+            others = exact
+        else:
+            # The needle check below covers the last word's prefix
+            candidates, others = exact[0], exact[1:]
+
+        needle = normalize_query(query)
+        previous = None
+        for scanned, message_id in enumerate(candidates):
+            if scanned >= MAX_CONTAINS_SCAN:
+                return
+            if message_id == previous:
+                continue
+            previous = message_id
+            if needle in self._docs[message_id][3] and all(_has(ids, message_id) for ids in others):
+                yield message_id
+
+    def plausible(self, query, query_clean):
+        # Whether search() or fuzzy() can find anything, checked per title: some
+        # non-stopword, and a title that starts with or contains the query, or a
+        # fuzzy candidate that scores. Both lookups are bounded (MAX_CONTAINS_SCAN,
+        # PLAUSIBLE_MAX_SCAN), so this stays cheap enough for every group message.
+        tokens = tokenize(query)
+        if not any(token not in STOPWORDS for token in tokens):
+            return False
+        with self._lock:
+            if query_clean:
+                i = bisect_left(self._by_clean, (query_clean,))
+                if i < len(self._by_clean) and self._by_clean[i][0].startswith(query_clean):
+                    return True
+            if next(self._contains_ids(query), None) is not None:
+                return True
+            return self._fuzzy.plausible(query_clean)
+
+    def fuzzy_entries(self):
+        with self._lock:
+            return self._fuzzy.entries()
+
+    def fuzzy(self, query_clean, limit=5, score_cutoff=70, language=None):
+        # Runs in the thread pool: only the candidate lookup holds the lock, so the
+        # event loop's search()/add() don't wait for the scoring pass
+        with self._lock:
+            fuzzy = self._fuzzy
+            candidates = fuzzy.candidates(query_clean, language)
+        return fuzzy.rank(query_clean, candidates, limit, score_cutoff)
+
+    def search(self, query, query_clean, language=None, limit=None):
+        with self._lock:
+            return [message_id for message_id, _ in self._search(query, query_clean, language, limit)]
+
+    def ranked(self, query, query_clean, language=None, limit=None):
+        # search() results as (message_id, score) sorted by (-score, message_id):
+        # title prefix matches score 100, "contains" matches 90
+        with self._lock:
+            results = self._search(query, query_clean, language, limit)
+        return sorted(results, key=lambda pair: (-pair[1], pair[0]))
+
+    def _search(self, query, query_clean, language, limit):
+        # Same semantics as the old Mongo query: title_clean starts with
+        # query_clean, or the title contains query (case-insensitive).
+        results = []
+        seen = set()
+        matches = self._prefix_ids(query_clean) if query_clean else iter(())
+        for message_id in matches:
+            if language and self._docs[message_id][2] != language:
+                continue
+            results.append((message_id, 100))
+            seen.add(message_id)
+            if limit and len(results) >= limit:
+                return results
+        for message_id in self._contains_ids(query):
+            if message_id in seen or (language and self._docs[message_id][2] != language):
+                continue
+            results.append((message_id, 90))
+            if limit and len(results) >= limit:
+                break
+        return results
@@ -0,0 +1,788 @@
+import asyncio
+import time
+from collections import Counter
+from datetime import datetime, UTC
+
+from pymongo import AsyncMongoClient, ASCENDING, ReturnDocument, UpdateOne
+from pymongo.errors import AutoReconnect, BulkWriteError, DuplicateKeyError, ServerSelectionTimeoutError
+
+from rollups import bucket_start, bucket_update, totals_update
+
+
+class MoviesRepo:
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def upsert(self, movie):
+        # Counters are only initialised on insert so re-saving an edited post keeps them
+        result = await self.db.run(lambda: self.col.update_one(
+            {"message_id": movie["message_id"]},
+            {"$set": movie, "$setOnInsert": {"views_count": 0, "likes": 0, "dislikes": 0}},
+            upsert=True
+        ))
+        return result.upserted_id is not None
+
+    async def bulk_upsert(self, movies):
+        # Same update as upsert() for a whole batch; unordered so one bad document
+        # doesn't stop the rest. Returns how many movies were new.
+        if not movies:
+            return 0
+        result = await self.db.run(lambda: self.col.bulk_write([
+            UpdateOne(
+                {"message_id": movie["message_id"]},
+                {"$set": movie, "$setOnInsert": {"views_count": 0, "likes": 0, "dislikes": 0}},
+                upsert=True
+            )
+            for movie in movies
+        ], ordered=False))
+        return result.upserted_count
+
+    async def max_message_id(self):
+        movie = await self.db.run(lambda: self.col.find_one({}, {"message_id": 1}, sort=[("message_id", -1)]))
+        return movie["message_id"] if movie else 0
+
+    async def get(self, message_id, projection=None):
+        return await self.db.run(lambda: self.col.find_one({"message_id": message_id}, projection))
+
+    async def get_many(self, message_ids, projection=None):
+        # Documents by message_id, in the order they were asked for
+        if not message_ids:
+            return []
+        docs = await self.db.run(lambda: self.col.find({"message_id": {"$in": message_ids}}, projection).to_list(None))
+        by_id = {doc["message_id"]: doc for doc in docs}
+        return [by_id[message_id] for message_id in message_ids if message_id in by_id]
+
+    async def find_by_tokens(self, tokens, language=None, limit=10, projection=None):
+        # Titles containing every token, through the multikey index on tokens.
+        # `tokens` must come from catalog.tokenize so they match the stored ones.
+        query = {"tokens": {"$all": tokens}}
+        if language:
+            query["language"] = language
+        return await self.db.run(lambda: self.col.find(query, projection).sort("message_id", ASCENDING).limit(limit).to_list(None))
+
+    async def backfill(self, derive, batch_size=1000):
+        # Rewrites derive(title) into every movie, walking message_id in batches
+        updated = 0
+        last_id = None
+        while True:
+            query = {} if last_id is None else {"message_id": {"$gt": last_id}}
+            movies = await self.db.run(lambda: self.col.find(query, {"message_id": 1, "title": 1})
+                                       .sort("message_id", ASCENDING).limit(batch_size).to_list(None))
+            if not movies:
+                return updated
+            ops = [UpdateOne({"_id": movie["_id"]}, {"$set": derive(movie.get("title") or "")}) for movie in movies]
+            await self.db.run(lambda: self.col.bulk_write(ops, ordered=False))
+            updated += len(ops)
+            last_id = movies[-1]["message_id"]
+
+    async def index_fields(self):
+        return await self.db.run(lambda: self.col.find(
+            {}, {"_id": 0, "message_id": 1, "title": 1, "title_clean": 1, "language": 1, "views_count": 1}
+        ).to_list(None))
+
+    async def delete(self, message_id):
+        await self.db.run(lambda: self.col.delete_one({"message_id": message_id}))
+        await self.db.run(lambda: self.db.ratings_col.delete_many({"message_id": message_id}))
+
+    async def delete_all(self):
+        await self.db.run(lambda: self.col.delete_many({}))
+        await self.db.run(lambda: self.db.ratings_col.delete_many({}))
+
+    async def count(self):
+        return await self.db.run(lambda: self.col.count_documents({}))
+
+
+class RatingsRepo:
+    # One document per (message_id, user_id) in the ratings collection; the unique
+    # index is what makes a vote one-shot. likes/dislikes on the movie are derived
+    # from it: legacy_likes/legacy_dislikes (votes from before ratings recorded a
+    # direction) plus the recorded votes, so a recount can be repeated safely.
+    def __init__(self, db, col, movies_col):
+        self.db = db
+        self.col = col
+        self.movies_col = movies_col
+
+    async def vote(self, message_id, user_id, action):
+        # Returns (likes, dislikes) after the vote, or None if the user already voted.
+        # Raises LookupError if the movie does not exist.
+        try:
+            await self.db.run(lambda: self.col.insert_one({
+                "message_id": message_id,
+                "user_id": user_id,
+                "vote": action,
+                "time": datetime.now(UTC)
+            }), idempotent=False)
+        except DuplicateKeyError:
+            return None
+
+        counts = await self.recount(message_id)
+        if counts is None:
+            await self.db.run(lambda: self.col.delete_one({"message_id": message_id, "user_id": user_id}))
+            raise LookupError(message_id)
+        return counts
+
+    async def recount(self, message_id):
+        # Sets likes/dislikes from the ratings collection; returns them, or None if the
+        # movie does not exist. Counts only grow, so $max keeps a recount that read
+        # before a concurrent vote from overwriting the newer one.
+        likes, dislikes = await asyncio.gather(
+            self.db.run(lambda: self.col.count_documents({"message_id": message_id, "vote": "like"})),
+            self.db.run(lambda: self.col.count_documents({"message_id": message_id, "vote": "dislike"}))
+        )
+        movie = await self.db.run(lambda: self.movies_col.find_one_and_update(
+            {"message_id": message_id},
+            [{"$set": {
+                "likes": {"$max": [{"$ifNull": ["$likes", 0]}, {"$add": [{"$ifNull": ["$legacy_likes", 0]}, likes]}]},
+                "dislikes": {"$max": [{"$ifNull": ["$dislikes", 0]}, {"$add": [{"$ifNull": ["$legacy_dislikes", 0]}, dislikes]}]}
+            }}],
+            projection={"_id": 0, "likes": 1, "dislikes": 1},
+            return_document=ReturnDocument.AFTER
+        ))
+        if movie is None:
+            return None
+        return movie.get("likes", 0), movie.get("dislikes", 0)
+
+    async def split_legacy_counts(self, batch_size=500):
+        # Stores the part of each movie's likes/dislikes that has no vote in the ratings
+        # collection as legacy_likes/legacy_dislikes, so recount() keeps it
+        async def votes():
+            cursor = await self.col.aggregate([
+                {"$match": {"vote": {"$in": ["like", "dislike"]}}},
+                {"$group": {"_id": {"message_id": "$message_id", "vote": "$vote"}, "count": {"$sum": 1}}}
+            ])
+            return await cursor.to_list(None)
+        recorded = {}
+        for row in await self.db.run(votes):
+            recorded[(row["_id"]["message_id"], row["_id"]["vote"])] = row["count"]
+
+        movies = await self.db.run(lambda: self.movies_col.find(
+            {"$or": [{"likes": {"$gt": 0}}, {"dislikes": {"$gt": 0}}]}, {"message_id": 1, "likes": 1, "dislikes": 1}
+        ).to_list(None))
+        ops = [
+            UpdateOne({"_id": movie["_id"]}, {"$set": {
+                "legacy_likes": max(movie.get("likes", 0) - recorded.get((movie["message_id"], "like"), 0), 0),
+                "legacy_dislikes": max(movie.get("dislikes", 0) - recorded.get((movie["message_id"], "dislike"), 0), 0)
+            }})
+            for movie in movies
+        ]
+        for i in range(0, len(ops), batch_size):
+            await self.db.run(lambda: self.movies_col.bulk_write(ops[i:i + batch_size], ordered=False))
+        return len(ops)
+
+    async def migrate_rated_by(self, batch_size=200):
+        # Moves the legacy rated_by arrays off the movie documents. The old arrays
+        # didn't record which way people voted, so those votes are stored as "legacy".
+        migrated = 0
+        while True:
+            movies = await self.db.run(lambda: self.movies_col.find(
+                {"rated_by.0": {"$exists": True}}, {"message_id": 1, "rated_by": 1}
+            ).limit(batch_size).to_list(None))
+            if not movies:
+                break
+            for movie in movies:
+                docs = [
+                    {"message_id": movie["message_id"], "user_id": user_id, "vote": "legacy", "time": None}
+                    for user_id in set(movie["rated_by"])
+                ]
+                try:
+                    await self.db.run(lambda: self.col.insert_many(docs, ordered=False))
+                except BulkWriteError as e:
+                    if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                        raise
+                migrated += len(docs)
+            await self.db.run(lambda: self.movies_col.update_many(
+                {"_id": {"$in": [movie["_id"] for movie in movies]}}, {"$unset": {"rated_by": ""}}
+            ))
+        # Documents that only ever had an empty array
+        await self.db.run(lambda: self.movies_col.update_many({"rated_by": {"$exists": True}}, {"$unset": {"rated_by": ""}}))
+        return migrated
+
+
+class UsersRepo:
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def register(self, user_id):
+        # True if this is the user's first contact with the bot
+        result = await self.db.run(lambda: self.col.update_one(
+            {"_id": user_id},
+            {"$set": {"joined": datetime.now(UTC), "notify": True, "blocked": False}, "$setOnInsert": {"favorite_movies": []}},
+            upsert=True
+        ))
+        return result.upserted_id is not None
+
+    async def favorites(self, user_id):
+        user = await self.db.run(lambda: self.col.find_one({"_id": user_id}, {"favorite_movies": 1}))
+        return user.get("favorite_movies", []) if user else []
+
+    async def add_favorite(self, user_id, message_id):
+        await self.db.run(lambda: self.col.update_one(
+            {"_id": user_id},
+            {"$addToSet": {"favorite_movies": message_id}, "$setOnInsert": {"joined": datetime.now(UTC), "notify": True}},
+            upsert=True
+        ))
+
+    async def remove_favorite(self, user_id, message_id):
+        await self.db.run(lambda: self.col.update_one({"_id": user_id}, {"$pull": {"favorite_movies": message_id}}))
+
+    async def audience_batch(self, audience, after_user_id, limit):
+        # Next page of user ids for a broadcast, walking the _id index
+        query = {"blocked": {"$ne": True}}
+        if audience == "notify":
+            query["notify"] = {"$ne": False}
+        elif isinstance(audience, dict):
+            query["_id"] = {"$in": audience["user_ids"]}
+        if after_user_id is not None:
+            query.setdefault("_id", {})["$gt"] = after_user_id
+        users = await self.db.run(lambda: self.col.find(query, {"_id": 1}).sort("_id", ASCENDING).limit(limit).to_list(None))
+        return [user["_id"] for user in users]
+
+    async def mark_blocked(self, user_ids):
+        await self.db.run(lambda: self.col.update_many({"_id": {"$in": user_ids}}, {"$set": {"blocked": True}}))
+
+    async def count(self):
+        # From collection metadata, no scan
+        return await self.db.run(lambda: self.col.estimated_document_count())
+
+
+class RequestsRepo:
+    # One pending document per request key (catalog.request_key) holding every user
+    # who asked for it. Closed requests keep their document; asking again opens a new one.
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def add(self, key, tokens, user_id, username, movie_name):
+        # Returns (status, waiting): "new" for the first requester, "joined" or "duplicate" after that
+        now = datetime.now(UTC)
+
+        def upsert():
+            return self.col.find_one_and_update(
+                {"key": key, "status": "pending"},
+                {"$addToSet": {"requesters": user_id},
+                 "$inc": {"requests": 1},
+                 "$set": {"last_requested": now},
+                 "$setOnInsert": {"tokens": tokens, "movie_name": movie_name, "user_id": user_id,
+                                  "username": username, "request_time": now}},
+                projection={"requesters": 1},
+                upsert=True
+            )
+
+        try:
+            before = await self.db.run(upsert, idempotent=False)
+        except DuplicateKeyError:
+            # Someone else inserted the same new request at the same moment (unique
+            # pending key); the document exists now, so this matches it and joins
+            before = await self.db.run(upsert, idempotent=False)
+        if before is None:
+            return "new", 1
+        requesters = before.get("requesters", [])
+        if user_id in requesters:
+            return "duplicate", len(requesters)
+        return "joined", len(requesters) + 1
+
+    async def matching(self, tokens):
+        # Pending requests whose tokens all appear in `tokens`; $in narrows the
+        # candidates through the status_1_tokens_1 multikey index
+        return await self.db.run(lambda: self.col.find(
+            {"status": "pending", "tokens": {"$in": tokens, "$not": {"$elemMatch": {"$nin": tokens}}}},
+            {"_id": 1}
+        ).to_list(None))
+
+    async def close(self, query, status, **fields):
+        # Returns the closed request with its final requester list, or None if it was already closed
+        return await self.db.run(lambda: self.col.find_one_and_update(
+            {**query, "status": "pending"},
+            {"$set": {"status": status, "closed": datetime.now(UTC), **fields}},
+            projection={"movie_name": 1, "requesters": 1},
+            return_document=ReturnDocument.AFTER
+        ), idempotent=False)
+
+    async def fulfil(self, tokens, message_id):
+        closed = []
+        for request in await self.matching(tokens):
+            doc = await self.close({"_id": request["_id"]}, "fulfilled", message_id=message_id)
+            if doc is not None:
+                closed.append(doc)
+        return closed
+
+    async def merge_legacy(self, key_func):
+        # Documents from before aggregation held one user and one name each
+        legacy = await self.db.run(lambda: self.col.find({"key": {"$exists": False}}).sort("request_time", ASCENDING).to_list(None))
+        merged = {}
+        for doc in legacy:
+            if doc.get("status", "pending") != "pending":
+                continue
+            key, tokens = key_func(doc["movie_name"])
+            entry = merged.setdefault(key, {
+                "tokens": tokens, "movie_name": doc["movie_name"], "user_id": doc["user_id"],
+                "username": doc.get("username"), "request_time": doc.get("request_time"),
+                "requesters": set(), "requests": 0
+            })
+            entry["requesters"].add(doc["user_id"])
+            entry["requests"] += 1
+        ops = [
+            UpdateOne(
+                {"key": key, "status": "pending"},
+                {"$addToSet": {"requesters": {"$each": list(entry.pop("requesters"))}},
+                 "$inc": {"requests": entry.pop("requests")},
+                 "$setOnInsert": entry},
+                upsert=True
+            )
+            for key, entry in merged.items()
+        ]
+        if ops:
+            await self.db.run(lambda: self.col.bulk_write(ops, ordered=False), idempotent=False)
+        if legacy:
+            await self.db.run(lambda: self.col.delete_many({"_id": {"$in": [doc["_id"] for doc in legacy]}}))
+        return len(legacy), len(ops)
+
+    async def count(self, status=None):
+        return await self.db.run(lambda: self.col.count_documents({} if status is None else {"status": status}))
+
+
+class FeedbackRepo:
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def add(self, user_id, text):
+        await self.db.run(lambda: self.col.insert_one({
+            "user": user_id,
+            "text": text,
+            "time": datetime.now(UTC)
+        }), idempotent=False)
+
+    async def count(self):
+        return await self.db.run(lambda: self.col.estimated_document_count())
+
+
+class BroadcastsRepo:
+    # One document per job; last_user_id is the resume point
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def create(self, text, audience, admin_chat_id, progress_message_id, auto_delete):
+        job = {
+            "text": text,
+            "audience": audience,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "auto_delete": auto_delete,
+            "status": "running",
+            "last_user_id": None,
+            "sent": 0,
+            "failed": 0,
+            "pruned": 0,
+            "created": datetime.now(UTC)
+        }
+        result = await self.db.run(lambda: self.col.insert_one(job), idempotent=False)
+        job["_id"] = result.inserted_id
+        return job
+
+    async def running(self):
+        return await self.db.run(lambda: self.col.find({"status": "running"}).to_list(None))
+
+    async def checkpoint(self, job_id, last_user_id, counts):
+        await self.db.run(lambda: self.col.update_one(
+            {"_id": job_id},
+            {"$set": {"last_user_id": last_user_id, "updated": datetime.now(UTC)}, "$inc": counts}
+        ), idempotent=False)
+
+    async def finish(self, job_id):
+        await self.db.run(lambda: self.col.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "done", "finished": datetime.now(UTC)}}
+        ))
+
+    async def fail(self, job_id, error):
+        # last_user_id is kept, so a resume picks up after the last checkpoint
+        await self.db.run(lambda: self.col.update_one(
+            {"_id": job_id},
+            {"$set": {"status": "failed", "error": error, "updated": datetime.now(UTC)}}
+        ))
+
+    async def reopen_failed(self):
+        # Returns the failed jobs, marked running again
+        jobs = await self.db.run(lambda: self.col.find({"status": "failed"}).to_list(None))
+        if jobs:
+            await self.db.run(lambda: self.col.update_many(
+                {"_id": {"$in": [job["_id"] for job in jobs]}}, {"$set": {"status": "running"}, "$unset": {"error": ""}}
+            ))
+        return jobs
+
+
+class DailyViewsRepo:
+    # Per-day view counts backing the today/week popular lists, expired by a TTL index
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def since(self, day):
+        docs = await self.db.run(lambda: self.col.find({"day": {"$gte": day}}, {"_id": 0, "day": 1, "message_id": 1, "count": 1}).to_list(None))
+        return [(doc["day"], doc["message_id"], doc["count"]) for doc in docs]
+
+
+class AutoDeletesRepo:
+    # Keyed by "chat_id:message_id" so re-persisting the same entry is harmless
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def add_many(self, entries):
+        docs = [dict(entry, _id=f"{entry['chat_id']}:{entry['message_id']}") for entry in entries]
+        try:
+            await self.db.run(lambda: self.col.insert_many(docs, ordered=False))
+        except BulkWriteError as e:
+            if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+                raise
+
+    async def remove_many(self, keys):
+        ids = [f"{chat_id}:{message_id}" for chat_id, message_id in keys]
+        await self.db.run(lambda: self.col.delete_many({"_id": {"$in": ids}}))
+
+    async def all(self):
+        return await self.db.run(lambda: self.col.find({}, {"chat_id": 1, "message_id": 1, "due": 1}).to_list(None))
+
+
+class MissedQueriesRepo:
+    # Failed searches, one document per normalized query with a count and the users
+    # waiting on it. Written by WriteBuffer.record_miss; last_seen has a TTL index.
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def for_digest(self, limit):
+        # Open queries that were searched again since they last went out in a digest
+        return await self.db.run(lambda: self.col.find(
+            {"status": "open", "$expr": {"$gt": ["$count", "$digested_count"]}},
+            {"query": 1, "count": 1, "digested_count": 1, "waiting": {"$size": "$users"}}
+        ).sort("count", -1).limit(limit).to_list(None))
+
+    async def mark_digested(self, docs):
+        if docs:
+            await self.db.run(lambda: self.col.bulk_write([
+                UpdateOne({"_id": doc["_id"]}, {"$max": {"digested_count": doc["count"]}}) for doc in docs
+            ], ordered=False))
+
+    async def resolve(self, key, status):
+        # Closes the query and hands back the users who were waiting on it
+        return await self.db.run(lambda: self.col.find_one_and_update(
+            {"_id": key, "status": "open"},
+            {"$set": {"status": status, "resolved": datetime.now(UTC), "users": []}},
+            projection={"query": 1, "users": 1}
+        ), idempotent=False)
+
+    async def count_open(self):
+        return await self.db.run(lambda: self.col.count_documents({"status": "open"}))
+
+
+class CallbackTokensRepo:
+    # Optional backing store for callbacks.CallbackRegistry; `expires` has a TTL index
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def save(self, token, payload, expires):
+        await self.db.run(lambda: self.col.update_one(
+            {"_id": token}, {"$set": {"payload": payload, "expires": expires}}, upsert=True
+        ))
+
+    async def get(self, token):
+        return await self.db.run(lambda: self.col.find_one({"_id": token, "expires": {"$gt": datetime.now(UTC)}}))
+
+
+class SettingsRepo:
+    def __init__(self, db, col):
+        self.db = db
+        self.col = col
+
+    async def get(self, key, default=None):
+        setting = await self.db.run(lambda: self.col.find_one({"key": key}))
+        return setting.get("value", default) if setting else default
+
+    async def set(self, key, value):
+        await self.db.run(lambda: self.col.update_one({"key": key}, {"$set": {"value": value}}, upsert=True))
+
+    async def delete(self, key):
+        await self.db.run(lambda: self.col.delete_one({"key": key}))
+
+
+class WriteBuffer:
+    # Write-behind for the hottest writes: views_count increments per movie, last_query
+    # per user, failed searches per normalized query and the per-minute stats counters.
+    # Flushed as unordered bulk_writes every `interval` seconds, as soon as `max_pending`
+    # keys are buffered, and on shutdown. Each collection's write stands on its own:
+    # a failed one keeps only its own updates (and only the ops the server rejected)
+    # for the next round, so the $inc writes that did apply are never replayed.
+    # After a network error or timeout the server may have applied an $inc batch,
+    # so it is dropped and counted in `dropped` rather than risk counting it twice.
+
+    def __init__(self, db, interval=5.0, max_pending=1000):
+        self.db = db
+        self.interval = interval
+        self.max_pending = max_pending
+        self.flushes = 0
+        self.last_flush_lag = 0.0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.dropped = 0
+        self._views = Counter()
+        self._daily = Counter()
+        self._users = {}
+        self._misses = {}
+        self._stats = Counter()
+        self._totals = Counter()
+        self._oldest = None
+        self._full = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task = None
+
+    def __len__(self):
+        return len(self._views) + len(self._users) + len(self._misses) + len(self._stats)
+
+    def _buffered(self):
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+        if len(self) >= self.max_pending:
+            self._full.set()
+
+    def incr_views(self, message_id, count=1):
+        self._views[message_id] += count
+        self._daily[(datetime.now(UTC).strftime("%Y-%m-%d"), message_id)] += count
+        self._buffered()
+
+    def touch_user(self, user_id, last_query):
+        self._users[user_id] = (last_query, datetime.now(UTC))
+        self._buffered()
+
+    def record_miss(self, key, query, user_id):
+        # key is the normalized query; query is kept as first typed for the digest
+        miss = self._misses.get(key)
+        if miss is None:
+            miss = self._misses[key] = {"query": query, "count": 0, "users": set()}
+        miss["count"] += 1
+        miss["users"].add(user_id)
+        miss["last_seen"] = datetime.now(UTC)
+        self._buffered()
+
+    def count(self, event, amount=1):
+        # Traffic counters for /stats, one key per (minute, event); see rollups.py
+        if amount:
+            self._stats[(bucket_start(datetime.now(UTC), "minute"), event)] += amount
+            self._totals[event] += amount
+            self._buffered()
+
+    def stats(self):
+        return {
+            "pending": len(self),
+            "flushes": self.flushes,
+            "last_flush_lag": self.last_flush_lag,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "dropped": self.dropped
+        }
+
+    async def flush(self):
+        # Serialized, so stop() waits for a flush that is already writing
+        async with self._flush_lock:
+            await self._flush()
+
+    async def _flush(self):
+        if not self._views and not self._users and not self._misses and not self._stats and not self._totals:
+            return
+        views, self._views = self._views, Counter()
+        daily, self._daily = self._daily, Counter()
+        users, self._users = self._users, {}
+        misses, self._misses = self._misses, {}
+        stats, self._stats = self._stats, Counter()
+        totals, self._totals = self._totals, Counter()
+        lag = time.monotonic() - self._oldest if self._oldest is not None else 0.0
+        self._oldest = None
+        self._full.clear()
+
+        views = list(views.items())
+        daily = list(daily.items())
+        users = list(users.items())
+        misses = list(misses.items())
+        minutes = {}
+        for (minute, event), count in stats.items():
+            minutes.setdefault(minute, {})[event] = count
+        minutes = list(minutes.items())
+        totals = [(event, count) for event, count in totals.items() if count]
+
+        view_ops = [UpdateOne({"message_id": message_id}, {"$inc": {"views_count": count}}) for message_id, count in views]
+        daily_ops = [
+            UpdateOne(
+                {"_id": f"{day}:{message_id}"},
+                {"$inc": {"count": count},
+                 "$setOnInsert": {"day": day, "message_id": message_id, "date": datetime.strptime(day, "%Y-%m-%d")}},
+                upsert=True
+            )
+            for (day, message_id), count in daily
+        ]
+        user_ops = [
+            UpdateOne(
+                {"_id": user_id},
+                {"$set": {"last_query": last_query, "last_active": last_active},
+                 "$setOnInsert": {"joined": last_active, "favorite_movies": []}},
+                upsert=True
+            )
+            for user_id, (last_query, last_active) in users
+        ]
+        miss_ops = [
+            UpdateOne(
+                {"_id": key},
+                {"$inc": {"count": miss["count"]},
+                 "$addToSet": {"users": {"$each": list(miss["users"])}},
+                 "$set": {"last_seen": miss["last_seen"], "status": "open"},
+                 "$setOnInsert": {"query": miss["query"], "first_seen": miss["last_seen"], "digested_count": 0}},
+                upsert=True
+            )
+            for key, miss in misses
+        ]
+        touched = datetime.now(UTC)
+        minute_ops = [bucket_update("minute", minute, counts, touched) for minute, counts in minutes]
+        totals_ops = [totals_update(dict(totals))] if totals else []
+
+        results = await asyncio.gather(
+            self._write(self.db.movies_col, view_ops, idempotent=False),
+            self._write(self.db.daily_views_col, daily_ops, idempotent=False),
+            self._write(self.db.users_col, user_ops, idempotent=True),
+            self._write(self.db.missed_queries_col, miss_ops, idempotent=False),
+            self._write(self.db.stats_col, minute_ops, idempotent=False),
+            self._write(self.db.stats_col, totals_ops, idempotent=False)
+        )
+        (failed_views, _), (failed_daily, _), (failed_users, new_users), (failed_misses, _), (failed_minutes, _), (failed_totals, _) = results
+
+        for i in failed_views:
+            self._views[views[i][0]] += views[i][1]
+        for i in failed_daily:
+            self._daily[daily[i][0]] += daily[i][1]
+        for i in failed_users:
+            self._users.setdefault(*users[i])
+        for i in failed_misses:
+            key, miss = misses[i]
+            pending = self._misses.setdefault(key, {"query": miss["query"], "count": 0, "users": set(), "last_seen": miss["last_seen"]})
+            pending["count"] += miss["count"]
+            pending["users"] |= miss["users"]
+        for i in failed_minutes:
+            minute, counts = minutes[i]
+            for event, count in counts.items():
+                self._stats[(minute, event)] += count
+        if failed_totals:
+            self._totals.update(dict(totals))
+        failed = len(failed_views) + len(failed_daily) + len(failed_users) + len(failed_misses) + len(failed_minutes) + len(failed_totals)
+        if failed:
+            self._buffered()
+
+        # Users first seen through a search; counted in the next flush
+        self.count("new_users", new_users)
+
+        self.flushes += 1
+        self.last_flush_lag = lag
+        self.last_batch_size = len(view_ops) + len(daily_ops) + len(user_ops) + len(miss_ops) + len(minute_ops) + len(totals_ops) - failed
+        self.max_batch_size = max(self.max_batch_size, self.last_batch_size)
+
+    async def _write(self, col, ops, idempotent):
+        # Returns (indexes of the ops to keep for the next round, documents upserted)
+        if not ops:
+            return [], 0
+        try:
+            result = await self.db.run(lambda: col.bulk_write(ops, ordered=False), idempotent=idempotent)
+            return [], result.upserted_count
+        except BulkWriteError as e:
+            # Unordered: everything but the listed ops was applied
+            failed = sorted({error["index"] for error in e.details.get("writeErrors", [])})
+            print(f"Write buffer flush to {col.name}: {len(failed)} of {len(ops)} updates failed, keeping them for the next round")
+            return failed, e.details.get("nUpserted", 0)
+        except ServerSelectionTimeoutError as e:
+            # No server was reached, so nothing was applied
+            print(f"Write buffer flush to {col.name} failed, keeping {len(ops)} updates for the next round: {e}")
+            return list(range(len(ops))), 0
+        except Exception as e:
+            if idempotent:
+                print(f"Write buffer flush to {col.name} failed, keeping {len(ops)} updates for the next round: {e}")
+                return list(range(len(ops))), 0
+            print(f"Write buffer flush to {col.name} failed and may have been applied, dropping {len(ops)} updates: {e}")
+            self.dropped += len(ops)
+            return [], 0
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            # Shielded: cancelling the loop on shutdown must not drop a batch mid-write
+            await asyncio.shield(self.flush())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self.flush()
+
+
+class Database:
+    def __init__(self, url, pool_size=50, timeout_ms=5000, retries=3, retry_backoff=0.2, event_listeners=None, name="movie_bot"):
+        self.client = AsyncMongoClient(
+            url,
+            event_listeners=event_listeners or [],
+            maxPoolSize=pool_size,
+            serverSelectionTimeoutMS=timeout_ms,
+            connectTimeoutMS=timeout_ms,
+            socketTimeoutMS=timeout_ms * 2,
+            waitQueueTimeoutMS=timeout_ms
+        )
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+
+        db = self.database = self.client[name]
+        self.movies_col = db["movies"]
+        self.users_col = db["users"]
+        self.feedback_col = db["feedback"]
+        self.stats_col = db["stats"]
+        self.settings_col = db["settings"]
+        self.requests_col = db["requests"]
+        self.broadcasts_col = db["broadcasts"]
+        self.auto_deletes_col = db["auto_deletes"]
+        self.daily_views_col = db["daily_views"]
+        self.ratings_col = db["ratings"]
+        self.callback_tokens_col = db["callback_tokens"]
+        self.missed_queries_col = db["missed_queries"]
+
+        self.movies = MoviesRepo(self, self.movies_col)
+        self.ratings = RatingsRepo(self, self.ratings_col, self.movies_col)
+        self.users = UsersRepo(self, self.users_col)
+        self.requests = RequestsRepo(self, self.requests_col)
+        self.feedback = FeedbackRepo(self, self.feedback_col)
+        self.settings = SettingsRepo(self, self.settings_col)
+        self.broadcasts = BroadcastsRepo(self, self.broadcasts_col)
+        self.auto_deletes = AutoDeletesRepo(self, self.auto_deletes_col)
+        self.daily_views = DailyViewsRepo(self, self.daily_views_col)
+        self.callback_tokens = CallbackTokensRepo(self, self.callback_tokens_col)
+        self.missed_queries = MissedQueriesRepo(self, self.missed_queries_col)
+
+    async def run(self, operation, idempotent=True):
+        # pymongo already retries once on its own; this adds backoff for longer blips.
+        # Non-idempotent writes ($inc, insert) are never replayed.
+        attempts = self.retries + 1 if idempotent else 1
+        for attempt in range(attempts):
+            try:
+                return await operation()
+            except AutoReconnect as e:
+                if attempt == attempts - 1:
+                    raise
+                delay = self.retry_backoff * 2 ** attempt
+                print(f"Mongo operation failed ({e}), retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+
+    async def close(self):
+        await self.client.close()
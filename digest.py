@@ -0,0 +1,69 @@
+import asyncio
+
+from pyrogram.types import InlineKeyboardButton, InlineKeyboardMarkup
+
+# Button per admin reply; the texts sent to users live with the handler in bot.py
+REASONS = {"wrong": "❌", "notyet": "⏳", "uploaded": "📤", "coming": "🚀"}
+
+
+class NoResultDigest:
+    # Failed searches are buffered per normalized query (WriteBuffer.record_miss) and
+    # sent to the admins as one periodic digest instead of one message per search.
+    # A query goes out again only if it was searched since it last appeared.
+
+    def __init__(self, client, db, tokens, admin_ids, interval=3600, limit=10, token_ttl=None):
+        self.client = client
+        self.db = db
+        self.tokens = tokens
+        self.admin_ids = admin_ids
+        self.interval = interval
+        self.limit = limit
+        self.token_ttl = token_ttl
+        self.sent_total = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.send()
+            except Exception as e:
+                print(f"No-result digest failed: {e}")
+
+    async def send(self):
+        docs = await self.db.missed_queries.for_digest(self.limit)
+        if not docs:
+            return 0
+        lines = ["📋 *খুঁজে না পাওয়া মুভির সারাংশ*\n"]
+        buttons = []
+        for number, doc in enumerate(docs, 1):
+            new = doc["count"] - doc.get("digested_count", 0)
+            query = doc["query"].replace("`", "'")
+            lines.append(f"{number}. `{query}` — {doc['count']} বার ({new} নতুন), {doc['waiting']} জন অপেক্ষায়")
+            token = await self.tokens.put({"key": doc["_id"]}, key=("missed", doc["_id"]), ttl=self.token_ttl)
+            buttons.append([
+                InlineKeyboardButton(f"{emoji} {number}", callback_data=f"digest_{reason}_{token}")
+                for reason, emoji in REASONS.items()
+            ])
+        lines.append("\n❌ ভুল নাম · ⏳ এখনো আসেনি · 📤 আপলোড আছে · 🚀 শিগগির আসবে\nএকটি চাপলেই অপেক্ষায় থাকা সবাইকে জানানো হবে।")
+        text = "\n".join(lines)
+
+        delivered = False
+        for admin_id in self.admin_ids:
+            try:
+                await self.client.send_message(admin_id, text, reply_markup=InlineKeyboardMarkup(buttons), disable_web_page_preview=True)
+                delivered = True
+            except Exception as e:
+                print(f"Could not send no-result digest to admin {admin_id}: {e}")
+        if delivered:
+            await self.db.missed_queries.mark_digested(docs)
+            self.sent_total += 1
+        return len(docs)
@@ -0,0 +1,56 @@
+from cache import LRUCache
+
+# Cached "no such movie", so a stale deep link doesn't hit Mongo on every click
+MISSING = object()
+
+
+class EntityCache:
+    # Read-through cache for what the watch_ deep link shows: a movie's rating counts
+    # and the user's favorite ids. Writes go to Mongo first and then update the cached
+    # entry in place, so the rating, favorite and delete handlers keep it current;
+    # the TTL only bounds how long a change made elsewhere can go unseen.
+
+    def __init__(self, db, movie_size=20000, user_size=50000, ttl=600):
+        self.db = db
+        self.movies = LRUCache(maxsize=movie_size, ttl=ttl)
+        self.users = LRUCache(maxsize=user_size, ttl=ttl)
+
+    async def movie(self, message_id):
+        movie = self.movies.get(message_id)
+        if movie is None:
+            movie = await self.db.movies.get(message_id, {"_id": 0, "title": 1, "likes": 1, "dislikes": 1})
+            self.movies.set(message_id, MISSING if movie is None else movie)
+        return None if movie is MISSING else movie
+
+    def set_counts(self, message_id, likes, dislikes):
+        movie = self.movies.get(message_id)
+        if movie is not None and movie is not MISSING:
+            self.movies.set(message_id, {**movie, "likes": likes, "dislikes": dislikes})
+
+    def forget_movie(self, message_id):
+        self.movies.pop(message_id)
+
+    def clear_movies(self):
+        self.movies.clear()
+
+    async def favorites(self, user_id):
+        favorites = self.users.get(user_id)
+        if favorites is None:
+            favorites = frozenset(await self.db.users.favorites(user_id))
+            self.users.set(user_id, favorites)
+        return favorites
+
+    async def add_favorite(self, user_id, message_id):
+        await self.db.users.add_favorite(user_id, message_id)
+        favorites = self.users.get(user_id)
+        if favorites is not None:
+            self.users.set(user_id, favorites | {message_id})
+
+    async def remove_favorite(self, user_id, message_id):
+        await self.db.users.remove_favorite(user_id, message_id)
+        favorites = self.users.get(user_id)
+        if favorites is not None:
+            self.users.set(user_id, favorites - {message_id})
+
+    def stats(self):
+        return {"movies": self.movies.stats(), "users": self.users.stats()}
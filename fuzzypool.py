@@ -0,0 +1,177 @@
+import asyncio
+import multiprocessing
+import os
+import pickle
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import resource_tracker, shared_memory
+
+from catalog import FuzzyIndex
+
+# Per worker process: snapshot -> index built from it, for the current snapshot and
+# the one before it, so queries still carrying the old snapshot during a swap don't
+# rebuild it
+_worker_indexes = {}
+
+
+def _attach(name, size):
+    # Forked workers share the parent's resource tracker, so attaching here doesn't
+    # hand ownership of the segment to the worker
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        return pickle.loads(shm.buf[:size])
+    finally:
+        shm.close()
+
+
+def _worker_load(snapshot):
+    index = _worker_indexes.get(snapshot)
+    if index is None:
+        name, size, _ = snapshot
+        try:
+            entries = _attach(name, size)
+        except FileNotFoundError:
+            return None
+        index = _worker_indexes[snapshot] = FuzzyIndex(entries)
+        while len(_worker_indexes) > 2:
+            del _worker_indexes[next(iter(_worker_indexes))]
+    return index
+
+
+def _worker_warm(snapshot):
+    _worker_load(snapshot)
+    return os.getpid()
+
+
+def _worker_search(snapshot, query, limit, score_cutoff, language):
+    index = _worker_load(snapshot)
+    if index is None:
+        # Replaced and unlinked before this worker got to it; the caller retries locally
+        return None
+    return index.search(query, limit=limit, score_cutoff=score_cutoff, language=language)
+
+
+class FuzzyPool:
+    # Fuzzy scoring on worker processes instead of GIL-bound threads. The catalog's
+    # fuzzy keys are pickled once into a shared-memory segment; each worker builds its
+    # own FuzzyIndex from it and only the segment name travels with a query.
+    # The catalog is checked every `refresh_delay` seconds and, if it changed, a new
+    # snapshot is published, every worker builds its index from it, and only then is
+    # it swapped in, so with two or more workers no query waits on an index build.
+    # Workers are forked, and a fork copies only the forking thread: a lock another
+    # thread holds at that moment stays held in the child. spawn() forks them all
+    # before bot.py starts any thread. If the pool breaks (a worker killed), queries
+    # fall back to threads and a new pool is forked from the now threaded process;
+    # its workers only run the functions above, which take no locks.
+
+    def __init__(self, catalog, workers, refresh_delay=30.0):
+        self.catalog = catalog
+        self.workers = workers
+        self.refresh_delay = refresh_delay
+        self.refreshes = 0
+        self.fallbacks = 0
+        self.restarts = 0
+        self._executor = None
+        self._restart_task = None
+        self._snapshot = None
+        self._segments = []
+        self._version = None
+        self._task = None
+
+    def spawn(self):
+        # fork: spawn/forkserver would re-import bot.py as __main__ in every worker. With
+        # fork the executor starts all workers on the first submit, so they exist on return.
+        # The resource tracker is started first so the workers inherit it (see _attach).
+        resource_tracker.ensure_running()
+        self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("fork"))
+        self._executor.submit(os.getpid).result()
+
+    async def start(self):
+        if self._executor is None:
+            self.spawn()
+        # Nothing is querying yet, so every worker builds at once
+        await self.refresh(parallel=True)
+        self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_delay)
+            if self.catalog.version != self._version:
+                try:
+                    await self.refresh()
+                except Exception as e:
+                    print(f"Fuzzy snapshot refresh failed: {e}")
+
+    async def refresh(self, parallel=False):
+        version = self.catalog.version
+        start = time.perf_counter()
+        data = await asyncio.to_thread(lambda: pickle.dumps(self.catalog.fuzzy_entries(), protocol=pickle.HIGHEST_PROTOCOL))
+        shm = shared_memory.SharedMemory(create=True, size=max(1, len(data)))
+        shm.buf[:len(data)] = data
+        snapshot = (shm.name, len(data), version)
+        self._segments.append(shm)
+        await self._warm(snapshot, parallel)
+        self._snapshot = snapshot
+        self._version = version
+        # The previous segment stays until the next swap for queries already in flight
+        while len(self._segments) > 2:
+            old = self._segments.pop(0)
+            old.close()
+            old.unlink()
+        self.refreshes += 1
+        print(f"Fuzzy snapshot {version} published ({len(data) / 1e6:.1f} MB) in {time.perf_counter() - start:.2f}s")
+
+    async def _warm(self, snapshot, parallel, attempts=5):
+        # Serially, one build at a time, the other workers keep answering queries. The
+        # executor hands each task to whichever worker is free, so this repeats until
+        # every worker has reported in; one that has the snapshot returns at once.
+        loop = asyncio.get_running_loop()
+        batch = self.workers if parallel else 1
+        warmed = set()
+        for _ in range(attempts * self.workers // batch):
+            warmed.update(await asyncio.gather(*(
+                loop.run_in_executor(self._executor, _worker_warm, snapshot) for _ in range(batch)
+            )))
+            if len(warmed) >= self.workers:
+                return
+
+    async def search(self, query_clean, limit=5, score_cutoff=70, language=None):
+        try:
+            matches = await asyncio.get_running_loop().run_in_executor(
+                self._executor, _worker_search, self._snapshot, query_clean, limit, score_cutoff, language
+            )
+        except (BrokenProcessPool, OSError) as e:
+            if self._restart_task is None or self._restart_task.done():
+                print(f"Fuzzy worker pool failed, restarting it: {e!r}")
+                self._restart_task = asyncio.create_task(self._restart())
+            matches = None
+        if matches is None:
+            self.fallbacks += 1
+            matches = await asyncio.to_thread(self.catalog.fuzzy, query_clean, limit, score_cutoff, language)
+        return matches
+
+    async def _restart(self):
+        broken = self._executor
+        self.spawn()
+        broken.shutdown(wait=False, cancel_futures=True)
+        try:
+            await self._warm(self._snapshot, parallel=True)
+        except Exception as e:
+            print(f"Fuzzy worker pool warm-up failed: {e}")
+        self.restarts += 1
+
+    def queue_depth(self):
+        return len(self._executor._pending_work_items) if self._executor else 0
+
+    async def stop(self):
+        for task in (self._task, self._restart_task):
+            if task:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        if self._executor:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        for shm in self._segments:
+            shm.close()
+            shm.unlink()
+        self._segments = []
@@ -0,0 +1,436 @@
+# End-to-end load test: bot.py's real handlers, filters and handler groups, driven by
+# a fake Telegram client against a local Mongo. Nothing is sent to Telegram.
+#
+#   python loadtest.py --rate 200 --duration 30                         # synthetic traffic
+#   python loadtest.py --rate 500 --latency 0.08 --flood 0.001          # slower API, some FloodWaits
+#   python loadtest.py --duration 60 --record traffic.jsonl             # save the generated stream
+#   python loadtest.py --replay traffic.jsonl --rate 0                  # replay it with its own timing
+#
+# Uses a separate database (movie_bot_loadtest by default), dropped before and after the run.
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import string
+import time
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, UTC
+from itertools import accumulate
+from types import SimpleNamespace
+
+import pyrogram
+from pyrogram.enums import ChatType
+from pyrogram.errors import FloodWait
+from pyrogram.handlers import CallbackQueryHandler, InlineQueryHandler, MessageHandler
+from pyrogram.types import CallbackQuery, Chat, InlineKeyboardButton, InlineKeyboardMarkup, Message, User
+from pymongo import AsyncMongoClient
+
+from benchmark import git_commit, make_catalog, percentile, typo
+from catalog import STOPWORDS
+
+DEFAULT_MIX = "search=45,group=20,watch=20,popular=4,favorite=4,rate=4,post=2,broadcast=0.05"
+BOT_ENV = {
+    "API_ID": "1",
+    "API_HASH": "loadtest",
+    "BOT_TOKEN": "1:loadtest",
+    "CHANNEL_ID": "-1001000000001",
+    "ADMIN_IDS": "1"
+}
+
+
+class FakeClient:
+    # Stands in for pyrogram.Client. Handlers are collected per group the way the real
+    # client does it; every other attribute is an API method that waits a simulated
+    # round trip, may raise FloodWait, and is counted.
+    latency = 0.05
+    jitter = 0.5
+    flood_rate = 0.0
+    flood_seconds = 3
+    rng = random.Random(0)
+
+    def __init__(self, *args, **kwargs):
+        self.groups = {}
+        self.me = SimpleNamespace(id=1, username="loadtest_bot", first_name="Load test")
+        self.calls = Counter()
+        self.flood_waits = Counter()
+        # Handler.check runs plain (non-async) filters on client.executor
+        self.executor = ThreadPoolExecutor(max_workers=4)
+        self.loop = None
+        self._next_id = 10 ** 9
+
+    def _add(self, handler, group):
+        self.groups.setdefault(group, []).append(handler)
+        self.groups = dict(sorted(self.groups.items()))
+
+    def on_message(self, filters=None, group=0):
+        def decorator(func):
+            self._add(MessageHandler(func, filters), group)
+            return func
+        return decorator
+
+    def on_callback_query(self, filters=None, group=0):
+        def decorator(func):
+            self._add(CallbackQueryHandler(func, filters), group)
+            return func
+        return decorator
+
+    def on_inline_query(self, filters=None, group=0):
+        def decorator(func):
+            self._add(InlineQueryHandler(func, filters), group)
+            return func
+        return decorator
+
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+
+    async def stop(self):
+        self.executor.shutdown(wait=False)
+
+    def __getattr__(self, method):
+        if method.startswith("_"):
+            raise AttributeError(method)
+
+        async def call(*args, **kwargs):
+            return await self._call(method, args, kwargs)
+        return call
+
+    async def _call(self, method, args, kwargs):
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency * self.rng.uniform(1 - self.jitter, 1 + self.jitter))
+        if self.flood_rate and self.rng.random() < self.flood_rate:
+            self.flood_waits[method] += 1
+            raise FloodWait(value=self.flood_seconds)
+        if method.startswith(("send_", "copy_", "edit_", "forward_")):
+            return self.message(kwargs.get("chat_id", args[0] if args else 0))
+        return True
+
+    def next_id(self):
+        self._next_id += 1
+        return self._next_id
+
+    def message(self, chat_id, **fields):
+        return Message(client=self, id=fields.pop("id", None) or self.next_id(), chat=self.chat(chat_id), date=datetime.now(), **fields)
+
+    def chat(self, chat_id):
+        if chat_id == int(os.environ["CHANNEL_ID"]):
+            chat_type = ChatType.CHANNEL
+        else:
+            chat_type = ChatType.PRIVATE if chat_id > 0 else ChatType.SUPERGROUP
+        return Chat(client=self, id=chat_id, type=chat_type)
+
+
+class Lifecycle:
+    # Replaces pyrogram.idle: bot.main() reports ready and waits here until the run is over
+    ready = None
+    finished = None
+
+    @classmethod
+    async def idle(cls):
+        cls.ready.set()
+        await cls.finished.wait()
+
+
+async def dispatch(client, update):
+    # Pyrogram's Dispatcher.handler_worker rules: groups in order, at most one handler
+    # per group, StopPropagation ends the update. Returns (last handler run, error).
+    kind = CallbackQueryHandler if isinstance(update, CallbackQuery) else MessageHandler
+    ran, error = None, None
+    try:
+        for handlers in list(client.groups.values()):
+            for handler in handlers:
+                if not isinstance(handler, kind):
+                    continue
+                try:
+                    if not await handler.check(client, update):
+                        continue
+                except Exception as e:
+                    error = f"filter: {e!r}"
+                    continue
+                ran = handler.callback.__name__
+                try:
+                    await handler.callback(client, update)
+                except pyrogram.ContinuePropagation:
+                    continue
+                except pyrogram.StopPropagation:
+                    raise
+                except Exception as e:
+                    error = repr(e)
+                break
+    except pyrogram.StopPropagation:
+        pass
+    return ran, error
+
+
+def synthetic_stream(movies, args, rng, admin_id):
+    mix = {kind: float(weight) for kind, weight in (item.split("=") for item in args.mix.split(","))}
+    kinds, weights = list(mix), list(mix.values())
+    # Watch links follow a Zipf-like curve: a few titles get most of the clicks
+    watch_weights = list(accumulate(1 / rank for rank in range(1, len(movies) + 1)))
+    chatter = sorted(STOPWORDS)
+    next_post = max(movie["message_id"] for movie in movies) + 1
+    count = int(args.rate * args.duration)
+
+    for i in range(count):
+        kind = rng.choices(kinds, weights)[0]
+        user_id = 10 ** 6 + rng.randrange(args.users)
+        movie = rng.choice(movies)
+        event = {"at": round(i / args.rate, 6), "kind": "message", "chat": "private", "user_id": user_id}
+        if kind == "search":
+            roll = rng.random()
+            if roll < 0.7:
+                event["text"] = " ".join(movie["name"].split()[:rng.randint(1, 3)])
+            elif roll < 0.9:
+                event["text"] = typo(movie["name"].lower(), rng)
+            else:
+                event["text"] = "".join(rng.choice(string.ascii_lowercase) for _ in range(8))
+        elif kind == "group":
+            event["chat"] = "group"
+            event["chat_id"] = -10 ** 12 - rng.randrange(args.groups)
+            event["text"] = movie["name"] if rng.random() < 0.3 else " ".join(rng.sample(chatter, 3))
+        elif kind == "watch":
+            watched = rng.choices(movies, cum_weights=watch_weights)[0]
+            event["text"] = f"/start watch_{watched['message_id']}"
+        elif kind == "popular":
+            event["text"] = "/popular"
+        elif kind == "favorite":
+            event.update(kind="callback", data=f"toggle_favorite_{movie['message_id']}")
+        elif kind == "rate":
+            event.update(kind="callback", data=f"{rng.choice(['like', 'dislike'])}_{movie['message_id']}_{user_id}")
+        elif kind == "post":
+            name = " ".join(rng.sample(movie["name"].split(), len(movie["name"].split())))
+            event.update(chat="channel", user_id=None, message_id=next_post, text=f"{name} ({rng.randint(1990, 2025)}) Hindi 720p")
+            next_post += 1
+        elif kind == "broadcast":
+            event.update(user_id=admin_id, text=f"/broadcast Load test broadcast {i}")
+        yield event
+
+
+def build_update(client, event, channel_id):
+    user = User(client=client, id=event["user_id"], first_name=f"user{event['user_id']}", is_bot=False) if event.get("user_id") else None
+    if event["kind"] == "callback":
+        # The button that was pressed, on a message in the user's private chat
+        markup = InlineKeyboardMarkup([[InlineKeyboardButton("·", callback_data=event["data"])]])
+        message = client.message(event["user_id"], text="·", reply_markup=markup)
+        return CallbackQuery(client=client, id=str(client.next_id()), from_user=user, chat_instance="loadtest", message=message, data=event["data"])
+    chat_id = {"private": event.get("user_id"), "group": event.get("chat_id"), "channel": channel_id}[event["chat"]]
+    return client.message(chat_id, id=event.get("message_id"), from_user=user, text=event["text"])
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        "count": len(latencies),
+        "p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "p95_ms": round(percentile(latencies, 0.95) * 1000, 3),
+        "p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else 0.0
+    }
+
+
+async def watch_loop_lag(samples, interval=0.05):
+    while True:
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, time.perf_counter() - start - interval))
+
+
+async def replay(client, events, args, channel_id):
+    queue = asyncio.Queue()
+    latencies = defaultdict(list)
+    end_to_end = []
+    errors = Counter()
+    error_samples = {}
+    completed = []
+
+    async def worker():
+        # One update at a time per worker, like pyrogram's handler workers
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            due, update = item
+            start = time.perf_counter()
+            name, error = await dispatch(client, update)
+            finish = time.perf_counter()
+            name = name or "unhandled"
+            latencies[name].append(finish - start)
+            end_to_end.append(finish - due)
+            completed.append(finish)
+            if error:
+                errors[name] += 1
+                error_samples.setdefault(name, error)
+
+    workers = [asyncio.create_task(worker()) for _ in range(args.workers)]
+    start = time.perf_counter()
+    offered = 0
+    for i, event in enumerate(events):
+        due = start + (i / args.rate if args.rate else event["at"])
+        delay = due - time.perf_counter()
+        # Yield even when behind schedule so the workers keep up with the generator
+        await asyncio.sleep(max(0.0, delay))
+        queue.put_nowait((due, build_update(client, event, channel_id)))
+        offered += 1
+    offered_until = time.perf_counter()
+
+    backlog = 0
+    for _ in workers:
+        queue.put_nowait(None)
+    try:
+        await asyncio.wait_for(asyncio.gather(*workers), args.drain)
+    except asyncio.TimeoutError:
+        backlog = queue.qsize()
+    finished = time.perf_counter()
+
+    window = offered_until - start
+    in_window = sum(1 for moment in completed if moment <= offered_until)
+    return {
+        "offered": offered,
+        "offered_per_sec": round(offered / window, 1) if window else 0.0,
+        "handled": len(completed),
+        "sustained_per_sec": round(in_window / window, 1) if window else 0.0,
+        "overall_per_sec": round(len(completed) / (finished - start), 1),
+        "backlog_after_drain": backlog,
+        "handlers": {name: {**summarize(values), "errors": errors[name], "error": error_samples.get(name)} for name, values in sorted(latencies.items())},
+        "end_to_end": summarize(end_to_end)
+    }
+
+
+async def seed(bot, args, rng):
+    movies = make_catalog(args.movies, rng)
+    start = time.perf_counter()
+    # Inserted directly: bulk_upsert would reset the synthetic views_count on insert
+    docs = [{**{key: value for key, value in movie.items() if key != "name"}, "likes": 0, "dislikes": 0} for movie in movies]
+    for i in range(0, len(docs), 10000):
+        batch = docs[i:i + 10000]
+        await bot.db.run(lambda: bot.db.movies_col.insert_many(batch, ordered=False), idempotent=False)
+    print(f"Seeded {len(movies)} movies in {time.perf_counter() - start:.1f}s")
+    return movies
+
+
+async def run(args):
+    import bot
+
+    if bot.DATABASE_NAME == "movie_bot":
+        raise SystemExit("Refusing to run against the production database name; pass --database")
+    client = bot.app
+    rng = random.Random(args.seed)
+
+    await bot.db.client.drop_database(bot.DATABASE_NAME)
+    movies = await seed(bot, args, rng)
+
+    if args.replay:
+        with open(args.replay) as f:
+            events = [json.loads(line) for line in f if line.strip()]
+    else:
+        events = list(synthetic_stream(movies, args, rng, bot.ADMIN_IDS[0]))
+    if args.record:
+        with open(args.record, "w") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+        print(f"Recorded {len(events)} updates to {args.record}")
+
+    Lifecycle.ready, Lifecycle.finished = asyncio.Event(), asyncio.Event()
+    main_task = asyncio.create_task(bot.main())
+    ready = asyncio.create_task(Lifecycle.ready.wait())
+    await asyncio.wait([main_task, ready], return_when=asyncio.FIRST_COMPLETED)
+    if main_task.done():
+        main_task.result()
+
+    lag = []
+    lag_task = asyncio.create_task(watch_loop_lag(lag))
+    print(f"Replaying {len(events)} updates with {args.workers} workers, "
+          f"simulated API latency {args.latency * 1000:.0f} ms, FloodWait rate {args.flood}")
+    results = await replay(client, events, args, bot.CHANNEL_ID)
+    lag_task.cancel()
+
+    Lifecycle.finished.set()
+    await main_task
+    results["event_loop_lag"] = summarize(lag)
+    results["telegram_calls"] = dict(client.calls.most_common())
+    results["flood_waits"] = dict(client.flood_waits)
+    results["rate_limited"] = {f"{kind}/{scope}": count for (kind, scope), count in bot.update_limiter.dropped.items()}
+
+    if not args.keep:
+        # bot.main() closed its client on shutdown, after the last buffered writes
+        cleanup = AsyncMongoClient(args.mongo)
+        try:
+            await cleanup.drop_database(bot.DATABASE_NAME)
+        finally:
+            await cleanup.close()
+    return results
+
+
+def report(results):
+    print(f"\noffered {results['offered']} updates at {results['offered_per_sec']}/s; "
+          f"sustained {results['sustained_per_sec']}/s, overall {results['overall_per_sec']}/s, "
+          f"{results['backlog_after_drain']} left after drain")
+    print(f"{'handler':>24} {'count':>7} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} {'errors':>7}")
+    for name, stats in results["handlers"].items():
+        print(f"{name:>24} {stats['count']:7d} {stats['p50_ms']:9.2f} {stats['p95_ms']:9.2f} {stats['p99_ms']:9.2f} {stats['errors']:7d}")
+    for name, stats in results["handlers"].items():
+        if stats["error"]:
+            print(f"  {name}: {stats['error']}")
+    e2e, lag = results["end_to_end"], results["event_loop_lag"]
+    print(f"{'end-to-end':>24} {e2e['count']:7d} {e2e['p50_ms']:9.2f} {e2e['p95_ms']:9.2f} {e2e['p99_ms']:9.2f}")
+    print(f"event loop lag: p50 {lag['p50_ms']:.2f} ms, p99 {lag['p99_ms']:.2f} ms, max {lag['max_ms']:.2f} ms")
+    print("telegram calls: " + ", ".join(f"{method} {count}" for method, count in results["telegram_calls"].items()))
+    if results["flood_waits"]:
+        print("flood waits: " + ", ".join(f"{method} {count}" for method, count in results["flood_waits"].items()))
+    if results["rate_limited"]:
+        print("rate limited: " + ", ".join(f"{scope} {count}" for scope, count in results["rate_limited"].items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay traffic through bot.py's handlers with a fake Telegram client.")
+    parser.add_argument("--mongo", default=os.getenv("DATABASE_URL", "mongodb://localhost:27017"))
+    parser.add_argument("--database", default="movie_bot_loadtest", help="dropped before and after the run")
+    parser.add_argument("--keep", action="store_true", help="keep the database after the run")
+    parser.add_argument("--movies", type=int, default=20000, help="synthetic catalog size")
+    parser.add_argument("--rate", type=float, default=100, help="updates per second; 0 replays recorded timing")
+    parser.add_argument("--duration", type=float, default=30, help="seconds of synthetic traffic")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help="relative weight per update kind")
+    parser.add_argument("--users", type=int, default=50000, help="distinct synthetic users")
+    parser.add_argument("--groups", type=int, default=50, help="distinct synthetic groups")
+    parser.add_argument("--workers", type=int, default=min(32, (os.cpu_count() or 1) + 4), help="concurrent updates, as pyrogram's workers")
+    parser.add_argument("--latency", type=float, default=0.05, help="mean simulated Telegram API latency in seconds")
+    parser.add_argument("--jitter", type=float, default=0.5, help="latency varies by +/- this fraction")
+    parser.add_argument("--flood", type=float, default=0.0, help="probability that an API call raises FloodWait")
+    parser.add_argument("--flood-seconds", type=int, default=3)
+    parser.add_argument("--drain", type=float, default=30, help="seconds to wait for queued updates after the last one")
+    parser.add_argument("--replay", help="JSONL update stream to replay instead of synthetic traffic")
+    parser.add_argument("--record", help="write the update stream to this JSONL file")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", help="write results as JSON to this file")
+    args = parser.parse_args()
+    if not args.rate and not args.replay:
+        parser.error("--rate 0 needs --replay")
+
+    # bot.py reads its config and builds its Client at import time
+    for name, value in BOT_ENV.items():
+        os.environ.setdefault(name, value)
+    os.environ["DATABASE_URL"] = args.mongo
+    os.environ["DATABASE_NAME"] = args.database
+    FakeClient.latency = args.latency
+    FakeClient.jitter = args.jitter
+    FakeClient.flood_rate = args.flood
+    FakeClient.flood_seconds = args.flood_seconds
+    FakeClient.rng = random.Random(args.seed)
+    pyrogram.Client = FakeClient
+    pyrogram.idle = Lifecycle.idle
+
+    results = asyncio.run(run(args))
+    report(results)
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"commit": git_commit(), "timestamp": datetime.now(UTC).isoformat(), "args": vars(args), "results": results}, f, indent=2)
+        print(f"\nResults written to {args.out}")
+    # bot.py's health-check server runs on a non-daemon thread
+    os._exit(0)
+
+
+if __name__ == "__main__":
+    main()
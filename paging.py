@@ -0,0 +1,24 @@
+from bisect import bisect_left, bisect_right
+
+# Telegram rejects a whole keyboard if one button's callback_data exceeds 64 bytes
+CALLBACK_DATA_LIMIT = 64
+
+
+def keyset_page(items, key, size, after=None, before=None):
+    # items are sorted ascending by key(item). `after`/`before` are the keys of the
+    # last/first item on the current page, so a page stays put when items are
+    # added or removed elsewhere in the list. Returns (page, has_prev, has_next).
+    keys = [key(item) for item in items]
+    if after is not None:
+        start = bisect_right(keys, after)
+        end = start + size
+    elif before is not None:
+        end = bisect_left(keys, before)
+        start = max(0, end - size)
+    else:
+        start, end = 0, size
+    return items[start:end], start > 0, end < len(items)
+
+
+def fits(callback_data):
+    return len(callback_data.encode()) <= CALLBACK_DATA_LIMIT
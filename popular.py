@@ -0,0 +1,106 @@
+from collections import Counter
+from datetime import datetime, UTC, timedelta
+
+WINDOWS = ("today", "week", "all")
+WEEK_DAYS = 7
+
+
+def utc_day(now=None):
+    return (now or datetime.now(UTC)).strftime("%Y-%m-%d")
+
+
+class TopList:
+    # Top `capacity` ids of a Counter. Counts only grow between rebuilds, so an id
+    # outside the list can only enter it by overtaking the current last entry.
+
+    def __init__(self, counts, capacity):
+        self.counts = counts
+        self.capacity = capacity
+        self.ids = []
+        self.rebuild()
+
+    def _key(self, message_id):
+        return (-self.counts[message_id], message_id)
+
+    def rebuild(self):
+        self.ids = sorted((mid for mid, count in self.counts.items() if count > 0), key=self._key)[:self.capacity]
+
+    def bump(self, message_id):
+        if message_id in self.ids:
+            self.ids.sort(key=self._key)
+        elif len(self.ids) < self.capacity or self._key(message_id) < self._key(self.ids[-1]):
+            self.ids.append(message_id)
+            self.ids.sort(key=self._key)
+            del self.ids[self.capacity:]
+
+    def discard(self, message_id):
+        if message_id in self.ids:
+            # The next best id is unknown, so fall back to a full rebuild (rare)
+            self.rebuild()
+
+
+class PopularBoard:
+    # Materialized /popular lists for today, the last 7 days and all time,
+    # updated on every view instead of sorting the collection per request.
+
+    def __init__(self, capacity=100):
+        self.capacity = capacity
+        self.day = utc_day()
+        self.days = {}
+        self.counts = {"today": Counter(), "week": Counter(), "all": Counter()}
+        self.tops = {window: TopList(self.counts[window], capacity) for window in WINDOWS}
+
+    def load(self, all_time, daily):
+        # all_time: {message_id: views_count}; daily: [(day, message_id, count), ...]
+        self.day = utc_day()
+        self.counts["all"].clear()
+        self.counts["all"].update(all_time)
+        self.days = {}
+        for day, message_id, count in daily:
+            self.days.setdefault(day, Counter())[message_id] += count
+        self._roll_windows()
+
+    def _roll_windows(self):
+        oldest = utc_day(datetime.strptime(self.day, "%Y-%m-%d").replace(tzinfo=UTC) - timedelta(days=WEEK_DAYS - 1))
+        self.days = {day: counts for day, counts in self.days.items() if day >= oldest}
+        self.counts["today"].clear()
+        self.counts["today"].update(self.days.get(self.day, {}))
+        self.counts["week"].clear()
+        for counts in self.days.values():
+            self.counts["week"].update(counts)
+        for top in self.tops.values():
+            top.rebuild()
+
+    def _check_day(self):
+        today = utc_day()
+        if today != self.day:
+            self.day = today
+            self._roll_windows()
+
+    def record_view(self, message_id, count=1):
+        self._check_day()
+        self.days.setdefault(self.day, Counter())[message_id] += count
+        for window in WINDOWS:
+            self.counts[window][message_id] += count
+            self.tops[window].bump(message_id)
+
+    def views(self, message_id, window="all"):
+        return self.counts[window].get(message_id, 0)
+
+    def top(self, window="all", limit=10):
+        self._check_day()
+        top = self.tops[window]
+        return [(message_id, top.counts[message_id]) for message_id in top.ids[:limit]]
+
+    def remove(self, message_id):
+        for counts in self.days.values():
+            counts.pop(message_id, None)
+        for window in WINDOWS:
+            self.counts[window].pop(message_id, None)
+            self.tops[window].discard(message_id)
+
+    def clear(self):
+        self.days = {}
+        for window in WINDOWS:
+            self.counts[window].clear()
+            self.tops[window].rebuild()
@@ -0,0 +1,69 @@
+import time
+from collections import Counter, OrderedDict
+
+
+class TokenBuckets:
+    # One token bucket per key, refilled at `rate` tokens per second up to `burst`.
+    # Buckets live in an LRU of at most `maxsize` keys; an evicted key simply comes
+    # back with a full bucket, so memory stays bounded whatever the traffic.
+
+    def __init__(self, rate, burst, maxsize=50000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def _tokens(self, entry, now):
+        if entry is None:
+            return self.burst
+        tokens, last = entry
+        return min(self.burst, tokens + (now - last) * self.rate)
+
+    def has(self, key, cost=1, now=None):
+        # allow() without taking the tokens
+        now = time.monotonic() if now is None else now
+        return self._tokens(self._buckets.get(key), now) >= cost
+
+    def allow(self, key, cost=1, now=None):
+        now = time.monotonic() if now is None else now
+        tokens = self._tokens(self._buckets.pop(key, None), now)
+        allowed = tokens >= cost
+        if allowed:
+            tokens -= cost
+        self._buckets[key] = (tokens, now)
+        if len(self._buckets) > self.maxsize:
+            self._buckets.popitem(last=False)
+        return allowed
+
+
+class UpdateLimiter:
+    # Per-user and per-chat buckets in front of every handler. A private chat has the
+    # user's id, so only group chats are charged to the chat bucket. An update takes
+    # a token from each bucket only if both have one, so a flooding user doesn't
+    # drain their group's bucket and a busy group doesn't drain its users'.
+
+    def __init__(self, user_rate=1.0, user_burst=5, chat_rate=3.0, chat_burst=20, maxsize=50000):
+        self.users = TokenBuckets(user_rate, user_burst, maxsize)
+        self.chats = TokenBuckets(chat_rate, chat_burst, maxsize)
+        self.dropped = Counter()
+
+    def __len__(self):
+        return len(self.users) + len(self.chats)
+
+    def check(self, kind, user_id, chat_id=None):
+        # Returns None if the update may proceed, otherwise the scope that dropped it
+        now = time.monotonic()
+        group = chat_id is not None and chat_id != user_id
+        if group and not self.chats.has(chat_id, now=now):
+            scope = "chat"
+        elif user_id is not None and not self.users.allow(user_id, now=now):
+            scope = "user"
+        else:
+            if group:
+                self.chats.allow(chat_id, now=now)
+            return None
+        self.dropped[(kind, scope)] += 1
+        return scope
@@ -0,0 +1,149 @@
+import asyncio
+import time
+from datetime import datetime, UTC
+
+from pyrogram.errors import FloodWait
+
+from catalog import movie_from_post
+
+# get_messages accepts at most 200 ids per call
+PAGE_SIZE = 200
+STATE_KEY = "reindex"
+
+
+class Reindexer:
+    # Rebuilds the movies collection from the channel. Bots can't read chat history,
+    # so the channel is walked by message id in pages of 200 and written back in
+    # unordered bulk upserts. The cursor lives in settings so a restart resumes it.
+
+    def __init__(self, client, db, channel_id, batch_size=1000, max_empty_pages=10, progress_interval=15, on_done=None):
+        self.client = client
+        self.db = db
+        self.channel_id = channel_id
+        self.batch_size = batch_size
+        # Past the newest known post, this many empty pages in a row means the end
+        self.max_empty_pages = max_empty_pages
+        self.progress_interval = progress_interval
+        # Awaited after a run completes, to reload the in-memory indexes
+        self.on_done = on_done
+        self._task = None
+
+    @property
+    def running(self):
+        return self._task is not None and not self._task.done()
+
+    async def start(self, admin_chat_id=None, from_id=1, to_id=None):
+        progress_message_id = None
+        if admin_chat_id is not None:
+            m = await self.client.send_message(admin_chat_id, "🔄 রিইনডেক্স শুরু হচ্ছে...")
+            progress_message_id = m.id
+        state = {
+            "next_id": max(1, from_id),
+            "to_id": to_id,
+            "known_max_id": await self.db.movies.max_message_id(),
+            "empty_pages": 0,
+            "scanned": 0,
+            "saved": 0,
+            "new": 0,
+            "admin_chat_id": admin_chat_id,
+            "progress_message_id": progress_message_id,
+            "started": datetime.now(UTC)
+        }
+        await self.db.settings.set(STATE_KEY, state)
+        self._spawn(state)
+
+    async def resume(self):
+        state = await self.db.settings.get(STATE_KEY)
+        if state and not self.running:
+            print(f"Resuming reindex from message {state['next_id']}")
+            self._spawn(state)
+
+    def _spawn(self, state):
+        self._task = asyncio.create_task(self._run(state))
+
+    async def _fetch(self, message_ids):
+        while True:
+            try:
+                return await self.client.get_messages(self.channel_id, message_ids)
+            except FloodWait as e:
+                print(f"FloodWait during reindex, pausing for {e.value}s")
+                await asyncio.sleep(e.value)
+
+    def _finished(self, state):
+        if state["to_id"] is not None:
+            return state["next_id"] > state["to_id"]
+        return state["next_id"] > state["known_max_id"] and state["empty_pages"] >= self.max_empty_pages
+
+    async def _run(self, state):
+        pending = []
+        last_report = time.monotonic()
+        try:
+            while not self._finished(state):
+                last_id = state["next_id"] + PAGE_SIZE - 1
+                if state["to_id"] is not None:
+                    last_id = min(last_id, state["to_id"])
+                messages = await self._fetch(list(range(state["next_id"], last_id + 1)))
+
+                page = [
+                    movie_from_post(m.id, m.text or m.caption, m.date)
+                    for m in messages if not m.empty and (m.text or m.caption)
+                ]
+                pending.extend(page)
+                state["empty_pages"] = 0 if any(not m.empty for m in messages) else state["empty_pages"] + 1
+                state["scanned"] += len(messages)
+                state["next_id"] = last_id + 1
+
+                if len(pending) >= self.batch_size or self._finished(state):
+                    state["new"] += await self.db.movies.bulk_upsert(pending)
+                    state["saved"] += len(pending)
+                    pending = []
+                    # Only checkpoint what has been written, so a resume never skips posts
+                    await self.db.settings.set(STATE_KEY, state)
+
+                if time.monotonic() - last_report >= self.progress_interval:
+                    last_report = time.monotonic()
+                    await self._report(state, done=False)
+
+            await self.db.settings.delete(STATE_KEY)
+            if self.on_done:
+                await self.on_done()
+            await self._report(state, done=True)
+        except asyncio.CancelledError:
+            # The cursor stays in settings so the run resumes on the next start
+            raise
+        except Exception as e:
+            print(f"Reindex stopped at message {state['next_id']}: {e}")
+            await self._report(state, done=False, error=e)
+
+    async def _report(self, state, done, error=None):
+        if state.get("admin_chat_id") is None:
+            return
+        if error is not None:
+            header = f"⚠️ রিইনডেক্স থেমে গেছে: {error}\nআবার চালু করতে /reindex resume দিন।"
+        elif done:
+            header = "✅ রিইনডেক্স সম্পন্ন হয়েছে।"
+        else:
+            header = "🔄 রিইনডেক্স চলছে..."
+        text = (
+            f"{header}\n\n"
+            f"পরবর্তী মেসেজ আইডি: {state['next_id']}\n"
+            f"স্ক্যান করা হয়েছে: {state['scanned']}\n"
+            f"সেভ করা মুভি: {state['saved']} (নতুন {state['new']})"
+        )
+        try:
+            if state.get("progress_message_id"):
+                await self.client.edit_message_text(state["admin_chat_id"], state["progress_message_id"], text)
+            else:
+                await self.client.send_message(state["admin_chat_id"], text)
+        except Exception as e:
+            print(f"Could not report reindex progress: {e}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def cancel(self):
+        # Stops the run for good instead of leaving it to resume
+        await self.stop()
+        await self.db.settings.delete(STATE_KEY)
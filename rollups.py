@@ -0,0 +1,159 @@
+import asyncio
+from collections import Counter
+from datetime import datetime, UTC, timedelta
+
+from pymongo import UpdateOne
+
+# Counted from the hot paths through WriteBuffer.count
+EVENTS = ("searches", "direct", "fuzzy", "no_result", "watches", "new_users", "broadcasts")
+
+# Minute buckets are written by the write buffer and rolled up into hour and day
+# buckets here. Finer buckets expire through the TTL index on `expires`; day
+# buckets and the all-time totals document are kept.
+RETENTION = {"minute": timedelta(days=2), "hour": timedelta(days=35)}
+TOTALS_ID = "totals"
+
+
+def bucket_start(moment, scale):
+    if scale == "minute":
+        return moment.replace(second=0, microsecond=0)
+    if scale == "hour":
+        return moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def _bucket_id(scale, start):
+    # e.g. "hour:2025-05-16T05:00"
+    return f"{scale}:{start:%Y-%m-%dT%H:%M}"
+
+
+def _bucket_fields(scale, start):
+    fields = {"scale": scale, "start": start}
+    if scale in RETENTION:
+        fields["expires"] = start + RETENTION[scale]
+    return fields
+
+
+def bucket_update(scale, start, counts, touched=None):
+    # Adds to a bucket. `touched` marks a minute bucket as changed since it was last
+    # folded into its hour (see StatsRollups.compact).
+    update = {"$inc": {f"counts.{event}": count for event, count in counts.items()}, "$setOnInsert": _bucket_fields(scale, start)}
+    if touched is not None:
+        update["$max"] = {"touched": touched}
+    return UpdateOne({"_id": _bucket_id(scale, start)}, update, upsert=True)
+
+
+def bucket_set(scale, start, counts):
+    # Replaces a bucket's counts with a recomputed total, so folding twice is harmless
+    return UpdateOne(
+        {"_id": _bucket_id(scale, start)},
+        {"$set": {"counts": dict(counts), **_bucket_fields(scale, start)}},
+        upsert=True
+    )
+
+
+def totals_update(counts):
+    return UpdateOne({"_id": TOTALS_ID}, {"$inc": {f"counts.{event}": count for event, count in counts.items()}}, upsert=True)
+
+
+def _sum(docs, since, until=None):
+    total = Counter()
+    for doc in docs:
+        start = doc["start"].replace(tzinfo=UTC)
+        if start >= since and (until is None or start < until):
+            total.update(doc.get("counts", {}))
+    return total
+
+
+class StatsRollups:
+    # Every `interval` seconds, recomputes the hour buckets that have changed minute
+    # buckets, and the day buckets of those hours, and $sets their totals; nothing is
+    # added, so a fold that is interrupted or repeated can't double count. A minute is
+    # changed when the write buffer's `touched` is newer than the `folded` stamp left
+    # here; the stamp trails the fold by `settle` seconds, so a flush still in flight
+    # while a fold reads is picked up by the next one.
+
+    def __init__(self, db, interval=300, settle=120):
+        self.db = db
+        self.interval = interval
+        self.settle = settle
+        self.compactions = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        while True:
+            try:
+                await self.compact()
+            except Exception as e:
+                print(f"Stats rollup failed: {e}")
+            await asyncio.sleep(self.interval)
+
+    async def compact(self):
+        now = datetime.now(UTC)
+        col = self.db.stats_col
+        changed = await self.db.run(lambda: col.find(
+            {"scale": "minute", "$or": [{"folded": {"$exists": False}}, {"$expr": {"$gt": ["$touched", "$folded"]}}]},
+            {"start": 1}
+        ).to_list(None))
+        if not changed:
+            return 0
+
+        # Hours whose first minutes have already expired can't be recomputed
+        oldest = bucket_start(now - RETENTION["minute"], "hour") + timedelta(hours=1)
+        hours = sorted({bucket_start(doc["start"].replace(tzinfo=UTC), "hour") for doc in changed})
+        hours = [hour for hour in hours if hour >= oldest]
+        if hours:
+            hour_counts = await self._sum_by("minute", "hour", hours, timedelta(hours=1))
+            await self.db.run(lambda: col.bulk_write([bucket_set("hour", hour, hour_counts[hour]) for hour in hours], ordered=False))
+            days = sorted({bucket_start(hour, "day") for hour in hours})
+            day_counts = await self._sum_by("hour", "day", days, timedelta(days=1))
+            await self.db.run(lambda: col.bulk_write([bucket_set("day", day, day_counts[day]) for day in days], ordered=False))
+
+        folded = now - timedelta(seconds=self.settle)
+        ids = [doc["_id"] for doc in changed]
+        await self.db.run(lambda: col.update_many({"_id": {"$in": ids}}, {"$max": {"folded": folded}}))
+        self.compactions += 1
+        return len(changed)
+
+    async def _sum_by(self, scale, into, starts, span):
+        # Totals of the `scale` buckets inside each of the `into` buckets in `starts`
+        docs = await self.db.run(lambda: self.db.stats_col.find(
+            {"scale": scale, "start": {"$gte": starts[0], "$lt": starts[-1] + span}}, {"start": 1, "counts": 1}
+        ).to_list(None))
+        totals = {start: Counter() for start in starts}
+        for doc in docs:
+            bucket = bucket_start(doc["start"].replace(tzinfo=UTC), into)
+            if bucket in totals:
+                totals[bucket].update(doc.get("counts", {}))
+        return totals
+
+    async def summary(self):
+        # Totals plus this period against the one before it, per window. Hour and day
+        # windows come from compacted buckets, so they trail by up to `interval`.
+        now = datetime.now(UTC)
+        hour, day = bucket_start(now, "hour"), bucket_start(now, "day")
+        totals, minutes, hours, days = await asyncio.gather(
+            self.db.run(lambda: self.db.stats_col.find_one({"_id": TOTALS_ID})),
+            self._buckets("minute", now - timedelta(hours=2)),
+            self._buckets("hour", hour - timedelta(hours=48)),
+            self._buckets("day", day - timedelta(days=14))
+        )
+        return {
+            "totals": Counter((totals or {}).get("counts", {})),
+            "hour": (_sum(minutes, now - timedelta(hours=1)), _sum(minutes, now - timedelta(hours=2), now - timedelta(hours=1))),
+            "day": (_sum(hours, hour - timedelta(hours=24)), _sum(hours, hour - timedelta(hours=48), hour - timedelta(hours=24))),
+            "week": (_sum(days, day - timedelta(days=7)), _sum(days, day - timedelta(days=14), day - timedelta(days=7)))
+        }
+
+    async def _buckets(self, scale, since):
+        return await self.db.run(lambda: self.db.stats_col.find(
+            {"scale": scale, "start": {"$gte": since}}, {"start": 1, "counts": 1}
+        ).to_list(None))
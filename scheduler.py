@@ -0,0 +1,132 @@
+import asyncio
+import heapq
+import time
+from datetime import datetime, UTC
+
+from pyrogram.errors import FloodWait
+
+# delete_messages accepts at most 100 ids per call
+DELETE_CHUNK = 100
+# Errors after which a message can never be deleted; anything else is retried
+PERMANENT_ERRORS = ("MESSAGE_ID_INVALID", "MESSAGE_DELETE_FORBIDDEN")
+# Seconds between attempts after a transient error, and attempts before giving up
+RETRY_DELAY = 30
+MAX_RETRIES = 5
+
+
+class DeleteScheduler:
+    # One heap of (due, chat_id, message_id) instead of one sleeping task per message.
+    # Due-times are mirrored to Mongo so deletions survive a restart. A row is only
+    # removed once its message is deleted or can never be; FloodWaits and transient
+    # errors push the message back onto the heap.
+
+    def __init__(self, client, db, delay=300, tick=1.0):
+        self.client = client
+        self.db = db
+        self.delay = delay
+        self.tick = tick
+        self.deleted_total = 0
+        self._heap = []
+        self._unsaved = []
+        self._retries = {}
+        self._task = None
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, chat_id, message_id, delay=None):
+        due = time.time() + (self.delay if delay is None else delay)
+        heapq.heappush(self._heap, (due, chat_id, message_id))
+        self._unsaved.append((due, chat_id, message_id))
+
+    async def recover(self):
+        # Anything already overdue is deleted on the first tick
+        entries = await self.db.auto_deletes.all()
+        for entry in entries:
+            heapq.heappush(self._heap, (entry["due"].replace(tzinfo=UTC).timestamp(), entry["chat_id"], entry["message_id"]))
+        print(f"Recovered {len(entries)} pending auto-deletes.")
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        await self._persist()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            try:
+                await self._persist()
+                await self._delete_due()
+            except Exception as e:
+                print(f"Auto-delete tick failed: {e}")
+
+    async def _persist(self):
+        if not self._unsaved:
+            return
+        unsaved, self._unsaved = self._unsaved, []
+        try:
+            await self.db.auto_deletes.add_many([
+                {"chat_id": chat_id, "message_id": message_id, "due": datetime.fromtimestamp(due, UTC)}
+                for due, chat_id, message_id in unsaved
+            ])
+        except Exception:
+            self._unsaved.extend(unsaved)
+            raise
+
+    async def _delete_due(self):
+        now = time.time()
+        due_by_chat = {}
+        while self._heap and self._heap[0][0] <= now:
+            _, chat_id, message_id = heapq.heappop(self._heap)
+            due_by_chat.setdefault(chat_id, []).append(message_id)
+        if not due_by_chat:
+            return
+
+        done = []
+        chunks = [
+            (chat_id, message_ids[i:i + DELETE_CHUNK])
+            for chat_id, message_ids in due_by_chat.items()
+            for i in range(0, len(message_ids), DELETE_CHUNK)
+        ]
+        for n, (chat_id, chunk) in enumerate(chunks):
+            try:
+                await self.client.delete_messages(chat_id, chunk)
+                self.deleted_total += len(chunk)
+                if self._retries:
+                    for message_id in chunk:
+                        self._retries.pop((chat_id, message_id), None)
+            except FloodWait as e:
+                # Nothing else goes out until the wait is over
+                print(f"FloodWait while auto-deleting, retrying in {e.value}s")
+                for waiting_chat_id, waiting in chunks[n:]:
+                    self._requeue(waiting_chat_id, waiting, now + e.value)
+                break
+            except Exception as e:
+                if not any(error in str(e) for error in PERMANENT_ERRORS):
+                    print(f"Error deleting messages {chunk} in chat {chat_id}: {e}")
+                    chunk = self._retry(chat_id, chunk, now + RETRY_DELAY)
+            done.extend((chat_id, message_id) for message_id in chunk)
+
+        if done:
+            await self.db.auto_deletes.remove_many(done)
+
+    def _requeue(self, chat_id, message_ids, due):
+        for message_id in message_ids:
+            heapq.heappush(self._heap, (due, chat_id, message_id))
+
+    def _retry(self, chat_id, message_ids, due):
+        # Requeues what still has attempts left; returns the ids given up on
+        given_up = []
+        for message_id in message_ids:
+            attempts = self._retries.get((chat_id, message_id), 0) + 1
+            if attempts > MAX_RETRIES:
+                self._retries.pop((chat_id, message_id), None)
+                given_up.append(message_id)
+            else:
+                self._retries[(chat_id, message_id)] = attempts
+                heapq.heappush(self._heap, (due, chat_id, message_id))
+        return given_up
@@ -0,0 +1,177 @@
+import asyncio
+import time
+
+from pymongo import ASCENDING
+from pymongo.errors import DuplicateKeyError, OperationFailure
+
+from catalog import analyze, request_key
+
+# Declared indexes per collection. Options compared against the server are the ones
+# listed in INDEX_OPTIONS; anything else Mongo reports (v, ns, background) is ignored.
+INDEXES = {
+    "movies": [
+        {"keys": [("message_id", ASCENDING)], "unique": True},
+        {"keys": [("language", ASCENDING)]},
+        {"keys": [("title_clean", ASCENDING)]},
+        {"keys": [("language", ASCENDING), ("title_clean", ASCENDING)]},
+        {"keys": [("views_count", ASCENDING)]},
+        {"keys": [("tokens", ASCENDING), ("language", ASCENDING)]},
+    ],
+    "ratings": [
+        {"keys": [("message_id", ASCENDING), ("user_id", ASCENDING)], "unique": True},
+    ],
+    "daily_views": [
+        {"keys": [("day", ASCENDING)]},
+        {"keys": [("date", ASCENDING)], "expireAfterSeconds": 8 * 24 * 3600},
+    ],
+    "requests": [
+        # Documents from before aggregation have no key and are left out until migrated
+        {"keys": [("key", ASCENDING)], "unique": True, "partialFilterExpression": {"status": "pending", "key": {"$exists": True}}},
+        {"keys": [("status", ASCENDING), ("tokens", ASCENDING)]},
+    ],
+    "missed_queries": [
+        {"keys": [("status", ASCENDING), ("count", -1)]},
+        {"keys": [("last_seen", ASCENDING)], "expireAfterSeconds": 30 * 24 * 3600},
+    ],
+    "stats": [
+        {"keys": [("scale", ASCENDING), ("start", ASCENDING)]},
+        {"keys": [("expires", ASCENDING)], "expireAfterSeconds": 0},
+    ],
+    "callback_tokens": [
+        {"keys": [("expires", ASCENDING)], "expireAfterSeconds": 0},
+    ],
+}
+INDEX_OPTIONS = ("unique", "sparse", "expireAfterSeconds", "partialFilterExpression")
+
+
+def index_name(keys):
+    # Mongo's default name, e.g. language_1_title_clean_1
+    return "_".join(f"{field}_{direction}" for field, direction in keys)
+
+
+def _options(spec):
+    # expireAfterSeconds=0 is meaningful, so only None/False count as unset
+    return {option: spec[option] for option in INDEX_OPTIONS if spec.get(option) is not None and spec.get(option) is not False}
+
+
+def _existing(info):
+    # list_indexes() reports key directions as floats on some servers
+    keys = [(field, int(direction) if isinstance(direction, float) else direction) for field, direction in info["key"].items()]
+    return keys, _options(info)
+
+
+async def migrate_rated_by(db):
+    # The old rated_by arrays on movie documents become rows in the ratings collection
+    migrated = await db.ratings.migrate_rated_by()
+    print(f"Moved {migrated} legacy votes from rated_by into the ratings collection.")
+
+
+async def migrate_requests(db):
+    # One document per request becomes one per title, with the users merged into requesters
+    legacy, merged = await db.requests.merge_legacy(request_key)
+    print(f"Merged {legacy} legacy requests into {merged} pending titles.")
+
+
+async def backfill_tokens(db):
+    # Recomputes title_clean, tokens, year, language and quality with the Unicode-aware analyze()
+    updated = await db.movies.backfill(analyze)
+    print(f"Re-analyzed {updated} movie titles.")
+
+
+async def split_legacy_ratings(db):
+    # likes/dislikes become legacy counts plus the votes in the ratings collection
+    updated = await db.ratings.split_legacy_counts()
+    print(f"Split legacy rating counts on {updated} movies.")
+
+
+# (version, description, coroutine); applied in order, each at most once
+MIGRATIONS = [
+    (1, "move rated_by arrays into the ratings collection", migrate_rated_by),
+    (2, "aggregate movie requests per title", migrate_requests),
+    (3, "store Unicode-aware tokens, year, language and quality per movie", backfill_tokens),
+    (4, "derive rating counts from the ratings collection", split_legacy_ratings),
+]
+
+
+class SchemaManager:
+    # Compares the declared indexes with list_indexes() and only builds what is
+    # missing or changed, and applies pending migrations recorded in settings.
+
+    def __init__(self, db, indexes=INDEXES, migrations=MIGRATIONS):
+        self.db = db
+        self.indexes = indexes
+        self.migrations = migrations
+        self._task = None
+
+    async def _list_indexes(self, collection):
+        async def list_indexes():
+            cursor = await self.db.database[collection].list_indexes()
+            return await cursor.to_list(None)
+        return await self.db.run(list_indexes)
+
+    async def plan(self):
+        # Returns [(collection, spec, reason)] for every index that needs building
+        plan = []
+        for collection, specs in self.indexes.items():
+            existing = {info["name"]: _existing(info) for info in await self._list_indexes(collection)}
+            for spec in specs:
+                name = index_name(spec["keys"])
+                wanted = (list(spec["keys"]), _options(spec))
+                if name not in existing:
+                    plan.append((collection, spec, "missing"))
+                elif existing[name] != wanted:
+                    plan.append((collection, spec, "changed"))
+        return plan
+
+    async def _build(self, plan):
+        for collection, spec, reason in plan:
+            col = self.db.database[collection]
+            name = index_name(spec["keys"])
+            start = time.perf_counter()
+            try:
+                if reason == "changed":
+                    await col.drop_index(name)
+                await col.create_index(spec["keys"], name=name, **_options(spec))
+                print(f"Index {collection}.{name} built ({reason}) in {time.perf_counter() - start:.2f}s")
+            except DuplicateKeyError as e:
+                print(f"Error: Cannot create unique index {collection}.{name} due to duplicate entries. "
+                      f"Please clean your database manually if this persists. Error: {e}")
+            except OperationFailure as e:
+                print(f"Error creating index {collection}.{name}: {e}")
+
+    async def sync_indexes(self, wait=False):
+        plan = await self.plan()
+        if not plan:
+            print("All indexes up to date.")
+            return plan
+        names = ", ".join(f"{collection}.{index_name(spec['keys'])} ({reason})" for collection, spec, reason in plan)
+        print(f"Building {len(plan)} index(es) in the background: {names}")
+        if wait:
+            await self._build(plan)
+        else:
+            # Existing indexes keep serving queries; startup doesn't wait on the builds
+            self._task = asyncio.create_task(self._build(plan))
+        return plan
+
+    async def migrate(self):
+        version = await self.db.settings.get("schema_version")
+        if version is None:
+            # Deployments from before schema versions recorded the rated_by move separately
+            version = 1 if await self.db.settings.get("ratings_migrated") else 0
+            await self.db.settings.set("schema_version", version)
+        applied = []
+        for target, description, migration in self.migrations:
+            if target <= version:
+                continue
+            start = time.perf_counter()
+            await migration(self.db)
+            await self.db.settings.set("schema_version", target)
+            version = target
+            applied.append(target)
+            print(f"Migration {target} ({description}) applied in {time.perf_counter() - start:.2f}s")
+        return applied
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
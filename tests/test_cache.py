@@ -0,0 +1,54 @@
+import pytest
+
+import cache
+from cache import LRUCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_entries_expire_after_ttl(clock):
+    lru = LRUCache(maxsize=10, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2, ttl=5)
+    clock[0] += 5
+    assert lru.get("b") is None and "b" not in lru
+    assert lru.get("a") == 1 and "a" in lru
+    clock[0] += 55
+    assert lru.get("a") is None
+    assert lru.stats()["expirations"] == 2
+    assert lru.stats()["hits"] == 1 and lru.stats()["misses"] == 2
+
+
+def test_set_restarts_the_ttl(clock):
+    lru = LRUCache(maxsize=10, ttl=60)
+    lru.set("a", 1)
+    clock[0] += 50
+    lru.set("a", 1)
+    clock[0] += 50
+    assert lru.get("a") == 1
+
+
+def test_least_recently_used_is_evicted(clock):
+    lru = LRUCache(maxsize=2, ttl=60)
+    lru.set("a", 1)
+    lru.set("b", 2)
+    lru.get("a")
+    lru.set("c", 3)
+    assert "b" not in lru and "a" in lru and "c" in lru
+    assert lru.evictions == 1
+
+
+def test_invalidate_and_clear_are_counted(clock):
+    lru = LRUCache(maxsize=10, ttl=60)
+    for key in range(5):
+        lru.set(key, key * 10)
+    assert lru.invalidate(lambda key, value: value >= 30) == 2
+    assert len(lru) == 3
+    lru.clear()
+    assert len(lru) == 0
+    assert lru.invalidations == 5
@@ -0,0 +1,89 @@
+import random
+
+import pytest
+
+from benchmark import make_catalog, make_queries, typo
+from catalog import FuzzyIndex, TitleIndex, _grams, _needed, clean_text, fuzzy_key, normalize, normalize_query, tokenize
+
+
+@pytest.fixture(scope="module")
+def movies():
+    return make_catalog(3000, random.Random(3))
+
+
+@pytest.fixture(scope="module")
+def fuzzy(movies):
+    return FuzzyIndex((movie["message_id"], fuzzy_key(movie["title"]), movie["language"]) for movie in movies)
+
+
+@pytest.fixture(scope="module")
+def index(movies):
+    index = TitleIndex()
+    index.load(movies)
+    return index
+
+
+def test_contains_ids_matches_brute_force(movies, index):
+    # What _contains_ids promises: every word but the last is a whole title word, the
+    # last is a word prefix (3+ characters unless it is the only word), and the
+    # normalized query is a substring of the normalized title; in message_id order
+    titles = sorted((movie["message_id"], set(tokenize(movie["title"])), normalize(movie["title"])) for movie in movies)
+
+    def brute_force(query):
+        tokens = tokenize(query)
+        needle = normalize_query(query)
+        return [
+            message_id for message_id, words, normalized in titles
+            if all(token in words for token in tokens[:-1])
+            and (len(tokens) > 1 and len(tokens[-1]) < 3 or any(word.startswith(tokens[-1]) for word in words))
+            and needle in normalized
+        ]
+
+    rng = random.Random(5)
+    queries = [
+        " ".join(movie["name"].split()[:words]).lower()[:length]
+        for movie in rng.sample(movies, 50) for words in (1, 2) for length in (3, 6, 40)
+    ]
+    for query in queries:
+        found = list(index._contains_ids(query))
+        assert found, query
+        assert found == brute_force(query)[:len(found)], query
+
+
+def test_contains_ids_after_remove_and_add(movies, index):
+    movie = movies[0]
+    index.remove(movie["message_id"])
+    assert movie["message_id"] not in index._contains_ids(movie["name"])
+    index.add(movie)
+    assert movie["message_id"] in index._contains_ids(movie["name"])
+
+
+def test_fuzzy_candidates_match_unpruned_count(movies, fuzzy):
+    # The pruned count must keep exactly the titles that share `needed` trigrams
+    key_grams = {message_id: _grams("".join(key)) for message_id, key, _ in fuzzy.entries()}
+    for query in make_queries(movies, 100, random.Random(7))["fuzzy"]:
+        grams = _grams(query)
+        needed = _needed(query, len(grams))
+        expected = {message_id for message_id, title_grams in key_grams.items() if len(grams & title_grams) >= needed}
+        assert set(fuzzy._candidates(query, max_candidates=None)) == expected, query
+
+
+def test_fuzzy_search_finds_exact_and_misspelled_titles(movies, fuzzy):
+    rng = random.Random(11)
+    for movie in rng.sample(movies, 100):
+        key = "".join(fuzzy_key(movie["title"]))
+        assert (movie["message_id"], 100) in fuzzy.search(key, limit=50)
+        if len(key) >= 8:
+            assert movie["message_id"] in [message_id for message_id, _ in fuzzy.search(clean_text(typo(key, rng)), limit=50)]
+
+
+def test_fuzzy_search_is_rank_of_candidates(movies, fuzzy):
+    for query, language in make_queries(movies, 100, random.Random(13))["lang"]:
+        matches = fuzzy.search(query, language=language)
+        assert matches == fuzzy.rank(query, fuzzy.candidates(query, language))
+        assert all(fuzzy._langs[message_id] == language for message_id, _ in matches)
+
+
+def test_fuzzy_plausible_agrees_with_search(movies, fuzzy):
+    for query in make_queries(movies, 100, random.Random(17))["fuzzy"] + ["qzxv", "hellothere"]:
+        assert fuzzy.plausible(query, max_scan=None) == bool(fuzzy.search(query)), query
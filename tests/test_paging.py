@@ -0,0 +1,47 @@
+from paging import fits, keyset_page
+
+
+def score_key(pair):
+    message_id, score = pair
+    return (-score, message_id)
+
+
+RANKED = sorted([(message_id, message_id % 7 * 10) for message_id in range(1, 24)], key=score_key)
+
+
+def test_pages_forward_cover_every_item_once():
+    seen, after, has_next = [], None, True
+    while has_next:
+        page, _, has_next = keyset_page(RANKED, score_key, 5, after)
+        seen.extend(page)
+        after = score_key(page[-1])
+    assert seen == RANKED
+
+
+def test_back_from_a_page_returns_the_previous_one():
+    first, has_prev, _ = keyset_page(RANKED, score_key, 5)
+    second, _, _ = keyset_page(RANKED, score_key, 5, after=score_key(first[-1]))
+    back, has_prev_back, _ = keyset_page(RANKED, score_key, 5, before=score_key(second[0]))
+    assert not has_prev
+    assert back == first and not has_prev_back
+
+
+def test_page_stays_put_when_earlier_items_change():
+    first, _, _ = keyset_page(RANKED, score_key, 5)
+    second, _, _ = keyset_page(RANKED, score_key, 5, after=score_key(first[-1]))
+    # A title on the first page is deleted and a better one is added
+    changed = sorted([pair for pair in RANKED if pair != first[1]] + [(100, 1000)], key=score_key)
+    again, has_prev, _ = keyset_page(changed, score_key, 5, after=score_key(first[-1]))
+    assert again == second and has_prev
+
+
+def test_last_page_and_empty_list():
+    last, _, has_next = keyset_page(RANKED, score_key, 5, after=score_key(RANKED[-3]))
+    assert last == RANKED[-2:] and not has_next
+    assert keyset_page([], score_key, 5) == ([], False, False)
+
+
+def test_fits_counts_bytes():
+    assert fits("a" * 64)
+    assert not fits("a" * 65)
+    assert not fits("ক" * 22)
@@ -0,0 +1,54 @@
+from ratelimit import TokenBuckets, UpdateLimiter
+
+
+def test_burst_then_refill():
+    buckets = TokenBuckets(rate=2, burst=3)
+    assert [buckets.allow("u", now=0) for _ in range(4)] == [True, True, True, False]
+    assert not buckets.allow("u", now=0.4)
+    assert buckets.allow("u", now=0.9)
+    # Refill stops at the burst size
+    assert [buckets.allow("u", now=100) for _ in range(4)] == [True, True, True, False]
+
+
+def test_has_does_not_take_tokens():
+    buckets = TokenBuckets(rate=1, burst=1)
+    assert buckets.has("u", now=0) and buckets.has("u", now=0)
+    assert buckets.allow("u", now=0)
+    assert not buckets.has("u", now=0)
+
+
+def test_least_recent_bucket_is_evicted():
+    buckets = TokenBuckets(rate=1, burst=1, maxsize=2)
+    for key in ("a", "b", "c"):
+        buckets.allow(key, now=0)
+    assert len(buckets) == 2
+    # "a" was evicted and comes back full
+    assert buckets.allow("a", now=0)
+    assert not buckets.allow("c", now=0)
+
+
+def test_flooding_user_does_not_drain_the_group():
+    limiter = UpdateLimiter(user_rate=0.001, user_burst=2, chat_rate=0.001, chat_burst=5)
+    results = [limiter.check("message", 1, -100) for _ in range(10)]
+    assert results == [None, None] + ["user"] * 8
+    # The group bucket only paid for the two updates that went through
+    assert [limiter.check("message", user_id, -100) for user_id in (2, 3, 4)] == [None, None, None]
+    assert limiter.check("message", 5, -100) == "chat"
+    assert limiter.dropped[("message", "user")] == 8
+    assert limiter.dropped[("message", "chat")] == 1
+
+
+def test_busy_group_does_not_drain_its_users():
+    limiter = UpdateLimiter(user_rate=0.001, user_burst=2, chat_rate=0.001, chat_burst=1)
+    assert limiter.check("message", 1, -100) is None
+    assert limiter.check("message", 1, -100) == "chat"
+    # The dropped group update didn't take the user's second token
+    assert limiter.check("message", 1, 1) is None
+    assert limiter.check("message", 1, 1) == "user"
+
+
+def test_private_chat_only_charges_the_user():
+    limiter = UpdateLimiter(user_rate=0.001, user_burst=1, chat_rate=0.001, chat_burst=1)
+    assert limiter.check("inline", 7) is None
+    assert limiter.check("message", 8, 8) is None
+    assert len(limiter.chats) == 0
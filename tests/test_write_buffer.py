@@ -0,0 +1,108 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect, BulkWriteError, ServerSelectionTimeoutError
+
+from database import WriteBuffer
+
+
+class Result:
+    def __init__(self, upserted_count):
+        self.upserted_count = upserted_count
+
+
+class FakeCollection:
+    # bulk_write that records the ops it applied; `failures` are raised in turn
+    def __init__(self, name):
+        self.name = name
+        self.applied = []
+        self.failures = []
+
+    async def bulk_write(self, ops, ordered):
+        if self.failures:
+            failure = self.failures.pop(0)
+            if failure == "partial":
+                # The server rejected the first op and applied the rest
+                self.applied += ops[1:]
+                raise BulkWriteError({"writeErrors": [{"index": 0, "code": 2}], "nUpserted": 0})
+            raise failure
+        self.applied += ops
+        return Result(sum(1 for op in ops if op._upsert))
+
+
+class FakeDatabase:
+    def __init__(self):
+        for name in ("movies_col", "daily_views_col", "users_col", "missed_queries_col", "stats_col"):
+            setattr(self, name, FakeCollection(name))
+
+    async def run(self, operation, idempotent=True):
+        return await operation()
+
+
+def views(col):
+    return {op._filter["message_id"]: op._doc["$inc"]["views_count"] for op in col.applied}
+
+
+def flush(buffer, times=1):
+    async def run():
+        for _ in range(times):
+            await buffer.flush()
+    asyncio.run(run())
+
+
+def test_partial_failure_keeps_only_the_rejected_ops():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db)
+    buffer.incr_views(1)
+    buffer.incr_views(2, 3)
+    db.movies_col.failures = ["partial"]
+    flush(buffer)
+    assert views(db.movies_col) == {2: 3}
+    assert len(buffer) == 1
+    flush(buffer)
+    # Only the rejected op was written again, never the one that applied
+    assert [op._filter["message_id"] for op in db.movies_col.applied] == [2, 1]
+    assert buffer.dropped == 0 and len(buffer) == 0
+
+
+def test_failure_in_one_collection_leaves_the_others_alone():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db)
+    buffer.incr_views(1)
+    buffer.count("searches")
+    db.stats_col.failures = [ServerSelectionTimeoutError("no server")] * 2
+    flush(buffer, times=3)
+    assert views(db.movies_col) == {1: 1}
+    assert sum(op._doc["$inc"].get("counts.searches", 0) for op in db.stats_col.applied) == 2
+
+
+def test_inc_batch_is_dropped_after_a_network_error():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db)
+    buffer.incr_views(1, 5)
+    db.movies_col.failures = [AutoReconnect("connection reset")]
+    flush(buffer, times=2)
+    # The batch may have been applied, so it is not replayed
+    assert db.movies_col.applied == []
+    assert buffer.dropped == 1
+    assert buffer.stats()["dropped"] == 1
+
+
+def test_idempotent_user_updates_are_kept_after_a_network_error():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db)
+    buffer.touch_user(7, "matrix")
+    db.users_col.failures = [AutoReconnect("connection reset")]
+    flush(buffer)
+    assert db.users_col.applied == [] and len(buffer) == 1
+    flush(buffer)
+    assert [op._filter["_id"] for op in db.users_col.applied] == [7]
+    assert buffer.dropped == 0
+
+
+def test_new_users_are_counted_in_the_next_flush():
+    db = FakeDatabase()
+    buffer = WriteBuffer(db)
+    buffer.touch_user(7, "matrix")
+    flush(buffer, times=2)
+    # Once in the minute bucket and once in the all-time totals
+    assert [op._doc["$inc"].get("counts.new_users") for op in db.stats_col.applied] == [1, 1]